@@ -1,21 +1,13 @@
-import multiprocessing
-from flask import Flask
+"""Protein search web app.
 
+The Flask application is created on the first access of app.application, so worker processes and utilities importing
+only app.computation (or other modules) do not load Flask and the routes.
+"""
 
-application = Flask(__name__)
 
-application.jinja_env.trim_blocks = True
-application.jinja_env.lstrip_blocks = True
-
-
-application.mp_manager = multiprocessing.Manager()
-application.db_stats = application.mp_manager.dict()
-application.computation_results = application.mp_manager.dict()
-
-application.secret_key = 'protein search secret key'
-
-
-if __name__ == '__main__':
-    application.run()
-
-from . import routes
+def __getattr__(name: str):
+    if name == 'application':
+        from .web import application
+        from . import routes  # registers the views
+        return application
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+from .config import config
+from .metrics import ADMISSION_QUEUE_LENGTH, ADMISSION_REJECTED, ADMISSION_RUNNING_COST
+
+# Costs are measured in alignments of two chains of this length, gesamt time grows about with the product of lengths
+REFERENCE_CHAIN_LENGTH = 250
+# Clients with a full token bucket are forgotten when more than this many are tracked
+MAX_TRACKED_CLIENTS = 10000
+
+
+class AdmissionError(RuntimeError):
+    def __init__(self, message: str, retry_after: Optional[int]):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def estimate_cost(num_results: int, radius: float, chain_length: int) -> float:
+    """Estimated work of a search, in alignments of chains of REFERENCE_CHAIN_LENGTH residues.
+
+    At most num_results candidates are aligned with the query. A tight radius lets fewer chains through the sketch
+    phases, a permissive one fills all k slots. Chains of unknown length count as average ones.
+    """
+    candidates = num_results * min(1.0, 0.2 + radius)
+    return candidates * (chain_length or REFERENCE_CHAIN_LENGTH) / REFERENCE_CHAIN_LENGTH
+
+
+class AdmissionController:
+    """Runs searches while their total estimated cost fits the capacity, the others wait in a FIFO queue.
+
+    Jobs costing more than the whole capacity are rejected, they would hold the queue until the server is idle and
+    then keep everyone else waiting. Every client (IP address or API token)
+    may have only a few jobs created, queued or running at once, and starts new ones at a limited rate.
+    """
+
+    def __init__(self, capacity: float, max_jobs_per_client: int, rate_per_minute: float, rate_burst: int):
+        self.capacity = capacity
+        self.max_jobs_per_client = max_jobs_per_client
+        self.rate_per_minute = rate_per_minute
+        self.rate_burst = rate_burst
+        self.condition = threading.Condition()
+        self.queue: Deque[str] = deque()
+        self.costs: Dict[str, float] = {}
+        self.running: Dict[str, float] = {}
+        self.client_jobs: Dict[str, Set[str]] = {}
+        self.job_clients: Dict[str, str] = {}
+        # Token buckets of the clients: (tokens, time of the last update)
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+
+    def register(self, job_id: str, client: str, cost: float) -> None:
+        """Counts the job towards the limits of the client until released, AdmissionError if they are exceeded or the
+        job could never run beside others."""
+        now = time.time()
+        with self.condition:
+            if cost > self.capacity:
+                ADMISSION_REJECTED.inc(label_value='cost')
+                raise AdmissionError('The search is too large for the server. '
+                                     'Lower the number of results or the Q-score range.', None)
+
+            jobs = self.client_jobs.get(client, set())
+            if len(jobs) >= self.max_jobs_per_client:
+                ADMISSION_REJECTED.inc(label_value='concurrency')
+                raise AdmissionError(f'You already have {len(jobs)} searches in progress. '
+                                     f'Wait until they finish or stop some of them.', 30)
+
+            tokens, updated = self.buckets.get(client, (self.rate_burst, now))
+            tokens = min(self.rate_burst, tokens + (now - updated) * self.rate_per_minute / 60)
+            if tokens < 1:
+                ADMISSION_REJECTED.inc(label_value='rate')
+                retry_after = int((1 - tokens) * 60 / self.rate_per_minute) + 1
+                raise AdmissionError(f'Too many searches started. Try again in {retry_after} s.', retry_after)
+
+            if len(self.buckets) > MAX_TRACKED_CLIENTS:
+                refill = self.rate_burst * 60 / self.rate_per_minute
+                self.buckets = {key: value for key, value in self.buckets.items() if now - value[1] < refill}
+            self.buckets[client] = (tokens - 1, now)
+            self.client_jobs.setdefault(client, set()).add(job_id)
+            self.job_clients[job_id] = client
+
+    def enqueue(self, job_id: str, cost: float) -> None:
+        with self.condition:
+            # Released (e.g., its client disconnected) before it got here
+            if job_id not in self.job_clients:
+                return
+            self.queue.append(job_id)
+            self.costs[job_id] = cost
+            ADMISSION_QUEUE_LENGTH.set(len(self.queue))
+            self._admit()
+
+    def _admit(self) -> None:
+        while self.queue:
+            job_id = self.queue[0]
+            cost = self.costs[job_id]
+            if self.running and sum(self.running.values()) + cost > self.capacity:
+                break
+            self.queue.popleft()
+            self.running[job_id] = cost
+            self.condition.notify_all()
+        ADMISSION_QUEUE_LENGTH.set(len(self.queue))
+        ADMISSION_RUNNING_COST.set(sum(self.running.values()))
+
+    def wait(self, job_id: str, timeout: float) -> Optional[int]:
+        """None once the job may run, otherwise its position in the queue after waiting up to timeout, 0 if the job
+        was released meanwhile (cancelled)."""
+        with self.condition:
+            if job_id not in self.running:
+                self.condition.wait(timeout)
+            if job_id in self.running:
+                return None
+            if job_id not in self.queue:
+                return 0
+            return self.queue.index(job_id) + 1
+
+    def release(self, job_id: str) -> None:
+        with self.condition:
+            if job_id in self.queue:
+                self.queue.remove(job_id)
+            self.running.pop(job_id, None)
+            self.costs.pop(job_id, None)
+            client = self.job_clients.pop(job_id, None)
+            if client is not None:
+                self.client_jobs[client].discard(job_id)
+                if not self.client_jobs[client]:
+                    del self.client_jobs[client]
+            self._admit()
+            # Positions of the queued jobs changed
+            self.condition.notify_all()
+
+
+ADMISSION = AdmissionController(config.getfloat('admission', 'capacity', fallback=(os.cpu_count() or 1) * 200),
+                                config.getint('admission', 'max_jobs_per_client', fallback=3),
+                                config.getfloat('admission', 'rate_per_minute', fallback=10),
+                                config.getint('admission', 'rate_burst', fallback=5))
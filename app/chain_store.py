@@ -0,0 +1,192 @@
+"""Chain binaries of the archive kept in shared memory for the alignments.
+
+python_distance reads both chains of an alignment from the archive directory, so the query of a search is read once
+per candidate and popular chains by every job. The store is a directory with the layout of the archive on a tmpfs
+(/dev/shm, where multiprocessing.shared_memory segments live too), chains are copied there on first use and then read
+from memory by all workers and server processes. Chains that do not fit the budget are read from the archive, the
+janitor thread then removes the least recently used chains, chains used within MIN_IDLE never, so a worker does not lose
+a chain between choosing the store and reading it. Chains changed by an archive update are removed from the store by
+utils/archive_hooks.py. The store is disabled unless [chain_store] budget_mb is set.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+from .config import config
+from .logs import log
+from .metrics import CHAIN_STORE_BYTES, CHAIN_STORE_CHAINS, CHAIN_STORE_EVICTED, CHAIN_STORE_LOOKUPS
+
+# The janitor recounts the resident size from the directory this often (copies that failed midway are not subtracted)
+SCAN_INTERVAL = 60
+# Chains used recently (i.e., being aligned) are never removed
+MIN_IDLE = 60
+# Eviction stops below this fraction of the budget
+LOW_WATERMARK = 0.9
+DEFAULT_DIRECTORY = '/dev/shm/protein_search_chains'
+
+
+class ChainStore:
+    def __init__(self, directory: Path, archive: str, budget: int):
+        self.directory = Path(directory)
+        self.archive = archive
+        self.budget = budget
+        # Shared by the processes forked from this one (workers of the pools, gunicorn workers of the preloaded app),
+        # which add chains concurrently; only the janitor scans the directory and removes chains
+        self.lock = multiprocessing.Lock()
+        self.resident = multiprocessing.RawValue('q', 0)
+        self.scanned = multiprocessing.RawValue('d', 0.0)
+        self.full = multiprocessing.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.budget > 0
+
+    @staticmethod
+    def chain_path(root, chain_id: str) -> Path:
+        return Path(root, chain_id[1:3].lower(), f'{chain_id}.bin')
+
+    def archive_for(self, chain_ids: Iterable[str]) -> str:
+        """Archive directory to pass to python_distance for the chains, the store if it holds all of them. Uploaded
+        queries are read from their job directories in either case."""
+        if not self.enabled:
+            return self.archive
+        for chain_id in chain_ids:
+            if not chain_id.startswith('_') and not self.ensure(chain_id):
+                return self.archive
+        return str(self.directory)
+
+    def ensure(self, chain_id: str) -> bool:
+        """Whether the chain is in the store, copied from the archive if missing and there is space for it."""
+        path = self.chain_path(self.directory, chain_id)
+        try:
+            os.utime(path)  # modification time orders the chains for eviction
+            CHAIN_STORE_LOOKUPS.inc(label_value='hit')
+            return True
+        except FileNotFoundError:
+            CHAIN_STORE_LOOKUPS.inc(label_value='miss')
+
+        source = self.chain_path(self.archive, chain_id)
+        tmp = None
+        try:
+            if not self.reserve(source.stat().st_size):
+                return False
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(prefix='.tmp', dir=path.parent)
+            with os.fdopen(fd, 'wb') as f_out, open(source, 'rb') as f_in:
+                shutil.copyfileobj(f_in, f_out)
+            os.replace(tmp, path)
+            CHAIN_STORE_CHAINS.inc()
+        except OSError as e:
+            log('chain_store_failed', logging.WARNING, chain=chain_id, error=str(e))
+            if tmp is not None:
+                Path(tmp).unlink(missing_ok=True)
+            return False
+        return True
+
+    def list_chains(self) -> List[Tuple[float, int, Path]]:
+        chains = []
+        for directory, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = Path(directory, filename)
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue  # removed meanwhile
+                chains.append((stat.st_mtime, stat.st_size, path))
+        return chains
+
+    def count(self, chains: List[Tuple[float, int, Path]]) -> None:
+        """Sets the resident size to that of the listed chains, called with the lock held."""
+        self.resident.value = sum(size for _, size, _ in chains)
+        self.scanned.value = time.time()
+        CHAIN_STORE_BYTES.set(self.resident.value)
+        CHAIN_STORE_CHAINS.set(len(chains))
+
+    def scan(self) -> List[Tuple[float, int, Path]]:
+        chains = self.list_chains()
+        with self.lock:
+            self.count(chains)
+        return chains
+
+    def reserve(self, size: int) -> bool:
+        """Counts a chain of the given size as resident, False if it does not fit (the janitor then makes space)."""
+        with self.lock:
+            if not self.scanned.value:
+                # The janitor has not counted the store yet (or does not run in this program), once for all processes
+                self.count(self.list_chains())
+            if self.resident.value + size > self.budget:
+                self.full.set()
+                return False
+            self.resident.value += size
+            CHAIN_STORE_BYTES.set(self.resident.value)
+        return True
+
+    def evict(self, chains: List[Tuple[float, int, Path]], needed: int) -> None:
+        idle_since = time.time() - MIN_IDLE
+        freed = 0
+        for mtime, size, path in sorted(chains):
+            if freed >= needed or mtime > idle_since:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            freed += size
+            CHAIN_STORE_EVICTED.inc()
+            CHAIN_STORE_CHAINS.dec()
+        with self.lock:
+            self.resident.value -= freed
+            CHAIN_STORE_BYTES.set(self.resident.value)
+        if freed:
+            log('chain_store_evicted', logging.DEBUG, freed=freed)
+
+    def collect(self) -> None:
+        """Recounts the store and removes the least recently used chains if it is (nearly) full."""
+        full = self.full.is_set()
+        self.full.clear()
+        chains = self.scan()
+        if full or self.resident.value > self.budget:
+            self.evict(chains, self.resident.value - int(self.budget * LOW_WATERMARK))
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.collect()
+            except Exception as e:
+                log('chain_store_collection_failed', logging.ERROR, error=str(e))
+            # Woken early by a chain that did not fit
+            self.full.wait(SCAN_INTERVAL)
+
+    def preload(self, list_file: str) -> None:
+        """Copies the chains listed in the file (e.g., the pivots) to the store."""
+        try:
+            with open(list_file) as f:
+                chain_ids = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        except OSError as e:
+            log('chain_store_preload_failed', logging.WARNING, file=list_file, error=str(e))
+            return
+        loaded = sum(self.ensure(chain_id) for chain_id in chain_ids)
+        log('chain_store_preloaded', chains=loaded, listed=len(chain_ids))
+
+    def start(self) -> None:
+        """Starts the janitor and the preload of [dirs] preload_list, in one process of the server."""
+        if not self.enabled or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name='chain-store-janitor', daemon=True)
+        self.thread.start()
+        # The same list as PRELOAD_LIST of docker/config.py
+        list_file = config.get('dirs', 'preload_list', fallback=None)
+        if list_file:
+            threading.Thread(target=self.preload, args=(list_file,), daemon=True, name='chain-store-preload').start()
+
+
+CHAIN_STORE = ChainStore(Path(config.get('chain_store', 'directory', fallback=DEFAULT_DIRECTORY)),
+                         config.get('dirs', 'archive', fallback=''),
+                         config.getint('chain_store', 'budget_mb', fallback=0) << 20)
@@ -1,4 +1,6 @@
 import os
+import gzip
+import hashlib
 import numpy as np
 import tempfile
 from pathlib import Path
@@ -6,21 +8,65 @@ import shutil
 import requests
 import json
 import mariadb
+import multiprocessing
 import time
+import signal
 import subprocess
+import tarfile
+import zipfile
 
-from flask import Request
-from typing import List, Tuple, Dict
+from concurrent.futures import Executor, Future, wait
+from typing import IO, TYPE_CHECKING, List, Tuple, Dict, Optional
 
+import logging
 import python_distance
+from .chain_store import CHAIN_STORE
 from .config import config
+from .id_map import IdMapStore, get_id_map_dir
+from .logs import log
+from .metrics import (ALIGNMENT_CACHE, ALIGNMENT_TIME, DB_QUERY_TIME, MESSIF_ERRORS,
+                      MESSIF_LATENCY, NEIGHBOUR_LISTS, PREPARE_PDB_TIME, PYMOL_RENDER_TIME, QUERY_CACHE)
+from .neighbours import NeighbourListStore, get_neighbours_dir
+from .sketches import get_results_local
+from .tracing import span
+
+if TYPE_CHECKING:
+    from flask import Request
+
+UPLOAD_CHUNK_SIZE = 1 << 20
+# Uncompressed sizes of the structures in a batch archive
+MAX_ARCHIVE_MEMBER_SIZE = 64 << 20
+MAX_ARCHIVE_SIZE = 1 << 30
+# Symlink from a job directory to its entry of the query cache
+QUERY_CACHE_LINK = 'cache'
+MESSIF_END_JOB_TIMEOUT = 5
+CANCEL_CHECK_INTERVAL = 0.2
+
+
+class TimedCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        with DB_QUERY_TIME.time():
+            return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        with DB_QUERY_TIME.time():
+            return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
 
 
 class DBConnection:
     def __enter__(self):
         self.conn = mariadb.connect(host=config['db']['host'], user=config['db']['user'], password=config['db']['password'],
                                     database=config['db']['database'])
-        self.c = self.conn.cursor()
+        self.c = TimedCursor(self.conn.cursor())
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -58,7 +104,31 @@ def search_title(query: str, limit: int) -> List[str]:
     return pdb_ids
 
 
-def prepare_indexed_chain(pdb_id: str) -> Tuple[str, List[Tuple[str, int]]]:
+def link_or_copy(source: Path, target: Path) -> None:
+    # Files of the query cache are never modified, so jobs share them as hard links
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy(source, target)
+
+
+def link_query_cache(entry: Path, directory: str, chains: List[Tuple[str, int]]) -> None:
+    for chain, _ in chains:
+        link_or_copy(Path(entry, f'query:{chain}.bin'), Path(directory, f'query:{chain}.bin'))
+    # Prepared query.pdb files are taken from the entry too, see prepare_PDB_wrapper
+    os.symlink(entry, Path(directory, QUERY_CACHE_LINK))
+
+
+def get_indexed_cache_entry(pdb_id: str) -> Path:
+    """Entry of the query cache with the structure, chain binaries and chain list of an indexed PDB entry."""
+    prefix = pdb_id[1:3].lower()
+    raw_file = Path(config['dirs']['raw_pdbs'], prefix, f'{pdb_id.lower()}.cif')
+    # The raw file is replaced (together with the binaries) whenever the entry is updated in the archive
+    stat = raw_file.stat()
+    entry = Path(get_upload_cache_dir(), f'pdb_{pdb_id}_{stat.st_size}_{stat.st_mtime_ns}')
+    if Path(entry, 'chains.json').exists():
+        return entry
+
     with DBConnection() as db:
         db.c.execute('SELECT gesamtId, chainLength FROM proteinChain WHERE gesamtId LIKE %s AND indexedAsDataObject = 1', (f'{pdb_id}%',))
         chains = [(chain_data[0].split(':')[1], chain_data[1]) for chain_data in db.c.fetchall()]
@@ -66,60 +136,370 @@ def prepare_indexed_chain(pdb_id: str) -> Tuple[str, List[Tuple[str, int]]]:
     if not chains:
         raise RuntimeError('No chains having at least 10 residues detected.')
 
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    tmp_entry = tempfile.mkdtemp(prefix='tmp', dir=entry.parent)
+    shutil.copy(raw_file, Path(tmp_entry, 'query'))
+    for chain, _ in chains:
+        shutil.copy(Path(config['dirs']['archive'], prefix, f'{pdb_id}:{chain}.bin'),
+                    Path(tmp_entry, f'query:{chain}.bin'))
+    with open(Path(tmp_entry, 'chains.json'), 'w') as f:
+        json.dump(chains, f)
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # Same entry prepared concurrently by another job
+        shutil.rmtree(tmp_entry)
+    return entry
+
+
+def prepare_indexed_chain(pdb_id: str) -> Tuple[str, List[Tuple[str, int]]]:
+    entry = get_indexed_cache_entry(pdb_id)
+    with open(Path(entry, 'chains.json')) as f:
+        chains = [(chain, size) for chain, size in json.load(f)]
+
     tmpdir = tempfile.mkdtemp(prefix='query', dir=config['dirs']['computations'])
     os.chmod(tmpdir, 0o755)
 
-    prefix = pdb_id[1:3].lower()
-    shutil.copy(Path(config['dirs']['raw_pdbs'], prefix,f'{pdb_id.lower()}.cif'), Path(tmpdir, 'query'))
-    for chain in (chain[0] for chain in chains):
-        filename = Path(config['dirs']['archive'], prefix, f'{pdb_id}:{chain}.bin')
-        shutil.copy(filename, Path(tmpdir, f'query:{chain}.bin'))
+    link_or_copy(Path(entry, 'query'), Path(tmpdir, 'query'))
+    link_query_cache(entry, tmpdir, chains)
+    os.utime(entry)
 
     job_id = Path(tmpdir).name[len('query'):]
     return job_id, chains
 
 
-def process_input(req: Request) -> Tuple[str, List[Tuple[str, int]]]:
+def get_upload_cache_dir() -> Path:
+    # Query cache: entries of uploads are named by the hash of their content, indexed entries by their PDB ID and
+    # the version of the raw file
+    return Path(config.get('dirs', 'upload_cache',
+                           fallback=str(Path(config['dirs']['computations'], 'upload_cache'))))
+
+
+def save_upload(req: 'Request', path: Path) -> str:
+    stream = req.files['file'].stream
+    magic = stream.read(2)
+    stream.seek(0)
+    if magic == b'\x1f\x8b':
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+
+    # Hash of the decompressed content, so the same structure is found in the cache however it was uploaded
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'wb') as f:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+    except (OSError, EOFError):
+        raise RuntimeError('Uploaded file is not a valid gzip archive.')
+
+    return digest.hexdigest()
+
+
+def load_cached_chains(digest: str, directory: str) -> Optional[List[Tuple[str, int]]]:
+    cached = Path(get_upload_cache_dir(), digest)
+    try:
+        with open(Path(cached, 'chains.json')) as f:
+            chains = [(chain, size) for chain, size in json.load(f)]
+        link_query_cache(cached, directory, chains)
+        # Last use of the entry for the eviction from the cache, see storage.py
+        os.utime(cached)
+    except (OSError, ValueError):
+        # Entry evicted meanwhile, the upload is converted again and must not write into the linked files
+        for path in (*Path(directory).glob('query:*.bin'), Path(directory, QUERY_CACHE_LINK)):
+            path.unlink(missing_ok=True)
+        return None
+
+    with open(Path(directory, 'chains.json'), 'w') as f:
+        json.dump(chains, f)
+    return chains
+
+
+def convert_upload(directory: str, digest: str) -> None:
+    try:
+        chains = python_distance.save_chains(str(Path(directory, 'query')), directory, 'query')
+    except Exception as e:
+        log('upload_conversion_failed', logging.ERROR, directory=directory, error=str(e))
+        chains = None
+
+    if not chains:
+        with open(Path(directory, 'error.txt'), 'w') as f:
+            f.write('No chains having at least 10 residues detected.')
+        return
+
+    cache_root = get_upload_cache_dir()
+    cache_root.mkdir(parents=True, exist_ok=True)
+    tmp_cache = tempfile.mkdtemp(prefix='tmp', dir=cache_root)
+    # The entry holds everything prepare_PDB_wrapper reads, like the entries of indexed structures
+    link_or_copy(Path(directory, 'query'), Path(tmp_cache, 'query'))
+    for chain, _ in chains:
+        link_or_copy(Path(directory, f'query:{chain}.bin'), Path(tmp_cache, f'query:{chain}.bin'))
+    with open(Path(tmp_cache, 'chains.json'), 'w') as f:
+        json.dump(chains, f)
+    try:
+        os.rename(tmp_cache, Path(cache_root, digest))
+    except OSError:
+        # Same structure converted concurrently by another job
+        shutil.rmtree(tmp_cache)
+    try:
+        os.symlink(Path(cache_root, digest), Path(directory, QUERY_CACHE_LINK))
+    except OSError:
+        pass  # query.pdb is then prepared in the job directory
+
+    # chains.json in the job directory signals that the upload is ready
+    with open(Path(directory, 'chains.json.tmp'), 'w') as f:
+        json.dump(chains, f)
+    os.replace(Path(directory, 'chains.json.tmp'), Path(directory, 'chains.json'))
+
+
+def conversion_done(directory: str, future: Future) -> None:
+    # convert_upload() reports its own errors, this one is left if the worker died (e.g., a crash in save_chains)
+    error = future.exception() if not future.cancelled() else RuntimeError('cancelled')
+    if error is None or Path(directory, 'chains.json').exists():
+        return
+    log('upload_conversion_failed', logging.ERROR, directory=directory, error=repr(error))
+    with open(Path(directory, 'error.txt'), 'w') as f:
+        f.write('The structure could not be processed.')
+
+
+def get_upload_status(job_id: str) -> dict:
+    directory = Path(config['dirs']['computations'], f'query{job_id}')
+    if Path(directory, 'chains.json').exists():
+        with open(Path(directory, 'chains.json')) as f:
+            return {'status': 'READY', 'chains': json.load(f)}
+    if Path(directory, 'error.txt').exists():
+        with open(Path(directory, 'error.txt')) as f:
+            return {'status': 'ERROR', 'error_message': f.read()}
+    return {'status': 'PARSING'}
+
+
+def process_input(req: 'Request', executor: Executor) -> Tuple[str, Optional[List[Tuple[str, int]]]]:
     tmpdir = tempfile.mkdtemp(prefix='query', dir=config['dirs']['computations'])
     os.chmod(tmpdir, 0o755)
-    path = Path(tmpdir, 'query')
-    req.files['file'].save(path)
+    digest = save_upload(req, Path(tmpdir, 'query'))
 
     job_id = Path(tmpdir).name[len('query'):]
-    chains = python_distance.save_chains(str(Path(tmpdir, 'query')), tmpdir, 'query')
-    if not chains:
-        raise RuntimeError('No chains having at least 10 residues detected.')
+    chains = load_cached_chains(digest, tmpdir)
+    if chains is None:
+        future = executor.submit(convert_upload, tmpdir, digest)
+        future.add_done_callback(lambda done: conversion_done(tmpdir, done))
 
     return job_id, chains
 
 
+def check_archive_members(sizes: List[int], max_queries: int) -> None:
+    # Each member gives at least one query, limits are checked before anything is extracted
+    if len(sizes) > max_queries:
+        raise RuntimeError(f'At most {max_queries} queries are allowed in a batch.')
+    if any(size > MAX_ARCHIVE_MEMBER_SIZE for size in sizes):
+        raise RuntimeError(f'Structures in the archive may have at most {MAX_ARCHIVE_MEMBER_SIZE >> 20} MB.')
+    if sum(sizes) > MAX_ARCHIVE_SIZE:
+        raise RuntimeError(f'Structures in the archive may have at most {MAX_ARCHIVE_SIZE >> 20} MB in total.')
+
+
+def extract_member(stream: IO[bytes]) -> Tuple[str, str]:
+    """Job directory with the member saved as its query and the hash of the member, like save_upload."""
+    tmpdir = tempfile.mkdtemp(prefix='query', dir=config['dirs']['computations'])
+    os.chmod(tmpdir, 0o755)
+    digest = hashlib.sha256()
+    with stream, open(Path(tmpdir, 'query'), 'wb') as f:
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+    return tmpdir, digest.hexdigest()
+
+
+def process_archive(req: 'Request', max_queries: int, executor: Executor) -> List[Tuple[List[str], str]]:
+    """Queries of the structures in the uploaded archive, converted by the executor like single uploads."""
+    members: List[Tuple[str, str, str]] = []
+    futures: List[Future] = []
+    completed = False
+    try:
+        with tempfile.TemporaryDirectory(prefix='archive', dir=config['dirs']['computations']) as archive_dir:
+            archive = Path(archive_dir, 'archive')
+            req.files['file'].save(archive)
+
+            if zipfile.is_zipfile(archive):
+                with zipfile.ZipFile(archive) as f:
+                    infos = [info for info in f.infolist() if not info.is_dir()]
+                    check_archive_members([info.file_size for info in infos], max_queries)
+                    for info in infos:
+                        members.append((Path(info.filename).name, *extract_member(f.open(info))))
+            elif tarfile.is_tarfile(archive):
+                with tarfile.open(archive) as f:
+                    infos = [info for info in f.getmembers() if info.isfile()]
+                    check_archive_members([info.size for info in infos], max_queries)
+                    for info in infos:
+                        members.append((Path(info.name).name, *extract_member(f.extractfile(info))))
+            else:
+                raise RuntimeError('Uploaded file is not a zip or tar archive.')
+
+        for _, tmpdir, digest in members:
+            if load_cached_chains(digest, tmpdir) is None:
+                futures.append(executor.submit(convert_upload, tmpdir, digest))
+                futures[-1].add_done_callback(lambda done, tmpdir=tmpdir: conversion_done(tmpdir, done))
+        wait(futures)
+
+        queries = []
+        for filename, tmpdir, _ in members:
+            job_id = Path(tmpdir).name[len('query'):]
+            # Structures that could not be converted give no queries, like those without chains
+            chains = get_upload_status(job_id).get('chains', [])
+            queries.extend(([f'{filename}:{chain}'], f'_{job_id}:{chain}') for chain, _ in chains)
+        if len(queries) > max_queries:
+            raise RuntimeError(f'At most {max_queries} queries are allowed in a batch.')
+        if not queries:
+            raise RuntimeError('No chains having at least 10 residues detected.')
+
+        completed = True
+        return queries
+    finally:
+        if not completed:
+            for future in futures:
+                future.cancel()
+            for _, tmpdir, _ in members:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def get_job_chains(job_id: str) -> List[str]:
+    directory = Path(config['dirs']['computations'], f'query{job_id}')
+    return sorted(path.stem[len('query:'):] for path in directory.glob('query:*.bin'))
+
+
+def get_chain_length(query: str, job_id: str) -> int:
+    if query.startswith('_'):
+        # Lengths of uploaded chains are known from their conversion only
+        chain = query.split(':')[1]
+        try:
+            with open(Path(config['dirs']['computations'], f'query{job_id}', 'chains.json')) as f:
+                return next((length for name, length in json.load(f) if name == chain), 0)
+        except (OSError, ValueError):
+            return 0
+
+    with DBConnection() as db:
+        db.c.execute('SELECT chainLength FROM proteinChain WHERE gesamtId = %s', (query,))
+        result = db.c.fetchall()
+    return result[0][0] if result else 0
+
+
+def get_chain_lengths(chain_ids: List[str]) -> Dict[str, int]:
+    if not chain_ids:
+        return {}
+    with DBConnection() as db:
+        query_template = ', '.join(['%s'] * len(chain_ids))
+        db.c.execute(f'SELECT gesamtId, chainLength FROM proteinChain WHERE gesamtId IN ({query_template})',
+                     tuple(chain_ids))
+        return dict(db.c.fetchall())
+
+
+def group_identical_chains(job_id: str, chains: List[str]) -> List[List[str]]:
+    # Chains with the same sequence (e.g., copies in homo-oligomers) are searched only once
+    import gemmi  # only needed here, the workers converting uploads use python_distance
+
+    try:
+        structure = gemmi.read_structure(str(Path(config['dirs']['computations'], f'query{job_id}', 'query')),
+                                         format=gemmi.CoorFormat.Detect)
+        sequences = {chain.name: chain.get_polymer().make_one_letter_sequence() for chain in structure[0]}
+    except (RuntimeError, ValueError, IndexError) as e:
+        log('sequence_read_failed', logging.WARNING, job_id=job_id, error=str(e))
+        sequences = {}
+
+    groups = {}
+    for chain in chains:
+        key = ('sequence', sequences[chain]) if sequences.get(chain) else ('chain', chain)
+        groups.setdefault(key, []).append(chain)
+
+    return list(groups.values())
+
+
+def get_engine(phase: str) -> str:
+    engine = config.get('engines', phase, fallback='messif')
+    if engine not in ('messif', 'local'):
+        raise RuntimeError(f'Unknown search engine {engine} for phase {phase}')
+    return engine
+
+
+def get_messif_url(phase: str, endpoint: str) -> str:
+    host = config.get('messif', 'host', fallback='localhost')
+    return f'http://{host}:{config["ports"][phase]}/{endpoint}'
+
+
+ID_MAPS = IdMapStore(get_id_map_dir(config))
+
+
+def get_chain_ids(int_ids: List[int]) -> List[str]:
+    """gesamtIds of the chains in the order of int_ids (i.e., MESSIF ranking)."""
+    id_map = ID_MAPS.get()
+    names = id_map.to_names(int_ids) if id_map is not None else [None] * len(int_ids)
+
+    missing = [int_id for int_id, name in zip(int_ids, names) if name is None]
+    if missing:
+        # Chains added since the map was built
+        log('id_map_miss', logging.DEBUG, count=len(missing))
+        with DBConnection() as db:
+            query_template = ', '.join(['%s'] * len(missing))
+            db.c.execute(f'SELECT intId, gesamtId FROM proteinChain WHERE intId IN ({query_template})',
+                         tuple(missing))
+            found = dict(db.c.fetchall())
+        names = [name if name is not None else found.get(int_id) for int_id, name in zip(int_ids, names)]
+
+    return [name for name in names if name is not None]
+
+
+def get_int_ids(chain_ids: List[str], db: DBConnection) -> Dict[str, int]:
+    id_map = ID_MAPS.get()
+    int_ids = id_map.to_int_ids(chain_ids) if id_map is not None else [None] * len(chain_ids)
+    result = {chain_id: int_id for chain_id, int_id in zip(chain_ids, int_ids) if int_id is not None}
+
+    missing = [chain_id for chain_id in chain_ids if chain_id not in result]
+    if missing:
+        log('id_map_miss', logging.DEBUG, count=len(missing))
+        query_template = ', '.join(['%s'] * len(missing))
+        db.c.execute(f'SELECT gesamtId, intId FROM proteinChain WHERE gesamtId IN ({query_template})',
+                     tuple(missing))
+        result.update(db.c.fetchall())
+
+    return result
+
+
 def get_results_messif(query: str, radius: float, num_results: int, phase: str, job_id: str) \
         -> Tuple[List[str], Dict[str, int]]:
+    check_cancelled()
+    if get_engine(phase) == 'local':
+        with span(job_id, f'search_{phase}', engine='local'):
+            return get_results_local(query, num_results, phase)
+
     parameters = {'queryid': query, 'k': num_results, 'job_id': job_id}
 
     if phase in ('sketches_large', 'full'):
         parameters['radius'] = radius
 
-    url = f'http://localhost:{config["ports"][phase]}/search' # todo get rid of this hard coding
+    url = get_messif_url(phase, 'search')
     try:
-        req = requests.get(url, params=parameters)
-        print(f"Final URL: {req.url}")
+        with MESSIF_LATENCY.time(phase), span(job_id, f'search_{phase}', engine='messif'):
+            req = requests.get(url, params=parameters)
+        log('messif_request', logging.DEBUG, url=req.url)
     except requests.exceptions.RequestException as e:
-        print(f'ERROR: MESSIF not responding when calling {url}')
-        print(f'Original exception: {e}')
+        MESSIF_ERRORS.inc(label_value=phase)
+        log('messif_not_responding', logging.ERROR, url=url, error=str(e))
         raise RuntimeError('MESSIF not responding')
 
     try:
         response = json.loads(req.content.decode('utf-8'))
     except json.decoder.JSONDecodeError as e:
-        print(f'ERROR: MESSIF not responding when calling {req.url}')
-        print(f'Original exception: {e}')
-        print(f'Original response: {req.content.decode("utf-8")}')
+        MESSIF_ERRORS.inc(label_value=phase)
+        log('messif_incorrect_response', logging.ERROR, url=req.url, error=str(e),
+            response=req.content.decode('utf-8'))
         raise RuntimeError('MESSIF returned an incorrect response')
 
     if response['status']['code'] not in (200, 201):
-        print(f'ERROR: MESSIF signalized error when calling {req.url}')
-        print(f'Response returned: {response}')
+        MESSIF_ERRORS.inc(label_value=phase)
+        log('messif_error', logging.ERROR, url=req.url, response=response)
         raise RuntimeError('MESSIF signalized error')
 
     messif_ids = [int(record['_id']) for record in response['answer_records']]
@@ -142,30 +522,151 @@ def get_results_messif(query: str, radius: float, num_results: int, phase: str,
                 'searchTime': response['statistics']['OperationTime'] - response['query_record']['pivotDistTimes'],
             })
     except KeyError as e:
-        print(f'ERROR: MESSIF returned an incorrect response when calling {req.url}')
-        print(f'Key not found: {e}')
-        print(f'Original response: {response}')
+        MESSIF_ERRORS.inc(label_value=phase)
+        log('messif_unexpected_response', logging.ERROR, url=req.url, missing_key=str(e), response=response)
         raise RuntimeError('MESSIF returned an unexpected response')
 
     if not messif_ids:
         return [], statistics
 
-    with DBConnection() as db:
-        query_template = ', '.join(['%s'] * len(messif_ids))
-        db.c.execute(f'SELECT gesamtId FROM proteinChain WHERE intId IN ({query_template})', tuple(messif_ids))
-        chain_ids = [candidate[0] for candidate in db.c.fetchall()]
+    with span(job_id, f'id_translation_{phase}', count=len(messif_ids)):
+        chain_ids = get_chain_ids(messif_ids)
+
+    return chain_ids, statistics
+
+
+NEIGHBOUR_LISTS_STORE = NeighbourListStore(get_neighbours_dir(config))
+# Statistics of the MESSIF phases replaced by a neighbour list
+NO_SEARCH_STATISTICS = {'pivotDistCountTotal': 0, 'pivotDistCountCached': 0, 'pivotTime': 0,
+                        'searchDistCountTotal': 0, 'searchDistCountCached': 0, 'searchTime': 0}
+
+
+def find_neighbours(query: str, radius: float, num_results: int, job_id: str) \
+        -> Optional[Tuple[List[str], Dict[str, Dict[str, int]]]]:
+    """Results of run_search_phases() taken from the neighbour lists, None if they do not answer the search."""
+    lists = NEIGHBOUR_LISTS_STORE.get()
+    if lists is None or query.startswith('_'):
+        return None
+
+    with span(job_id, 'neighbour_list'), DBConnection() as db:
+        int_id = get_int_ids([query], db).get(query)
+        int_ids = lists.lookup(int_id, 1 - radius, num_results) if int_id is not None else None
+    if int_ids is None:
+        NEIGHBOUR_LISTS.inc(label_value='miss')
+        return None
 
+    NEIGHBOUR_LISTS.inc(label_value='hit')
+    log('neighbour_list_hit', logging.DEBUG, job_id=job_id, count=len(int_ids))
+    return get_chain_ids(int_ids), {phase: dict(NO_SEARCH_STATISTICS)
+                                    for phase in ('sketches_small', 'sketches_large', 'full')}
+
+
+def run_search_phases(query: str, radius: float, num_results: int, job_id: str, use_neighbour_lists: bool = True) \
+        -> Tuple[List[str], Dict[str, Dict[str, int]]]:
+    neighbours = find_neighbours(query, radius, num_results, job_id) if use_neighbour_lists else None
+    if neighbours is not None:
+        return neighbours
+
+    chain_ids = []
+    statistics = {}
+    for phase in ('sketches_small', 'sketches_large', 'full'):
+        phase_radius = -1 if phase == 'sketches_small' else radius
+        chain_ids, statistics[phase] = get_results_messif(query, phase_radius, num_results, phase, job_id)
     return chain_ids, statistics
 
 
-def get_similarity_results(query: str, other: str, min_qscore: float) -> Tuple[float, float, float, int, List[float]]:
+def compact_res_data(res_data: dict) -> dict:
+    # Hits are stored in savedQueryHits, progress of the phases is useless once the search finished
+    summary = {key: value for key, value in res_data.items()
+               if key not in ('statistics', 'chain_ids') and not key.endswith('_progress')}
+    summary['chain_count'] = len(res_data.get('chain_ids', []))
+    return summary
+
+
+def save_hits(db: DBConnection, job_id: str, statistics: List[dict], transforms: Dict[str, List[float]]) -> None:
+    hits = [hit for hit in statistics if hit['qscore'] != -1 and hit['rmsd'] is not None]
+    if not hits:
+        return
+
+    int_ids = get_int_ids([hit['object'] for hit in hits], db)
+
+    rows = []
+    for position, hit in enumerate(hits):
+        if hit['object'] not in int_ids:
+            continue
+        T = transforms.get(hit['object'])
+        T_str = ';'.join(f'{x:.3f}' for x in T) if T is not None else None
+        rows.append((job_id, position, int_ids[hit['object']], hit['qscore'], hit['rmsd'], hit['seq_id'],
+                     hit['aligned'], T_str))
+    db.c.executemany('INSERT IGNORE INTO savedQueryHits '
+                     '(job_id, position, chainIntId, qscore, rmsd, seqIdentity, alignedResidues, rotationStats) '
+                     'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)', rows)
+
+
+def hit_from_row(row: Tuple) -> dict:
+    gesamt_id, qscore, rmsd, seq_identity, aligned = row
+    return {'object': gesamt_id,
+            'qscore': round(qscore, 3),
+            'rmsd': round(rmsd, 3),
+            'seq_id': round(seq_identity, 3),
+            'aligned': aligned}
+
+
+def load_saved_hits(job_id: str) -> List[dict]:
+    with DBConnection() as db:
+        db.c.execute('SELECT c.gesamtId, h.qscore, h.rmsd, h.seqIdentity, h.alignedResidues '
+                     'FROM savedQueryHits h JOIN proteinChain c ON h.chainIntId = c.intId '
+                     'WHERE h.job_id = %s ORDER BY h.position', (job_id,))
+        return [hit_from_row(row) for row in db.c.fetchall()]
+
+
+def load_saved_transforms(job_id: str) -> Dict[str, List[float]]:
+    with DBConnection() as db:
+        db.c.execute('SELECT c.gesamtId, h.rotationStats '
+                     'FROM savedQueryHits h JOIN proteinChain c ON h.chainIntId = c.intId '
+                     'WHERE h.job_id = %s AND h.rotationStats IS NOT NULL', (job_id,))
+        return {gesamt_id: [float(x) for x in T.split(';')] for gesamt_id, T in db.c.fetchall()}
+
+
+def load_saved_transform(job_id: str, obj: str) -> Optional[List[float]]:
+    with DBConnection() as db:
+        db.c.execute('SELECT h.rotationStats '
+                     'FROM savedQueryHits h JOIN proteinChain c ON h.chainIntId = c.intId '
+                     'WHERE h.job_id = %s AND c.gesamtId = %s AND h.rotationStats IS NOT NULL', (job_id, obj))
+        data = db.c.fetchall()
+    return [float(x) for x in data[0][0].split(';')] if data else None
+
+
+def load_saved_hit(job_id: str, obj: str) -> Optional[dict]:
+    with DBConnection() as db:
+        db.c.execute('SELECT c.gesamtId, h.qscore, h.rmsd, h.seqIdentity, h.alignedResidues '
+                     'FROM savedQueryHits h JOIN proteinChain c ON h.chainIntId = c.intId '
+                     'WHERE h.job_id = %s AND c.gesamtId = %s', (job_id, obj))
+        data = db.c.fetchall()
+    return hit_from_row(data[0]) if data else None
+
+
+def cache_alignment(db: DBConnection, query: str, other: str, elapsed: int,
+                    results: Tuple[float, float, float, int, List[float]]) -> None:
+    qscore, rmsd, seq_identity, aligned, T = results
+    insert_query = ('INSERT IGNORE INTO queriesNearestNeighboursStats '
+                    '(evaluationTime, queryGesamtId, nnGesamtId,'
+                    ' qscore, rmsd, alignedResidues, seqIdentity, rotationStats) '
+                    'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)')
+    T_str = ';'.join(f'{x:.3f}' for x in T)
+    db.c.execute(insert_query, (elapsed, query, other, qscore, rmsd, aligned, seq_identity, T_str))
+    db.conn.commit()
+
+
+def get_similarity_results(query: str, other: str, min_qscore: float, job_id: Optional[str] = None) \
+        -> Tuple[float, float, float, int, List[float]]:
     with DBConnection() as db:
         if query == other:
             db.c.execute('SELECT chainLength FROM proteinChain WHERE gesamtId = %s', (query,))
             query_result = db.c.fetchall()
             aligned = -1
             if not query_result:
-                print(f'ERROR: Query {query} not found in DB')
+                log('query_not_found', logging.ERROR, query=query)
             else:
                 aligned = query_result[0][0]
             T = np.eye(4).flatten().tolist()
@@ -173,74 +674,142 @@ def get_similarity_results(query: str, other: str, min_qscore: float) -> Tuple[f
 
         select_query = ('SELECT qscore, rmsd, seqIdentity, alignedResidues, rotationStats '
                         'FROM queriesNearestNeighboursStats WHERE queryGesamtId = %s AND nnGesamtId = %s')
-        db.c.execute(select_query, (query, other))
-        query_result = db.c.fetchall()
+        with span(job_id, 'cache_lookup', other=other):
+            db.c.execute(select_query, (query, other))
+            query_result = db.c.fetchall()
         if not query_result:
+            ALIGNMENT_CACHE.inc(label_value='miss')
             begin = time.time()
-            print(f"trying to get result for query: {query}, other {other} archive_dir {config['dirs']['archive']} q {min_qscore}")
-            _, qscore, rmsd, seq_identity, aligned, T = python_distance.get_results(query, other, config['dirs']['archive'],
-                                                                                    min_qscore)
+            log('alignment', logging.DEBUG, sample=0.01, query=query, other=other, min_qscore=min_qscore)
+            with span(job_id, 'gesamt', other=other):
+                archive = CHAIN_STORE.archive_for((query, other))
+                _, qscore, rmsd, seq_identity, aligned, T = python_distance.get_results(query, other, archive,
+                                                                                        min_qscore)
             end = time.time()
+            ALIGNMENT_TIME.observe(end - begin)
             elapsed = int((end - begin) * 1000)
             results = (qscore, rmsd, seq_identity, aligned, T)
             if elapsed > 30:
-                insert_query = ('INSERT IGNORE INTO queriesNearestNeighboursStats '
-                                '(evaluationTime, queryGesamtId, nnGesamtId,'
-                                ' qscore, rmsd, alignedResidues, seqIdentity, rotationStats) '
-                                'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)')
-                T_str = ';'.join(f'{x:.3f}' for x in T)
-                db.c.execute(insert_query, (elapsed, query, other, qscore, rmsd, aligned, seq_identity, T_str))
-                db.conn.commit()
+                with span(job_id, 'cache_insert', other=other):
+                    cache_alignment(db, query, other, elapsed, results)
         else:
+            ALIGNMENT_CACHE.inc(label_value='hit')
             qscore, rmsd, seq_identity, aligned, T = query_result[0]
             T = [float(x) for x in T.split(';')]
             results = float(qscore), float(rmsd), float(seq_identity), int(aligned), T
     return results
 
 
+class JobCancelled(Exception):
+    pass
+
+
+# Worker processes are forked, so they share the modules (python_distance, numpy, ...) and the metrics in shared
+# memory with the server instead of importing the app again, as with forkserver (the default since Python 3.14)
+WORKER_CONTEXT = multiprocessing.get_context('fork')
+
+# Set in the worker processes of a search job, see init_job_worker
+_cancel_event = None
+
+
+def init_job_worker(cancel_event, worker_pids) -> None:
+    global _cancel_event
+    os.nice(19)
+    _cancel_event = cancel_event
+    # Workers still busy when the job is cancelled are killed, see monitor.stop_workers
+    worker_pids.put(os.getpid())
+
+
+def check_cancelled() -> None:
+    if _cancel_event is not None and _cancel_event.is_set():
+        raise JobCancelled()
+
+
+def run_cancellable(args: List) -> None:
+    # Own session, so the whole process group is killed when the job is cancelled
+    process = subprocess.Popen(args, start_new_session=True)
+    while True:
+        try:
+            process.wait(timeout=CANCEL_CHECK_INTERVAL)
+            return
+        except subprocess.TimeoutExpired:
+            if _cancel_event is not None and _cancel_event.is_set():
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                raise JobCancelled()
+
+
 def get_stats(query: str, query_name: str, other: str, min_qscore: float, job_id: str, disable_visualizations: bool) \
-        -> Tuple[float, float, float, int]:
-    qscore, rmsd, seq_identity, aligned, T = get_similarity_results(query, other, min_qscore)
-    directory = Path(config['dirs']['computations'], f'query{job_id}')
-    if qscore > min_qscore:
+        -> Tuple[float, float, float, int, List[float]]:
+    from .superpose import superpose_available, write_aligned_pdb  # superpose imports this module
+
+    check_cancelled()
+    with span(job_id, 'get_stats', other=other):
+        qscore, rmsd, seq_identity, aligned, T = get_similarity_results(query, other, min_qscore, job_id)
+        directory = Path(config['dirs']['computations'], f'query{job_id}')
+        if qscore > min_qscore:
+            try:
+                query_pdb = Path(directory, 'query.pdb')
+                if query == other:
+                    other_pdb = Path(directory, 'query.pdb')
+                else:
+                    with PREPARE_PDB_TIME.time(), span(job_id, 'prepare_PDB', other=other):
+                        if superpose_available():
+                            write_aligned_pdb(other, T, directory)
+                        else:
+                            python_distance.prepare_PDB(other, config['dirs']['raw_pdbs'], str(directory), T)
+                    other_pdb = Path(directory, f'{other}.aligned.pdb')
+                if not disable_visualizations:
+                    output_png = Path(directory, f'{other}.aligned.png')
+                    args = ['pymol', '-qrc', Path(Path(__file__).parent, 'draw.pml'), '--', query_pdb,
+                            other_pdb, output_png]
+                    with PYMOL_RENDER_TIME.time(), span(job_id, 'pymol', other=other):
+                        run_cancellable(args)
+
+                    args = ['convert', '-fill', 'rgb(33, 155, 119)', '-font', 'Carlito-Bold', '-pointsize', '24',
+                            '-draw', f'text 20, 40 "{query_name} (query)"', '-fill', 'rgb(192, 85, 25)', '-draw',
+                            f'text 20, 70 "{other}"', output_png, output_png]
+                    with span(job_id, 'convert', other=other):
+                        run_cancellable(args)
+            except JobCancelled:
+                raise
+            except Exception as e:
+                log('alignment_image_failed', logging.WARNING, query=query, other=other, error=str(e))
+    return qscore, rmsd, seq_identity, aligned, T
+
+
+def get_stats_batch(query: str, query_name: str, others: List[str], min_qscore: float, job_id: str,
+                    disable_visualizations: bool) -> List[Tuple[Optional[tuple], Optional[Exception]]]:
+    """get_stats() of several (short) chains in one task, a failure of one chain does not affect the others."""
+    results = []
+    for other in others:
         try:
-            query_pdb = Path(directory, 'query.pdb')
-            if query == other:
-                other_pdb = Path(directory, 'query.pdb')
-            else:
-                python_distance.prepare_PDB(other, config['dirs']['raw_pdbs'], str(directory), T)
-                other_pdb = Path(directory, f'{other}.aligned.pdb')
-            if not disable_visualizations:
-                output_png = Path(directory, f'{other}.aligned.png')
-                args = ['pymol', '-qrc', Path(Path(__file__).parent, 'draw.pml'), '--', query_pdb,
-                        other_pdb, output_png]
-                subprocess.run(args)
-
-                args = ['convert', '-fill', 'rgb(33, 155, 119)', '-font', 'Carlito-Bold', '-pointsize', '24',
-                        '-draw', f'text 20, 40 "{query_name} (query)"', '-fill', 'rgb(192, 85, 25)', '-draw',
-                        f'text 20, 70 "{other}"', output_png, output_png]
-                subprocess.run(args)
+            results.append((get_stats(query, query_name, other, min_qscore, job_id, disable_visualizations), None))
+        except JobCancelled:
+            raise
         except Exception as e:
-            print('Cannot generate alignment and image', e)
-    return qscore, rmsd, seq_identity, aligned
+            results.append((None, e))
+    return results
 
 
 def get_progress(job_id: str, phase: str) -> dict:
-    url = f'http://localhost:{config["ports"][phase]}/get_progress'
+    if get_engine(phase) == 'local':
+        return {'running': False}
+
+    url = get_messif_url(phase, 'get_progress')
 
     try:
-        req = requests.get(url, params={'job_id': job_id})
+        with span(job_id, 'progress_poll', phase=phase):
+            req = requests.get(url, params={'job_id': job_id})
     except requests.exceptions.RequestException as e:
-        print(f'ERROR: MESSIF not responding when calling {url} with job_id={job_id}')
-        print(f'Original exception: {e}')
+        log('messif_not_responding', logging.ERROR, url=url, job_id=job_id, error=str(e))
         raise RuntimeError('MESSIF not responding')
 
     try:
         response = json.loads(req.content.decode('utf-8'))
     except json.decoder.JSONDecodeError as e:
-        print(f'ERROR: MESSIF not responding when calling {req.url}')
-        print(f'Original exception: {e}')
-        print(f'Original response: {req.content.decode("utf-8")}')
+        log('messif_incorrect_response', logging.ERROR, url=req.url, error=str(e),
+            response=req.content.decode('utf-8'))
         raise RuntimeError('MESSIF returned an incorrect response')
 
     progress = {'running': False}
@@ -261,26 +830,52 @@ def get_progress(job_id: str, phase: str) -> dict:
                         'searchDistCountCached'])
                 })
     except KeyError as e:
-        print(f'ERROR: MESSIF returned an incorrect response when calling {req.url}')
-        print(f'Key not found: {e}')
-        print(f'Original response: {response}')
+        log('messif_unexpected_response', logging.ERROR, url=req.url, missing_key=str(e), response=response)
         raise RuntimeError('MESSIF returned an unexpected response')
 
     return progress
 
 
 def end_messif_job(job_id: str, phase: str) -> None:
-    url = f'http://similar-pdb.cerit-sc.cz:{config["ports"][phase]}/end_job'
+    if get_engine(phase) == 'local':
+        return
+
+    url = get_messif_url(phase, 'end_job')
 
     try:
-        req = requests.get(url, params={'job_id': job_id})
-        print('Ending search on ', req.url)
+        req = requests.get(url, params={'job_id': job_id}, timeout=MESSIF_END_JOB_TIMEOUT)
+        log('messif_job_ended', url=req.url)
     except requests.exceptions.RequestException as e:
-        print(f'ERROR: MESSIF not responding when calling {url}')
-        print(f'Original exception: {e}')
+        log('messif_not_responding', logging.ERROR, url=url, error=str(e))
         raise RuntimeError('MESSIF not responding')
 
 
-def prepare_PDB_wrapper(query: str, pdb_dir: str, output_dir: str) -> None:
-    print(f"prepare PDB wrapper {query} {pdb_dir} {output_dir}")
-    python_distance.prepare_PDB(query, pdb_dir, output_dir, None)
+def prepare_PDB_wrapper(query: str, pdb_dir: str, output_dir: str, job_id: Optional[str] = None) -> None:
+    check_cancelled()
+    entry = Path(output_dir, QUERY_CACHE_LINK)
+    if not entry.is_dir():
+        log('prepare_query_pdb', logging.DEBUG, query=query, output_dir=output_dir)
+        with PREPARE_PDB_TIME.time(), span(job_id, 'query_prep'):
+            python_distance.prepare_PDB(query, pdb_dir, output_dir, None)
+        return
+
+    cached = Path(entry, f'query:{query.split(":")[1]}.pdb')
+    if cached.exists():
+        QUERY_CACHE.inc(label_value='hit')
+    else:
+        QUERY_CACHE.inc(label_value='miss')
+        log('prepare_query_pdb', logging.DEBUG, query=query, output_dir=output_dir)
+        tmpdir = tempfile.mkdtemp(prefix='tmp', dir=entry)
+        try:
+            # prepare_PDB reads the raw query next to its output, every job directory has it (entries made before
+            # convert_upload saved it to the cache do not)
+            link_or_copy(Path(output_dir, 'query'), Path(tmpdir, 'query'))
+            with PREPARE_PDB_TIME.time(), span(job_id, 'query_prep'):
+                python_distance.prepare_PDB(query, pdb_dir, tmpdir, None)
+            os.replace(Path(tmpdir, 'query.pdb'), cached)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    # Replaced, not overwritten, the previous query.pdb (another chain of the upload) may be shared with other jobs
+    link_or_copy(cached, Path(output_dir, 'query.pdb.tmp'))
+    os.replace(Path(output_dir, 'query.pdb.tmp'), Path(output_dir, 'query.pdb'))
@@ -1,4 +1,8 @@
 import configparser
+import os
+
+# Relative to the working directory of the server unless set
+CONFIG_FILE = os.environ.get('PROTEIN_SEARCH_CONFIG', '../protein_search.ini')
 
 config = configparser.ConfigParser()
-config.read('../protein_search.ini')
+config.read(CONFIG_FILE)
@@ -0,0 +1,150 @@
+import csv
+import importlib.util
+import io
+import json
+import zipfile
+from pathlib import Path
+from typing import Dict, Generator, List, Optional
+
+from .superpose import aligned_pdb, superpose_available
+
+
+EXPORT_COLUMNS = ['object', 'qscore', 'rmsd', 'seq_id', 'aligned']
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'tsv': 'text/tab-separated-values',
+    'jsonl': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'zip': 'application/zip',
+}
+ARROW_FORMATS = ('parquet', 'arrow')
+ROWS_PER_CHUNK = 200
+
+
+class StreamBuffer(io.RawIOBase):
+    """Write-only file collecting the output of zipfile/pyarrow writers until it is yielded to the response."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def finished_hits(statistics: List[dict]) -> List[dict]:
+    # Rows still being aligned have no values yet
+    return [hit for hit in statistics if hit['qscore'] != -1 and hit['rmsd'] is not None]
+
+
+def format_transform(T: Optional[List[float]]) -> str:
+    return ';'.join(f'{x:.3f}' for x in T) if T is not None else ''
+
+
+def export_delimited(hits: List[dict], transforms: Dict[str, List[float]], delimiter: str) \
+        -> Generator[str, None, None]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter, lineterminator='\n')
+    writer.writerow(EXPORT_COLUMNS + ['T'])
+    for i, hit in enumerate(hits, start=1):
+        writer.writerow([hit[column] for column in EXPORT_COLUMNS] + [format_transform(transforms.get(hit['object']))])
+        if i % ROWS_PER_CHUNK == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_jsonl(hits: List[dict], transforms: Dict[str, List[float]]) -> Generator[str, None, None]:
+    for hit in hits:
+        yield json.dumps({**hit, 'T': transforms.get(hit['object'])}) + '\n'
+
+
+def arrow_available() -> bool:
+    # pyarrow is optional and slow to import, it is loaded by the first Parquet/Arrow export
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def export_arrow(hits: List[dict], transforms: Dict[str, List[float]], fmt: str) -> Generator[bytes, None, None]:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    table = pyarrow.table({
+        'object': pyarrow.array([hit['object'] for hit in hits], type=pyarrow.string()),
+        'qscore': pyarrow.array([hit['qscore'] for hit in hits], type=pyarrow.float32()),
+        'rmsd': pyarrow.array([hit['rmsd'] for hit in hits], type=pyarrow.float32()),
+        'seq_id': pyarrow.array([hit['seq_id'] for hit in hits], type=pyarrow.float32()),
+        'aligned': pyarrow.array([hit['aligned'] for hit in hits], type=pyarrow.int32()),
+        'T': pyarrow.array([transforms.get(hit['object']) for hit in hits], type=pyarrow.list_(pyarrow.float32())),
+    })
+
+    sink = StreamBuffer()
+    if fmt == 'parquet':
+        # Parquet footer refers back to the row groups, so the file is produced at once
+        pyarrow.parquet.write_table(table, sink)
+        yield sink.pop()
+        return
+
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        for batch in table.to_batches(max_chunksize=ROWS_PER_CHUNK):
+            writer.write_batch(batch)
+            yield sink.pop()
+    yield sink.pop()
+
+
+def export_zip(hits: List[dict], transforms: Dict[str, List[float]], directory: Path, structures: bool) \
+        -> Generator[bytes, None, None]:
+    sink = StreamBuffer()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open('results.csv', 'w') as f:
+            for chunk in export_delimited(hits, transforms, ','):
+                f.write(chunk.encode('utf-8'))
+        yield sink.pop()
+
+        if structures:
+            if Path(directory, 'query.pdb').exists():
+                archive.write(Path(directory, 'query.pdb'), 'structures/query.pdb')
+                yield sink.pop()
+            can_superpose = superpose_available()
+            for hit in hits:
+                path = Path(directory, f'{hit["object"]}.aligned.pdb')
+                T = transforms.get(hit['object'])
+                if path.exists():
+                    archive.write(path, f'structures/{hit["object"]}.pdb')
+                elif can_superpose and T is not None:
+                    # Not written by the search (or purged since)
+                    try:
+                        archive.writestr(f'structures/{hit["object"]}.pdb', aligned_pdb(hit['object'], T))
+                    except (OSError, ValueError):
+                        continue
+                else:
+                    continue
+                yield sink.pop()
+    yield sink.pop()
+
+
+def export_results(statistics: List[dict], transforms: Dict[str, List[float]], fmt: str, directory: Path,
+                   structures: bool) -> Generator:
+    hits = finished_hits(statistics)
+    if fmt == 'csv':
+        return export_delimited(hits, transforms, ',')
+    elif fmt == 'tsv':
+        return export_delimited(hits, transforms, '\t')
+    elif fmt == 'jsonl':
+        return export_jsonl(hits, transforms)
+    elif fmt in ARROW_FORMATS:
+        return export_arrow(hits, transforms, fmt)
+    elif fmt == 'zip':
+        return export_zip(hits, transforms, directory, structures)
+    raise ValueError(f'Unknown export format {fmt}')
@@ -0,0 +1,131 @@
+"""Memory-mapped translation between proteinChain.intId (used by MESSIF) and gesamtId.
+
+A map directory contains:
+  int_ids.npy      -- int64 intIds, sorted
+  offsets.npy      -- int64 offsets of the gesamtIds in names.bin (one more than intIds), in intId order
+  names.bin        -- concatenated ASCII gesamtIds
+  sorted_names.npy -- fixed-width bytes array of the gesamtIds, sorted
+  name_int_ids.npy -- int64 intIds in the order of sorted_names.npy
+
+Maps are written by write_id_map() into a new subdirectory of the root and published by replacing the file
+CURRENT, so readers never see a half-written map. The module depends only on numpy, the scripts in utils
+import it directly.
+"""
+import mmap
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+CURRENT = 'CURRENT'
+KEEP_MAPS = 2
+CHECK_INTERVAL = 1.0
+
+
+def get_id_map_dir(config) -> Path:
+    return Path(config.get('dirs', 'id_map', fallback=str(Path(config['dirs']['computations'], 'id_map'))))
+
+
+class IdMap:
+    def __init__(self, directory: Path):
+        self.int_ids = np.load(Path(directory, 'int_ids.npy'), mmap_mode='r')
+        self.offsets = np.load(Path(directory, 'offsets.npy'), mmap_mode='r')
+        self.sorted_names = np.load(Path(directory, 'sorted_names.npy'), mmap_mode='r')
+        self.name_int_ids = np.load(Path(directory, 'name_int_ids.npy'), mmap_mode='r')
+        with open(Path(directory, 'names.bin'), 'rb') as f:
+            self.names = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+
+    def __len__(self) -> int:
+        return len(self.int_ids)
+
+    def _name(self, idx: int) -> bytes:
+        return self.names[int(self.offsets[idx]):int(self.offsets[idx + 1])]
+
+    def to_names(self, int_ids: Sequence[int]) -> List[Optional[str]]:
+        """gesamtIds in the order of int_ids, None for intIds not in the map."""
+        if not len(self):
+            return [None] * len(int_ids)
+        ids = np.asarray(int_ids, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self.int_ids, ids), len(self) - 1)
+        found = self.int_ids[idx] == ids
+        return [self._name(i).decode('ascii') if ok else None for i, ok in zip(idx.tolist(), found.tolist())]
+
+    def to_int_ids(self, names: Sequence[str]) -> List[Optional[int]]:
+        """intIds in the order of names, None for gesamtIds not in the map."""
+        if not len(self):
+            return [None] * len(names)
+        # Longer names would be truncated to the width of the array and match a different chain
+        keys = np.array([name.encode('ascii') if name.isascii() and len(name) <= self.sorted_names.itemsize else b''
+                         for name in names], dtype=self.sorted_names.dtype)
+        idx = np.minimum(np.searchsorted(self.sorted_names, keys), len(self) - 1)
+        found = (self.sorted_names[idx] == keys) & (keys != b'')
+        return [int_id if ok else None for int_id, ok in zip(self.name_int_ids[idx].tolist(), found.tolist())]
+
+
+def write_id_map(root: Path, rows: Iterable[Tuple[int, str]]) -> Path:
+    rows = sorted(rows)
+    encoded = [name.encode('ascii') for _, name in rows]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(name) for name in encoded])
+
+    directory = new_version_dir(root)
+    np.save(Path(directory, 'int_ids.npy'), np.array([int_id for int_id, _ in rows], dtype=np.int64))
+    np.save(Path(directory, 'offsets.npy'), offsets)
+    by_name = sorted(range(len(encoded)), key=encoded.__getitem__)
+    width = max((len(name) for name in encoded), default=1)
+    np.save(Path(directory, 'sorted_names.npy'), np.array([encoded[i] for i in by_name], dtype=f'S{width}'))
+    np.save(Path(directory, 'name_int_ids.npy'), np.array([rows[i][0] for i in by_name], dtype=np.int64))
+    with open(Path(directory, 'names.bin'), 'wb') as f:
+        f.write(b''.join(encoded))
+    publish(root, directory)
+    return directory
+
+
+def new_version_dir(root: Path) -> Path:
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    return Path(tempfile.mkdtemp(prefix=time.strftime('%Y%m%d%H%M%S_'), dir=root))
+
+
+def publish(root: Path, directory: Path) -> None:
+    """Makes directory (a complete subdirectory of root) the current version and removes the old ones."""
+    os.chmod(directory, 0o755)
+    with open(Path(root, f'{CURRENT}.tmp'), 'w') as f:
+        f.write(directory.name)
+    os.replace(Path(root, f'{CURRENT}.tmp'), Path(root, CURRENT))
+
+    # Readers keep older maps mapped until they notice the new one, unlinked files stay valid for them
+    maps = sorted((d for d in Path(root).iterdir() if d.is_dir() and d != directory), key=lambda d: d.name,
+                  reverse=True)
+    old = maps[KEEP_MAPS - 1:]
+    for d in old:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+class IdMapStore:
+    """Current map of the root directory, reloaded when a newer one is published."""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.map: Optional[IdMap] = None
+        self.version: Optional[str] = None
+        self.checked = 0.0
+
+    def get(self) -> Optional[IdMap]:
+        now = time.monotonic()
+        if now - self.checked < CHECK_INTERVAL:
+            return self.map
+        self.checked = now
+
+        try:
+            version = Path(self.root, CURRENT).read_text().strip()
+            if version != self.version:
+                self.map = IdMap(Path(self.root, version))
+                self.version = version
+        except (OSError, ValueError):
+            pass  # map not built yet or replaced while loading, the next check retries
+        return self.map
@@ -0,0 +1,13 @@
+import json
+import logging
+import random
+
+logger = logging.getLogger('protein_search')
+
+
+def log(event: str, level: int = logging.INFO, sample: float = 1.0, **fields) -> None:
+    """Log one event as a JSON object; hot-path events pass sample < 1 to log only that fraction of them."""
+    if sample < 1.0 and random.random() >= sample:
+        return
+    if logger.isEnabledFor(level):
+        logger.log(level, json.dumps({'event': event, **fields}, default=str))
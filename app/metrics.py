@@ -0,0 +1,153 @@
+import multiprocessing
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Sequence, Tuple
+
+# Values live in shared memory allocated at import time, so the worker processes forked by the
+# ProcessPoolExecutors update the same counters as the web process.
+_lock = multiprocessing.Lock()
+_registry: List['Metric'] = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+PHASES = ('sketches_small', 'sketches_large', 'full')
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, label: Optional[Tuple[str, Sequence[str]]], width: int):
+        self.name = name
+        self.documentation = documentation
+        self.label_name, self.label_values = label if label is not None else (None, (None,))
+        self.width = width
+        self.values = multiprocessing.RawArray('d', width * len(self.label_values))
+        _registry.append(self)
+
+    def _offset(self, label_value: Optional[str]) -> int:
+        return self.label_values.index(label_value) * self.width
+
+    def _labels(self, label_value: Optional[str], extra: str = '') -> str:
+        labels = [f'{self.label_name}="{label_value}"'] if self.label_name is not None else []
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for label_value in self.label_values:
+            offset = self._offset(label_value)
+            lines.extend(self._render_value(label_value, offset))
+        return lines
+
+    def _render_value(self, label_value: Optional[str], offset: int) -> List[str]:
+        return [f'{self.name}{self._labels(label_value)} {self.values[offset]}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, label: Optional[Tuple[str, Sequence[str]]] = None):
+        super().__init__(name, documentation, label, 1)
+
+    def inc(self, amount: float = 1, label_value: Optional[str] = None) -> None:
+        with _lock:
+            self.values[self._offset(label_value)] += amount
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1, label_value: Optional[str] = None) -> None:
+        self.inc(-amount, label_value)
+
+    def set(self, value: float, label_value: Optional[str] = None) -> None:
+        with _lock:
+            self.values[self._offset(label_value)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label: Optional[Tuple[str, Sequence[str]]] = None,
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # Per label value: cumulative bucket counts, +Inf count (= total count) and the sum
+        super().__init__(name, documentation, label, len(self.buckets) + 2)
+
+    def observe(self, value: float, label_value: Optional[str] = None) -> None:
+        offset = self._offset(label_value)
+        with _lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.values[offset + i] += 1
+            self.values[offset + len(self.buckets)] += 1
+            self.values[offset + len(self.buckets) + 1] += value
+
+    @contextmanager
+    def time(self, label_value: Optional[str] = None):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - begin, label_value)
+
+    def _render_value(self, label_value: Optional[str], offset: int) -> List[str]:
+        lines = []
+        for i, bound in enumerate(self.buckets):
+            labels = self._labels(label_value, f'le="{bound}"')
+            lines.append(f'{self.name}_bucket{labels} {self.values[offset + i]}')
+        count = self.values[offset + len(self.buckets)]
+        labels = self._labels(label_value, 'le="+Inf"')
+        lines.append(f'{self.name}_bucket{labels} {count}')
+        lines.append(f'{self.name}_count{self._labels(label_value)} {count}')
+        lines.append(f'{self.name}_sum{self._labels(label_value)} {self.values[offset + len(self.buckets) + 1]}')
+        return lines
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+MESSIF_LATENCY = Histogram('protein_search_messif_request_seconds', 'Duration of MESSIF search requests',
+                           label=('phase', PHASES))
+MESSIF_ERRORS = Counter('protein_search_messif_errors_total', 'Failed MESSIF requests', label=('phase', PHASES))
+ALIGNMENT_TIME = Histogram('protein_search_alignment_seconds', 'Duration of gesamt alignments of chain pairs')
+ALIGNMENT_CACHE = Counter('protein_search_alignment_cache_total',
+                          'Lookups of queriesNearestNeighboursStats for chain pairs', label=('result', ('hit', 'miss')))
+ALIGNMENTS_PRUNED = Counter('protein_search_alignments_pruned_total',
+                            'Candidates not aligned because they cannot be in the results',
+                            label=('reason', ('dropped',)))
+NEIGHBOUR_LISTS = Counter('protein_search_neighbour_lists_total',
+                          'Searches of indexed chains answered by (hit) or passed on from (miss) the neighbour lists',
+                          label=('result', ('hit', 'miss')))
+CHAIN_STORE_LOOKUPS = Counter('protein_search_chain_store_total', 'Lookups of chains in the shared-memory chain store',
+                              label=('result', ('hit', 'miss')))
+CHAIN_STORE_BYTES = Gauge('protein_search_chain_store_bytes', 'Size of the chains resident in the chain store')
+CHAIN_STORE_CHAINS = Gauge('protein_search_chain_store_chains', 'Chains resident in the chain store')
+CHAIN_STORE_EVICTED = Counter('protein_search_chain_store_evicted_total', 'Chains removed from the chain store')
+PYMOL_RENDER_TIME = Histogram('protein_search_pymol_render_seconds', 'Duration of rendering alignment images')
+QUERY_CACHE = Counter('protein_search_query_cache_total', 'Lookups of prepared query structures in the query cache',
+                      label=('result', ('hit', 'miss')))
+COORDINATE_CACHE = Counter('protein_search_coordinate_cache_total',
+                           'Lookups of parsed atoms of PDB entries in the query cache', label=('result', ('hit', 'miss')))
+PREPARE_PDB_TIME = Histogram('protein_search_prepare_pdb_seconds', 'Duration of writing (aligned) PDB files')
+DB_QUERY_TIME = Histogram('protein_search_db_query_seconds', 'Duration of DB queries',
+                          buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+WORKER_QUEUE_DEPTH = Gauge('protein_search_worker_queue_depth', 'Tasks submitted to worker pools and not finished')
+ACTIVE_STREAMS = Gauge('protein_search_active_streams', 'Open result streams (SSE and NDJSON)')
+ADMISSION_QUEUE_LENGTH = Gauge('protein_search_admission_queue_length', 'Searches waiting for admission')
+ADMISSION_RUNNING_COST = Gauge('protein_search_admission_running_cost',
+                               'Estimated cost of the admitted searches (in alignments of average chains)')
+ADMISSION_REJECTED = Counter('protein_search_admission_rejected_total', 'Searches rejected by the admission limits',
+                             label=('reason', ('concurrency', 'rate', 'cost')))
+STORAGE_USED_BYTES = Gauge('protein_search_storage_used_bytes', 'Disk usage of job directories and the upload cache')
+STORAGE_QUOTA_BYTES = Gauge('protein_search_storage_quota_bytes', 'Quota of the disk usage')
+STORAGE_ENTRIES = Gauge('protein_search_storage_entries', 'Job directories and upload cache entries on disk',
+                        label=('kind', ('job', 'upload_cache')))
+STORAGE_EVICTED = Counter('protein_search_storage_evicted_total', 'Removed job directories and upload cache entries',
+                          label=('reason', ('expired', 'quota')))
+STORAGE_PURGED_BYTES = Counter('protein_search_storage_purged_bytes_total',
+                               'Artifacts of dropped candidates removed when their job ended')
@@ -0,0 +1,664 @@
+import abc
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Generator, List, Optional, Set, Tuple
+
+from .web import application
+from .admission import ADMISSION
+from .computation import (end_messif_job, find_neighbours, get_chain_lengths, get_progress, get_results_messif,
+                          get_stats, get_stats_batch, init_job_worker, prepare_PDB_wrapper, WORKER_CONTEXT)
+from .config import config
+from .logs import log
+from .metrics import ALIGNMENTS_PRUNED, WORKER_QUEUE_DEPTH
+from .storage import STORAGE, purge_artifacts
+from .tracing import record_span
+
+PHASES = ('sketches_small', 'sketches_large', 'full')
+TERMINAL_STATUSES = ('FINISHED', 'ERROR', 'ABORTED')
+
+# Alignment results are collected (and published) at most this often
+UPDATE_INTERVAL = 1.0
+# Bounds of the adaptive MESSIF progress polling
+MIN_POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 5.0
+# Streams without a new state for this long get a keep-alive comment (which also detects closed connections)
+KEEPALIVE_INTERVAL = 5.0
+# Queued jobs check for cancellation (and report their position) at least this often
+QUEUE_CHECK_INTERVAL = 1.0
+
+# Alignments of chains shorter than this take less than the overhead of a task, they are submitted in batches
+TINY_CHAIN_LENGTH = 100
+TINY_BATCH_SIZE = 16
+
+# Lifecycle of a search job, stored as 'state' in its job data:
+# CREATED -> QUEUED -> RUNNING -> FINISHED | FAILED | CANCELLED (/end_job) | EXPIRED (deadline) | ABANDONED (no open
+# stream), queued jobs may also be cancelled or abandoned. The deadline starts when the job is admitted.
+JOB_DEADLINE = 30 * 60
+ABANDON_TIMEOUT = 60
+# Worker processes still running this long after a cancellation are killed
+CANCEL_GRACE = 2.0
+# Ended jobs are forgotten after this time, saved queries are then loaded from the DB
+JOB_RETENTION = 24 * 3600
+REAP_INTERVAL = 10 * 60
+
+
+def submit_task(executor: concurrent.futures.Executor, fn, *args) -> concurrent.futures.Future:
+    WORKER_QUEUE_DEPTH.inc()
+    future = executor.submit(fn, *args)
+    future.add_done_callback(lambda _: WORKER_QUEUE_DEPTH.dec())
+    return future
+
+
+def completed_future(result) -> concurrent.futures.Future:
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+def submit_alignments(executor: concurrent.futures.Executor, chain_ids: List[str], query: str, query_name: str,
+                      min_qscore: float, job_id: str, disable_visualizations: bool) \
+        -> Dict[str, concurrent.futures.Future]:
+    """Submits get_stats() of the chains, longest first, so that no long alignment is left to run alone at the end.
+
+    Chains of the same length keep the MESSIF ranking. Tiny chains are aligned in batches, each chain still gets its
+    own future.
+    """
+    lengths = get_chain_lengths(chain_ids)
+    ordered = sorted(chain_ids, key=lambda chain_id: lengths.get(chain_id, TINY_CHAIN_LENGTH), reverse=True)
+
+    futures = {}
+    tiny = [chain_id for chain_id in ordered if lengths.get(chain_id, TINY_CHAIN_LENGTH) < TINY_CHAIN_LENGTH]
+    for chain_id in ordered[:len(ordered) - len(tiny)]:
+        futures[chain_id] = submit_task(executor, get_stats, query, query_name, chain_id, min_qscore, job_id,
+                                        disable_visualizations)
+
+    for start in range(0, len(tiny), TINY_BATCH_SIZE):
+        batch = tiny[start:start + TINY_BATCH_SIZE]
+        chain_futures = [concurrent.futures.Future() for _ in batch]
+        futures.update(zip(batch, chain_futures))
+        batch_future = submit_task(executor, get_stats_batch, query, query_name, batch, min_qscore, job_id,
+                                   disable_visualizations)
+        batch_future.add_done_callback(lambda future, chain_futures=chain_futures: resolve_batch(future, chain_futures))
+        for future in chain_futures:
+            future.add_done_callback(lambda _, batch_future=batch_future, chain_futures=chain_futures:
+                                     cancel_unused_batch(batch_future, chain_futures))
+
+    return futures
+
+
+def resolve_batch(batch_future: concurrent.futures.Future, chain_futures: List[concurrent.futures.Future]) -> None:
+    if batch_future.cancelled():
+        for future in chain_futures:
+            future.cancel()
+        return
+
+    if batch_future.exception() is not None:
+        results = [(None, batch_future.exception())] * len(chain_futures)
+    else:
+        results = batch_future.result()
+    for future, (result, exception) in zip(chain_futures, results):
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            pass  # cancelled, the chain was dropped by a later phase
+
+
+def cancel_unused_batch(batch_future: concurrent.futures.Future,
+                        chain_futures: List[concurrent.futures.Future]) -> None:
+    if all(future.cancelled() for future in chain_futures):
+        batch_future.cancel()
+
+
+def collect_statistics(job_id: str, chain_ids: List[str], result_stats: Dict[str, concurrent.futures.Future],
+                       min_qscore: float, transforms: Dict[str, List[float]], failed: Set[str]) \
+        -> Tuple[List[dict], int]:
+    """Statistics of the aligned chains and the number of completed alignments, failed ones count as completed."""
+    statistics = []
+    completed = 0
+    for chain_id in chain_ids:
+        job = result_stats[chain_id]
+        if job.done():
+            completed += 1
+            try:
+                qscore, rmsd, seq_id, aligned, T = job.result()
+            except Exception as e:
+                # One broken chain must not keep the whole search from finishing, it is logged once
+                if chain_id not in failed:
+                    failed.add(chain_id)
+                    log('alignment_failed', logging.WARNING, job_id=job_id, other=chain_id, error=str(e))
+                continue
+            if qscore < min_qscore:
+                continue
+            transforms[chain_id] = T
+            statistics.append({'object': chain_id,
+                               'qscore': round(qscore, 3),
+                               'rmsd': round(rmsd, 3),
+                               'seq_id': round(seq_id, 3),
+                               'aligned': aligned})
+        else:
+            statistics.append({
+                'object': chain_id,
+                'qscore': -1,
+                'rmsd': None,
+                'seq_id': None,
+                'aligned': None,
+            })
+
+    return sorted(statistics, key=lambda x: x['qscore'], reverse=True), completed
+
+
+def remaining_distances(progress: dict) -> Tuple[int, int]:
+    computed = progress['pivotDistCountComputed'] + progress.get('searchDistCountComputed', 0)
+    expected = progress['pivotDistCountExpected'] - progress['pivotDistCountCached']
+    if 'searchDistCountExpected' in progress:
+        expected += progress['searchDistCountExpected'] - progress['searchDistCountCached']
+    return computed, max(0, expected - computed)
+
+
+def next_poll_interval(progress: dict, previous: Optional[Tuple[float, dict]], now: float) -> float:
+    """Polls the sooner, the closer the phase is to its end, estimated from the rate of distance computations."""
+    if not progress['running'] or previous is None or not previous[1]['running']:
+        return MIN_POLL_INTERVAL * 2
+
+    computed, remaining = remaining_distances(progress)
+    previous_computed, _ = remaining_distances(previous[1])
+    rate = (computed - previous_computed) / max(now - previous[0], 1e-3)
+    if rate <= 0:
+        return MAX_POLL_INTERVAL / 2
+    return min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, remaining / rate / 4))
+
+
+class JobStates(abc.ABC):
+    """Latest state of one job, published to all result streams of the job in this process."""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.condition = threading.Condition()
+        self.res_data: Optional[dict] = None
+        self.version = 0
+        self.subscribers = 0
+        self.unsubscribed_at = time.time()
+        self.thread = threading.Thread(target=self.run, name=f'monitor-{job_id}', daemon=True)
+
+    @abc.abstractmethod
+    def run(self) -> None:
+        """Body of the thread, produces the states of the job."""
+
+    def notify(self, res_data: dict) -> None:
+        with self.condition:
+            self.res_data = res_data
+            self.version += 1
+            self.condition.notify_all()
+
+    def subscribe(self) -> Generator[Optional[dict], None, None]:
+        """Yields the latest state whenever it changes and None after KEEPALIVE_INTERVAL without a change."""
+        version = 0
+        with self.condition:
+            self.subscribers += 1
+        try:
+            while True:
+                with self.condition:
+                    if self.version == version:
+                        self.condition.wait(KEEPALIVE_INTERVAL)
+                    res_data = self.res_data if self.version != version else None
+                    version = self.version
+                yield res_data
+                if res_data is not None and res_data['status'] in TERMINAL_STATUSES:
+                    return
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+                self.unsubscribed_at = time.time()
+
+    def watched(self) -> bool:
+        with self.condition:
+            return self.subscribers > 0 or time.time() - self.unsubscribed_at <= ABANDON_TIMEOUT
+
+
+class JobMonitor(JobStates):
+    """Runs the search of one job and publishes its states to all result streams of the job.
+
+    Progress of the running MESSIF phase is polled by the monitor only, however many browser tabs show the job.
+    States are also stored in the job data, from where followers in other server processes relay them.
+    """
+
+    def publish(self, res_data: dict) -> None:
+        self.notify(res_data)
+        application.computation_results[self.job_id].update(res_data=res_data, version=self.version)
+
+    def stop_reason(self, deadline: Optional[float]) -> Optional[str]:
+        job_data = application.computation_results[self.job_id]
+        if job_data.get('_abort'):
+            return 'CANCELLED'
+        if deadline is not None and time.time() > deadline:
+            return 'EXPIRED'
+        # Streams served by other processes keep refreshing 'watched'
+        if not self.watched() and time.time() - job_data.get('watched', 0) > ABANDON_TIMEOUT:
+            return 'ABANDONED'
+        return None
+
+    def run(self) -> None:
+        STORAGE.pin([self.job_id])
+        try:
+            self.search()
+        except Exception as e:
+            log('monitor_failed', logging.ERROR, job_id=self.job_id, error=str(e))
+            res_data = {'status': 'ERROR', 'error_message': 'Internal error', 'chain_ids': [], 'statistics': [],
+                        **{f'{phase}_status': 'ERROR' for phase in PHASES}}
+            # Streams opened later replay the stored error
+            self.publish(res_data)
+            set_job_state(self.job_id, 'FAILED')
+        finally:
+            ADMISSION.release(self.job_id)
+            STORAGE.unpin([self.job_id])
+            with _monitors_lock:
+                _monitors.pop(self.job_id, None)
+
+    def wait_for_admission(self, cost: float) -> Optional[str]:
+        """Waits in the admission queue and publishes the position of the job. None once admitted, else the reason
+        to stop the job."""
+        ADMISSION.enqueue(self.job_id, cost)
+        position = ADMISSION.wait(self.job_id, 0)
+        if position is None:
+            return None
+        if position == 0:
+            return 'CANCELLED'
+
+        set_job_state(self.job_id, 'QUEUED')
+        log('job_queued', job_id=self.job_id, position=position, cost=round(cost, 1))
+        published = None
+        while position is not None:
+            if position != published:
+                self.publish({'status': 'QUEUED', 'queue_position': position, 'chain_ids': [], 'statistics': [],
+                              **{f'{phase}_status': 'WAITING' for phase in PHASES}})
+                published = position
+            stop_reason = self.stop_reason(None)
+            if stop_reason is not None:
+                return stop_reason
+            position = ADMISSION.wait(self.job_id, QUEUE_CHECK_INTERVAL)
+            if position == 0:
+                return 'CANCELLED'
+        return None
+
+    def search(self) -> None:
+        job_id = self.job_id
+        # Parameters of the job do not change, one round trip to the manager is enough
+        job_data = dict(application.computation_results[job_id])
+        query = job_data['query']
+        query_name = f'{job_data["name"]}:{job_data["chain"]}'
+        min_qscore = 1 - job_data['radius']
+
+        stop_reason = self.wait_for_admission(job_data.get('cost', 0.0))
+        if stop_reason is not None:
+            res_data = {'status': 'ABORTED', 'chain_ids': [], 'statistics': [],
+                        **{f'{phase}_status': 'WAITING' for phase in PHASES}}
+            self.publish(res_data)
+            log('monitor_ended', job_id=job_id, status=res_data['status'], state=stop_reason)
+            set_job_state(job_id, stop_reason)
+            return
+
+        cancel_event = WORKER_CONTEXT.Event()
+        worker_pids = WORKER_CONTEXT.SimpleQueue()
+        executor = concurrent.futures.ProcessPoolExecutor(mp_context=WORKER_CONTEXT, initializer=init_job_worker,
+                                                          initargs=(cancel_event, worker_pids))
+        # Submitted MESSIF phases, those still running are ended however the search stops
+        messif_future = {phase: None for phase in PHASES}
+        state = None
+        try:
+            start_time = time.time()
+            deadline = job_data.get('deadline', start_time + JOB_DEADLINE)
+            set_job_state(job_id, 'RUNNING')
+
+            query_raw_pdb = submit_task(executor, prepare_PDB_wrapper, query, config['dirs']['raw_pdbs'],
+                                        str(Path(config['dirs']['computations'], f'query{job_id}')), job_id)
+
+            neighbours = find_neighbours(query, job_data['radius'], job_data['num_results'], job_id)
+            if neighbours is not None:
+                # All phases resolve at once, the alignments of the neighbours were cached when the lists were built
+                chain_ids, phase_stats = neighbours
+                messif_future = {phase: completed_future((chain_ids, phase_stats[phase])) for phase in PHASES}
+            else:
+                messif_future = {'sketches_small': submit_task(executor, get_results_messif, query, -1,
+                                                               job_data['num_results'], 'sketches_small', job_id),
+                                 'sketches_large': None,
+                                 'full': None}
+
+            result_stats = {}
+            transforms = {}
+            failed = set()
+            progress = {}
+            previous_progress = {}
+            next_poll = {phase: 0.0 for phase in PHASES}
+            published = None
+            log('monitor_started', job_id=job_id, query=query_name)
+            while True:
+                res_data = {'chain_ids': [],
+                            'status': 'COMPUTING',
+                            'sketches_small_status': 'COMPUTING',
+                            'sketches_large_status': 'WAITING',
+                            'full_status': 'WAITING'}
+
+                if messif_future['sketches_small'].done():
+                    try:
+                        res_data['chain_ids'], stats = messif_future['sketches_small'].result()
+                        res_data['sketches_small_statistics'] = stats
+
+                        res_data['sketches_small_status'] = 'DONE'
+                        res_data['sketches_large_status'] = 'COMPUTING'
+
+                        if messif_future['sketches_large'] is None:
+                            messif_future['sketches_large'] = submit_task(executor, get_results_messif, query,
+                                                                          job_data['radius'], job_data['num_results'],
+                                                                          'sketches_large', job_id)
+                    except RuntimeError as e:
+                        res_data['status'] = 'ERROR'
+                        res_data['sketches_small_status'] = 'ERROR'
+                        res_data['error_message'] = str(e)
+
+                if messif_future['sketches_large'] is not None and messif_future['sketches_large'].done():
+                    try:
+                        res_data['chain_ids'], stats = messif_future['sketches_large'].result()
+                        res_data['sketches_large_statistics'] = stats
+
+                        res_data['sketches_large_status'] = 'DONE'
+                        res_data['full_status'] = 'COMPUTING'
+
+                        if messif_future['full'] is None:
+                            messif_future['full'] = submit_task(executor, get_results_messif, query,
+                                                                job_data['radius'], job_data['num_results'], 'full',
+                                                                job_id)
+                    except RuntimeError as e:
+                        res_data['status'] = 'ERROR'
+                        res_data['sketches_large_status'] = 'ERROR'
+                        res_data['error_message'] = str(e)
+
+                if messif_future['full'] is not None and messif_future['full'].done():
+                    try:
+                        res_data['chain_ids'], stats = messif_future['full'].result()
+                        res_data['full_status'] = 'DONE'
+                        res_data['full_statistics'] = stats
+                    except RuntimeError as e:
+                        res_data['status'] = 'ERROR'
+                        res_data['full_status'] = 'ERROR'
+                        res_data['error_message'] = str(e)
+
+                running_phase = None
+                for phase in PHASES:
+                    if res_data[f'{phase}_status'] == 'COMPUTING':
+                        running_phase = phase
+
+                now = time.time()
+                if running_phase is not None and now >= next_poll[running_phase]:
+                    try:
+                        progress[running_phase] = get_progress(job_id, running_phase)
+                        next_poll[running_phase] = now + next_poll_interval(progress[running_phase],
+                                                                            previous_progress.get(running_phase), now)
+                        previous_progress[running_phase] = (now, progress[running_phase])
+                    except RuntimeError as e:
+                        res_data['status'] = 'ERROR'
+                        res_data[f'{running_phase}_status'] = 'ERROR'
+                        res_data['error_message'] = str(e)
+                if running_phase in progress:
+                    res_data[f'{running_phase}_progress'] = progress[running_phase]
+
+                if query_raw_pdb.done():
+                    # Candidates of an earlier phase missing in the later one cannot be in the results, their alignments
+                    # are dropped unless already running (and submitted again if a later phase returns them)
+                    candidates = set(res_data['chain_ids'])
+                    dropped = sum(future.cancel() for chain_id, future in result_stats.items()
+                                  if chain_id not in candidates and not future.done())
+                    if dropped:
+                        ALIGNMENTS_PRUNED.inc(dropped, label_value='dropped')
+                    new_chain_ids = [chain_id for chain_id in res_data['chain_ids']
+                                     if chain_id not in result_stats or result_stats[chain_id].cancelled()]
+                    if new_chain_ids:
+                        result_stats.update(submit_alignments(executor, new_chain_ids, query, query_name, min_qscore,
+                                                              job_id, job_data['disable_visualizations']))
+
+                statistics = []
+                completed = 0
+                if query_raw_pdb.done():
+                    statistics, completed = collect_statistics(job_id, res_data['chain_ids'], result_stats,
+                                                               min_qscore, transforms, failed)
+                res_data['statistics'] = statistics
+                res_data['completed'] = completed
+
+                if res_data['full_status'] == 'DONE':
+                    res_data['search_time'] = 0
+                    for phase in PHASES:
+                        stats = res_data[f'{phase}_statistics']
+                        res_data['search_time'] += stats['pivotTime'] + stats['searchTime']
+
+                if res_data['full_status'] == 'DONE' and completed == len(res_data['chain_ids']):
+                    res_data['total_time'] = int((time.time() - start_time) * 1000)
+                    res_data['status'] = 'FINISHED'
+                    # Superposition matrices are needed only for exports, so they are stored once at the end
+                    application.computation_results[job_id]['transforms'] = transforms
+
+                stop_reason = None
+                if res_data['status'] not in TERMINAL_STATUSES:
+                    stop_reason = self.stop_reason(deadline)
+                    if stop_reason == 'EXPIRED':
+                        res_data['status'] = 'ERROR'
+                        res_data['error_message'] = 'The search took too long and was stopped.'
+                    elif stop_reason is not None:
+                        res_data['status'] = 'ABORTED'
+
+                if res_data != published:
+                    self.publish(res_data)
+                    published = res_data
+
+                if res_data['status'] in TERMINAL_STATUSES:
+                    break
+
+                # Wakes up as soon as a MESSIF phase (or the query preparation) resolves, the progress of a finished
+                # phase is not polled anymore
+                waiting = [future for future in (query_raw_pdb, *messif_future.values())
+                           if future is not None and not future.done()]
+                timeout = now + UPDATE_INTERVAL - time.time()
+                if running_phase is not None:
+                    timeout = min(timeout, next_poll[running_phase] - time.time())
+                if waiting:
+                    concurrent.futures.wait(waiting, timeout=max(0.0, timeout),
+                                            return_when=concurrent.futures.FIRST_COMPLETED)
+                else:
+                    time.sleep(max(0.0, timeout))
+
+            state = stop_reason or ('FINISHED' if res_data['status'] == 'FINISHED' else 'FAILED')
+            log('monitor_ended', job_id=job_id, status=res_data['status'], state=state)
+            record_span(job_id, 'search', start_time, time.time(), None, status=res_data['status'])
+        finally:
+            for phase, future in messif_future.items():
+                if future is not None and not future.done():
+                    try:
+                        end_messif_job(job_id, phase)
+                    except RuntimeError:
+                        pass  # already logged, MESSIF ends the job itself eventually
+            # Workers of a failed search are killed together with their gesamt and PyMOL subprocesses
+            stop_workers(executor, cancel_event, worker_pids, cancel=state != 'FINISHED')
+        set_job_state(job_id, state)
+
+        # Candidates aligned in the earlier phases and dropped later left their structures and images behind, nobody
+        # looks at the images of an abandoned job
+        if state in ('FINISHED', 'ABANDONED'):
+            keep = [row['object'] for row in res_data['statistics']] if state == 'FINISHED' else []
+            purge_artifacts(job_id, keep)
+
+
+class JobFollower(JobStates):
+    """Relays the states of a job searched by another server process (e.g., another gunicorn worker) to the result
+    streams of this process, the job data is polled once for all of them."""
+
+    def run(self) -> None:
+        ended = False
+        try:
+            job_data = application.computation_results[self.job_id]
+            owner = job_data.get('owner')
+            version = None
+            watched_at = 0.0
+            while True:
+                current = job_data.get('version')
+                if current != version:
+                    version = current
+                    res_data = job_data.get('res_data')
+                    if res_data is not None:
+                        self.notify(res_data)
+                        if res_data['status'] in TERMINAL_STATUSES:
+                            ended = True
+                            return
+                elif not owner_alive(owner):
+                    # The process was killed (e.g., restarted by the server) with the search, nobody else publishes
+                    res_data = {'status': 'ERROR', 'error_message': 'The search was interrupted by a server restart.',
+                                'chain_ids': [], 'statistics': [], **{f'{phase}_status': 'ERROR' for phase in PHASES}}
+                    job_data.update(res_data=res_data, version=(version or 0) + 1)
+                    set_job_state(self.job_id, 'FAILED')
+                    log('job_lost', logging.WARNING, job_id=self.job_id, owner=owner)
+                    continue
+
+                now = time.time()
+                with _monitors_lock:
+                    if not self.watched():
+                        _monitors.pop(self.job_id, None)
+                        ended = True
+                        return
+                if now - watched_at > KEEPALIVE_INTERVAL:
+                    job_data['watched'] = watched_at = now
+                time.sleep(UPDATE_INTERVAL)
+        except Exception as e:
+            log('follower_failed', logging.ERROR, job_id=self.job_id, error=str(e))
+        finally:
+            if not ended:
+                self.notify({'status': 'ERROR', 'error_message': 'Internal error', 'chain_ids': [], 'statistics': [],
+                             **{f'{phase}_status': 'ERROR' for phase in PHASES}})
+            with _monitors_lock:
+                if _monitors.get(self.job_id) is self:
+                    del _monitors[self.job_id]
+
+
+def owner_alive(owner: Optional[int]) -> bool:
+    """Whether the process running a search still exists, the server processes run on one host."""
+    if owner is None:
+        return True
+    try:
+        os.kill(owner, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def stop_workers(executor: concurrent.futures.ProcessPoolExecutor, cancel_event, worker_pids,
+                 cancel: bool) -> None:
+    if not cancel:
+        # Alignments of candidates from the earlier phases are finished, their results are cached in the DB
+        if sys.version_info.major == 3 and sys.version_info.minor >= 9:
+            executor.shutdown(cancel_futures=True)
+        else:
+            executor.shutdown()
+        return
+
+    # Running tasks stop at their next check_cancelled() and kill their subprocesses, gesamt cannot be interrupted,
+    # so workers still busy after the grace period are killed. The workers report their PIDs in init_job_worker.
+    pids = set()
+    while not worker_pids.empty():
+        pids.add(worker_pids.get())
+    processes = [process for process in multiprocessing.active_children() if process.pid in pids]
+    cancel_event.set()
+    if sys.version_info.major == 3 and sys.version_info.minor >= 9:
+        executor.shutdown(wait=False, cancel_futures=True)
+    else:
+        executor.shutdown(wait=False)
+
+    end = time.time() + CANCEL_GRACE
+    for process in processes:
+        process.join(max(0.0, end - time.time()))
+        if process.is_alive():
+            log('worker_killed', logging.WARNING, pid=process.pid)
+            process.kill()
+
+
+def set_job_state(job_id: str, state: str) -> None:
+    job_data = application.computation_results.get(job_id)
+    if job_data is None:
+        return
+    job_data['state'] = state
+    if state == 'RUNNING':
+        job_data['started'] = time.time()
+    elif state != 'QUEUED':
+        job_data['ended'] = time.time()
+
+
+_last_reap = 0.0
+
+
+def reap_jobs() -> None:
+    """Forgets jobs which ended (or never started) more than JOB_RETENTION ago."""
+    global _last_reap
+    now = time.time()
+    if now - _last_reap < REAP_INTERVAL:
+        return
+    _last_reap = now
+
+    for job_id in list(application.computation_results.keys()):
+        with _monitors_lock:
+            if job_id in _monitors:
+                continue
+        job_data = application.computation_results.get(job_id)
+        if job_data is None:
+            continue
+        timestamp = job_data.get('ended', job_data.get('created'))
+        if job_data.get('state') != 'RUNNING' and timestamp is not None and now - timestamp > JOB_RETENTION:
+            application.computation_results.pop(job_id, None)
+            log('job_reaped', logging.DEBUG, job_id=job_id)
+
+
+_monitors: Dict[str, JobStates] = {}
+_monitors_lock = threading.Lock()
+
+
+def start_job_monitor(job_id: str) -> JobMonitor:
+    reap_jobs()
+    with _monitors_lock:
+        monitor = _monitors.get(job_id)
+        # The search of a job runs once, whoever asks to start it again gets the running monitor
+        if isinstance(monitor, JobMonitor):
+            return monitor
+        monitor = _monitors[job_id] = JobMonitor(job_id)
+        monitor.thread.start()
+    return monitor
+
+
+def get_job_states(job_id: str) -> JobStates:
+    """States of the job for a result stream, relayed from the job data if the job runs in another process."""
+    reap_jobs()
+    with _monitors_lock:
+        states = _monitors.get(job_id)
+        if states is None:
+            states = _monitors[job_id] = JobFollower(job_id)
+            states.thread.start()
+        else:
+            # Keeps an idle follower alive until the stream subscribes
+            with states.condition:
+                states.unsubscribed_at = time.time()
+    return states
+
+
+def wait_for_monitors(timeout: float) -> None:
+    """Lets the searches running in this process finish, e.g., before a server worker exits on a reload."""
+    end = time.time() + timeout
+    with _monitors_lock:
+        threads = [monitor.thread for monitor in _monitors.values() if isinstance(monitor, JobMonitor)]
+    if threads:
+        log('waiting_for_monitors', jobs=len(threads))
+    for thread in threads:
+        thread.join(max(0.0, end - time.time()))
@@ -0,0 +1,163 @@
+"""Precomputed lists of the nearest neighbours of the indexed chains, built by utils/build_neighbours.py.
+
+A list directory contains:
+  int_ids.npy    -- int64 intIds of the chains with a list, sorted
+  offsets.npy    -- int64 offsets of the lists in neighbours.npy (one more than intIds)
+  neighbours.npy -- int64 intIds of the neighbours, each list ordered by Q-score descending
+  qscores.npy    -- float32 Q-scores of the neighbours
+  truncated.npy  -- bool, whether the list was cut at size (more neighbours may pass min_qscore)
+  meta.json      -- size (longest list) and min_qscore the lists were built with
+
+A list holds the best size neighbours with Q-score at least min_qscore, so it answers any search with a higher
+threshold and at most size results, and also a search asking for more results if the list is complete or already ends
+below the threshold of the search. Lists are versioned like the ID maps (see id_map.py). Archive updates drop the
+changed chains and add their new lists (update_neighbour_lists), without rebuilding the others.
+"""
+import fcntl
+import json
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .id_map import CHECK_INTERVAL, CURRENT, new_version_dir, publish
+
+
+def get_neighbours_dir(config) -> Path:
+    return Path(config.get('dirs', 'neighbours', fallback=str(Path(config['dirs']['computations'], 'neighbours'))))
+
+
+class NeighbourLists:
+    def __init__(self, directory: Path):
+        self.int_ids = np.load(Path(directory, 'int_ids.npy'), mmap_mode='r')
+        self.offsets = np.load(Path(directory, 'offsets.npy'), mmap_mode='r')
+        self.neighbours = np.load(Path(directory, 'neighbours.npy'), mmap_mode='r')
+        self.qscores = np.load(Path(directory, 'qscores.npy'), mmap_mode='r')
+        self.truncated = np.load(Path(directory, 'truncated.npy'), mmap_mode='r')
+        with open(Path(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        self.size = meta['size']
+        self.min_qscore = meta['min_qscore']
+
+    def __len__(self) -> int:
+        return len(self.int_ids)
+
+    def lookup(self, int_id: int, min_qscore: float, num_results: int) -> Optional[List[int]]:
+        """intIds of the neighbours a search with the given threshold and number of results would return, None if the
+        list of the chain does not answer the search (or there is none)."""
+        if min_qscore < self.min_qscore or not len(self):
+            return None
+        idx = int(np.searchsorted(self.int_ids, int_id))
+        if idx == len(self) or self.int_ids[idx] != int_id:
+            return None
+
+        begin, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        passing = int(np.count_nonzero(self.qscores[begin:end] >= min_qscore))
+        if passing < num_results and passing == end - begin and self.truncated[idx]:
+            return None  # neighbours beyond the end of the list may pass the threshold too
+        return self.neighbours[begin:begin + min(passing, num_results)].tolist()
+
+
+def write_neighbour_lists(root: Path, int_ids: np.ndarray, offsets: np.ndarray, neighbours: np.ndarray,
+                          qscores: np.ndarray, truncated: np.ndarray, size: int, min_qscore: float) -> Path:
+    directory = new_version_dir(root)
+    np.save(Path(directory, 'int_ids.npy'), np.asarray(int_ids, dtype=np.int64))
+    np.save(Path(directory, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+    np.save(Path(directory, 'neighbours.npy'), np.asarray(neighbours, dtype=np.int64))
+    np.save(Path(directory, 'qscores.npy'), np.asarray(qscores, dtype=np.float32))
+    np.save(Path(directory, 'truncated.npy'), np.asarray(truncated, dtype=bool))
+    with open(Path(directory, 'meta.json'), 'w') as f:
+        json.dump({'size': size, 'min_qscore': min_qscore}, f)
+    publish(root, directory)
+    return directory
+
+
+def load_current(root: Path) -> Optional[NeighbourLists]:
+    try:
+        return NeighbourLists(Path(root, Path(root, CURRENT).read_text().strip()))
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def lists_lock(root: Path):
+    # Updates read the current lists and publish new ones, concurrent updates would lose each other's changes
+    Path(root).mkdir(parents=True, exist_ok=True)
+    with open(Path(root, 'LOCK'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def update_neighbour_lists(root: Path, stale: Iterable[int],
+                           new_lists: Dict[int, Tuple[List[Tuple[int, float]], bool]]) -> Optional[Path]:
+    """Publishes the current lists without the lists of the stale chains and without the stale chains as neighbours,
+    with new_lists (intId -> neighbours with Q-scores and whether the list is truncated) added and their chains
+    inserted into the lists of their neighbours. Returns None if no lists were built yet."""
+    with lists_lock(root):
+        lists = load_current(root)
+        return _update_lists(root, lists, stale, new_lists) if lists is not None else None
+
+
+def _update_lists(root: Path, lists: NeighbourLists, stale: Iterable[int],
+                  new_lists: Dict[int, Tuple[List[Tuple[int, float]], bool]]) -> Path:
+
+    new_int_ids = np.fromiter(new_lists, dtype=np.int64, count=len(new_lists))
+    stale = np.union1d(np.fromiter(stale, dtype=np.int64), new_int_ids)
+    old_kept = ~np.isin(lists.int_ids, stale)
+    old_int_ids = np.asarray(lists.int_ids)[old_kept]
+    owners = np.repeat(np.asarray(lists.int_ids), np.diff(lists.offsets))
+    kept = np.isin(owners, old_int_ids) & ~np.isin(lists.neighbours, stale)
+
+    pairs = [(int_id, neighbour, qscore) for int_id, (neighbours, _) in new_lists.items()
+             for neighbour, qscore in neighbours]
+    new_owners = np.array([int_id for int_id, _, _ in pairs], dtype=np.int64)
+    new_neighbours = np.array([neighbour for _, neighbour, _ in pairs], dtype=np.int64)
+    new_qscores = np.array([qscore for _, _, qscore in pairs], dtype=np.float32)
+    # Q-score is symmetric, so the new chains enter the lists of their neighbours. Lists of other new chains have
+    # them already, chains without a list get none (a list of just the new chains would pretend to be complete).
+    reverse = np.isin(new_neighbours, old_int_ids)
+    owners = np.concatenate([owners[kept], new_owners, new_neighbours[reverse]])
+    neighbours = np.concatenate([lists.neighbours[kept], new_neighbours, new_owners[reverse]])
+    qscores = np.concatenate([lists.qscores[kept], new_qscores, new_qscores[reverse]])
+
+    order = np.lexsort((-qscores, owners))
+    owners, neighbours, qscores = owners[order], neighbours[order], qscores[order]
+    rank = np.arange(len(owners)) - np.searchsorted(owners, owners)
+    overflow = np.unique(owners[rank >= lists.size])
+    fits = rank < lists.size
+    owners, neighbours, qscores = owners[fits], neighbours[fits], qscores[fits]
+
+    int_ids = np.concatenate([old_int_ids, new_int_ids])
+    truncated = np.concatenate([np.asarray(lists.truncated)[old_kept],
+                                np.array([truncated for _, truncated in new_lists.values()], dtype=bool)])
+    by_int_id = np.argsort(int_ids, kind='stable')
+    int_ids, truncated = int_ids[by_int_id], truncated[by_int_id] | np.isin(int_ids[by_int_id], overflow)
+    offsets = np.append(np.searchsorted(owners, int_ids), len(owners))
+    return write_neighbour_lists(root, int_ids, offsets, neighbours, qscores, truncated, lists.size, lists.min_qscore)
+
+
+class NeighbourListStore:
+    """Current lists of the root directory, reloaded when newer ones are published."""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.lists: Optional[NeighbourLists] = None
+        self.version: Optional[str] = None
+        self.checked = 0.0
+
+    def get(self) -> Optional[NeighbourLists]:
+        now = time.monotonic()
+        if now - self.checked < CHECK_INTERVAL:
+            return self.lists
+        self.checked = now
+
+        try:
+            version = Path(self.root, CURRENT).read_text().strip()
+            if version != self.version:
+                self.lists = NeighbourLists(Path(self.root, version))
+                self.version = version
+        except (OSError, ValueError, KeyError):
+            pass  # lists not built yet or replaced while loading, the next check retries
+        return self.lists
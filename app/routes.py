@@ -1,13 +1,118 @@
 from flask import render_template, request, flash, send_from_directory, jsonify, redirect, url_for, Response, abort
+from werkzeug.http import dump_options_header
 import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import gzip
 from datetime import datetime
-from typing import Generator, Union
+from typing import Generator, List, Optional, Union
 import copy
 import re
 import sys
-
-from . import application
+import threading
+import unicodedata
+import uuid
+from urllib.parse import quote
+
+from .web import application, new_job_data
+from .admission import ADMISSION, AdmissionError, estimate_cost
+from .chain_store import CHAIN_STORE
 from .computation import *
+from .export import EXPORT_MIMETYPES, ARROW_FORMATS, arrow_available, export_results, finished_hits
+from .logs import log
+from .metrics import ACTIVE_STREAMS, PREPARE_PDB_TIME, render_metrics
+from .monitor import PHASES, QUEUE_CHECK_INTERVAL, TERMINAL_STATUSES, get_job_states, start_job_monitor, submit_task
+from .storage import STORAGE
+from .superpose import aligned_pdb, superpose_available
+from .tracing import load_trace, span
+
+MAX_BATCH_QUERIES = 1000
+# Largest number of results of a query, like the search form allows
+MAX_NUM_RESULTS = 5000
+BATCH_MESSIF_WORKERS = 4
+# PDB text compresses well already at the fastest level
+GZIP_LEVEL = 1
+
+# Known API tokens identify clients sharing an address (e.g., a whole institute behind a NAT)
+API_TOKENS = set(config.get('admission', 'tokens', fallback='').split())
+BEHIND_PROXY = config.getboolean('admission', 'behind_proxy', fallback=False)
+# 'search' or 'stream' when served by one of the gunicorn pools, None otherwise (mod_wsgi, development server)
+SERVER_POOL = os.environ.get('PROTEIN_SEARCH_POOL')
+
+# Mapped before the worker pools fork, so all processes share the pages
+ID_MAPS.get()
+# Under gunicorn (gunicorn.conf.py), the janitor runs in the worker of the search pool, which pins the directories
+# of its searches
+if SERVER_POOL is None:
+    STORAGE.start()
+    CHAIN_STORE.start()
+
+
+class WorkerPool(concurrent.futures.Executor):
+    """Process pool of the uploads, started on first use and replaced when broken.
+
+    A pool whose worker died (e.g., a crash in save_chains) refuses all later tasks with BrokenProcessPool.
+    """
+
+    def __init__(self):
+        self.pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        with self.lock:
+            if self.pool is not None:
+                try:
+                    return self.pool.submit(fn, *args, **kwargs)
+                except BrokenProcessPool:
+                    log('worker_pool_replaced', logging.WARNING)
+                    self.pool.shutdown(wait=False)
+            self.pool = concurrent.futures.ProcessPoolExecutor(mp_context=WORKER_CONTEXT, initializer=os.nice,
+                                                               initargs=(19,))
+            return self.pool.submit(fn, *args, **kwargs)
+
+
+WORKER_POOL = WorkerPool()
+
+
+@application.before_request
+def touch_job() -> None:
+    # Directories of jobs are evicted least recently used first
+    job_id = (request.view_args or {}).get('job_id')
+    if job_id is not None:
+        STORAGE.touch(job_id)
+
+
+def get_client() -> str:
+    token = request.headers.get('X-API-Token')
+    if token in API_TOKENS:
+        return f'token:{token}'
+    # The last address of X-Forwarded-For is the one added by the (trusted) reverse proxy, the others can be forged
+    return request.access_route[-1] if BEHIND_PROXY else request.remote_addr
+
+
+def start_job(job_id: str, job_data: dict) -> None:
+    """Starts the search of the job (possibly queued), AdmissionError if the client is over its limits."""
+    chain_length = get_chain_length(job_data['query'], job_id)
+    job_data['cost'] = estimate_cost(job_data['num_results'], job_data['radius'], chain_length)
+    ADMISSION.register(job_id, get_client(), job_data['cost'])
+    # Streams served by other processes check that the search still runs
+    job_data['owner'] = os.getpid()
+    application.computation_results[job_id] = new_job_data(job_data)
+    start_job_monitor(job_id)
+
+
+def rejected(e: AdmissionError):
+    flash(str(e))
+    if e.retry_after is None:
+        return render_template('index.html', **application.db_stats), 400
+    return render_template('index.html', **application.db_stats), 429, {'Retry-After': str(e.retry_after)}
+
+
+def tracked_stream(stream: Generator) -> Generator:
+    ACTIVE_STREAMS.inc()
+    try:
+        yield from stream
+    finally:
+        ACTIVE_STREAMS.dec()
 
 
 @application.route('/', methods=['GET', 'POST'])
@@ -58,14 +163,14 @@ def index():
                                uploaded=False, name=name, **application.db_stats)
     elif 'upload' in request.form:
         try:
-            job_id, chains = process_input(request)
+            job_id, chains = process_input(request, WORKER_POOL)
         except RuntimeError as e:
             flash(e)
             return render_template('index.html', **application.db_stats)
 
         filename = request.files['file'].filename
         return render_template('index.html', chains=chains, selected=True, job_id=job_id, input_name=filename,
-                               uploaded=True, **application.db_stats)
+                               uploaded=True, parsing=chains is None, **application.db_stats)
     else:
         flash('Unknown error')
         return render_template('index.html', **application.db_stats)
@@ -75,23 +180,41 @@ def index():
 def search(job_id: str):
     chain: str = request.form['chain']
     name: str = request.form['input_name']
-    radius: float = 1 - float(request.form['qscore_range'])
-    num_results: int = int(request.form['num_results'])
-    print(f"started search for chain {chain} under name {name}")
+    try:
+        radius: float = 1 - float(request.form['qscore_range'])
+        num_results: int = int(request.form['num_results'])
+    except ValueError:
+        flash('Incorrect search parameters.')
+        return render_template('index.html', **application.db_stats), 400
+    if num_results < 1:
+        flash('The number of results must be positive.')
+        return render_template('index.html', **application.db_stats), 400
+    num_results = min(num_results, MAX_NUM_RESULTS)
+    if job_id in application.computation_results:
+        # Submitted again (e.g., a double click), the search of the job runs already
+        job_data = application.computation_results[job_id]
+        return redirect(url_for('results', job_id=job_id, chain=job_data['chain'], name=job_data['name']))
+    log('search_started', name=name, chain=chain, job_id=job_id)
     if request.form['uploaded'] == 'True':
         query = f'_{job_id}:{chain}'
     else:
         query = f'{name}:{chain}'
 
-    application.computation_results[job_id] = application.mp_manager.dict({
-        'query': query,
-        'radius': radius,
-        'name': name,
-        'chain': chain,
-        'num_results': num_results,
-        'disable_search_stats': 'disable_search_stats' in request.form,
-        'disable_visualizations': 'disable_visualizations' in request.form
-    })
+    try:
+        start_job(job_id, {
+            'query': query,
+            'radius': radius,
+            'name': name,
+            'chain': chain,
+            'num_results': num_results,
+            'disable_search_stats': 'disable_search_stats' in request.form,
+            'disable_visualizations': 'disable_visualizations' in request.form,
+            'state': 'CREATED',
+            'created': time.time()
+        })
+    except AdmissionError as e:
+        log('search_rejected', logging.WARNING, job_id=job_id, error=str(e))
+        return rejected(e)
 
     return redirect(url_for('results', job_id=job_id, chain=chain, name=name))
 
@@ -101,8 +224,6 @@ def results(job_id: str, name: str, chain: str):
     if job_id not in application.computation_results:
         abort(404)
 
-    print(f"redirected to jobs chain {chain}")
-
     disable_search_stats = application.computation_results[job_id]['disable_search_stats']
     disable_visualizations = application.computation_results[job_id]['disable_visualizations']
     title = get_names([name]).get(name, None)
@@ -110,25 +231,49 @@ def results(job_id: str, name: str, chain: str):
                            disable_search_stats=disable_search_stats, disable_visualizations=disable_visualizations)
 
 
+def get_saved_query(job_id: str) -> Optional[Tuple[str, str, dict]]:
+    with DBConnection() as db:
+        sql_select = 'SELECT name, chain, statistics FROM savedQueries WHERE job_id = %s'
+        db.c.execute(sql_select, (job_id,))
+        data = db.c.fetchall()
+
+    if not data:
+        return None
+    name, chain, summary = data[0]
+    return name, chain, json.loads(summary)
+
+
+def get_job_statistics(job_id: str) -> Optional[Tuple[str, str, List[dict]]]:
+    if job_id in application.computation_results:
+        job_data = application.computation_results[job_id]
+        return job_data['name'], job_data['chain'], job_data.get('res_data', {}).get('statistics', [])
+
+    saved = get_saved_query(job_id)
+    if saved is None:
+        return None
+    name, chain, summary = saved
+    # Rows saved before savedQueryHits existed keep the hits in the JSON
+    statistics = summary['statistics'] if 'statistics' in summary else load_saved_hits(job_id)
+    return name, chain, statistics
+
+
 @application.route('/details/<string:job_id>/<string:obj>')
 def get_details(job_id: str, obj: str):
     if job_id in application.computation_results:
         job_data = application.computation_results[job_id]
         name = job_data['name']
         chain = job_data['chain']
-        statistics = job_data['res_data']['statistics']
+        statistics = job_data.get('res_data', {}).get('statistics', [])
+        obj_stats = next((stat for stat in statistics if stat['object'] == obj), None)
     else:
-        with DBConnection() as db:
-            sql_select = 'SELECT name, chain, statistics FROM savedQueries WHERE job_id = %s'
-            db.c.execute(sql_select, (job_id,))
-            data = db.c.fetchall()
-
-        if not data:
+        saved = get_saved_query(job_id)
+        if saved is None:
             abort(404)
-        name, chain, statistics = data[0]
-        statistics = json.loads(statistics)['statistics']
-
-    obj_stats = next((stat for stat in statistics if stat['object'] == obj), None)
+        name, chain, summary = saved
+        if 'statistics' in summary:
+            obj_stats = next((stat for stat in summary['statistics'] if stat['object'] == obj), None)
+        else:
+            obj_stats = load_saved_hit(job_id, obj)
 
     other_pdb = obj.split(':')[0]
     names = get_names([name, other_pdb])
@@ -139,6 +284,68 @@ def get_details(job_id: str, obj: str):
                            obj_stats=obj_stats, job_id=job_id, obj=obj)
 
 
+RESULT_SORT_KEYS = ('object', 'qscore', 'rmsd', 'seq_id', 'aligned')
+RESULT_FILTERS = {'min_qscore': ('qscore', float.__ge__),
+                  'max_qscore': ('qscore', float.__le__),
+                  'min_rmsd': ('rmsd', float.__ge__),
+                  'max_rmsd': ('rmsd', float.__le__),
+                  'min_seq_id': ('seq_id', float.__ge__),
+                  'max_seq_id': ('seq_id', float.__le__)}
+MAX_PAGE_SIZE = 500
+
+
+@application.route('/get_results/<string:job_id>')
+def get_results(job_id: str) -> Union[Response, Tuple]:
+    job_statistics = get_job_statistics(job_id)
+    if job_statistics is None:
+        return jsonify({'error': 'job_id not found'}), 404
+    _, _, statistics = job_statistics
+
+    try:
+        sort = request.args.get('sort', 'qscore')
+        descending = request.args.get('order', 'desc') == 'desc'
+        page = int(request.args.get('page', 1))
+        page_size = min(int(request.args.get('page_size', 50)), MAX_PAGE_SIZE)
+        filters = {arg: float(request.args[arg]) for arg in RESULT_FILTERS if arg in request.args}
+    except ValueError:
+        return jsonify({'error': 'Incorrect parameters.'}), 400
+    if sort not in RESULT_SORT_KEYS or page < 1 or page_size < 1:
+        return jsonify({'error': 'Incorrect parameters.'}), 400
+
+    selected = statistics
+    for arg, value in filters.items():
+        key, compare = RESULT_FILTERS[arg]
+        # Rows still being aligned have no values and cannot pass any threshold
+        selected = [row for row in selected if row[key] is not None and row['qscore'] != -1
+                    and compare(float(row[key]), value)]
+
+    # Rows without a value are always listed last
+    present = [row for row in selected if row[sort] is not None]
+    missing = [row for row in selected if row[sort] is None]
+    selected = sorted(present, key=lambda x: x[sort], reverse=descending) + missing
+
+    start = (page - 1) * page_size
+    return jsonify({'total': len(statistics),
+                    'filtered': len(selected),
+                    'page': page,
+                    'page_size': page_size,
+                    'statistics': selected[start:start + page_size]})
+
+
+def attachment(filename: str) -> str:
+    """Content-Disposition of a download named after the user's upload, encoded like by send_file()."""
+    ascii_name = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+    return dump_options_header('attachment', {'filename': ascii_name,
+                                              'filename*': f"UTF-8''{quote(filename, safe='!#$&+-.^_`|~')}"})
+
+
+def get_transform(job_id: str, obj: str) -> Optional[List[float]]:
+    if job_id in application.computation_results:
+        # Stored when the search finishes
+        return application.computation_results[job_id].get('transforms', {}).get(obj)
+    return load_saved_transform(job_id, obj)
+
+
 @application.route('/get_pdb/<string:job_id>/<string:obj>')
 def get_pdb(job_id: str, obj: str):
     if obj == 'query':
@@ -146,8 +353,36 @@ def get_pdb(job_id: str, obj: str):
     else:
         file = f'{obj}.aligned.pdb'
 
-    with open(Path(config['dirs']['computations'], f'query{job_id}', file)) as f:
-        return ''.join(line for line in f if not line.startswith('HETATM'))
+    path = Path(config['dirs']['computations'], f'query{job_id}', file)
+    if path.exists() or obj == 'query':
+        with open(path) as f:
+            pdb = ''.join(line for line in f if not line.startswith('HETATM'))
+    else:
+        # Aligned structures not written by the search (e.g., purged from a saved query) are superposed now
+        T = get_transform(job_id, obj)
+        if T is None or not superpose_available():
+            abort(404)
+        try:
+            with PREPARE_PDB_TIME.time():
+                pdb = aligned_pdb(obj, T)
+        except (OSError, ValueError) as e:
+            log('aligned_pdb_failed', logging.WARNING, job_id=job_id, obj=obj, error=str(e))
+            abort(404)
+
+    if 'gzip' not in request.accept_encodings:
+        return pdb
+    response = Response(gzip.compress(pdb.encode(), compresslevel=GZIP_LEVEL), mimetype='text/html')
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@application.route('/upload_status/<string:job_id>')
+def upload_status(job_id: str) -> Union[Response, Tuple]:
+    if not Path(config['dirs']['computations'], f'query{job_id}').exists():
+        return jsonify({'error': 'job_id not found'}), 404
+
+    return jsonify(get_upload_status(job_id))
 
 
 @application.route('/get_random_pdbs')
@@ -175,182 +410,45 @@ def get_image(job_id: str, obj: str):
 
 
 def results_event_stream(job_id: str) -> Generator[str, None, None]:
-    def set_niceness(val: int):
-        os.nice(val)
-
     job_data = application.computation_results[job_id]
+    res_data = job_data.get('res_data')
+    if res_data is not None and res_data['status'] in TERMINAL_STATUSES:
+        # Search already ended, the final state is replayed
+        states = (state for state in [res_data])
+    else:
+        states = get_job_states(job_id).subscribe()
 
-    query_name = f'{job_data["name"]}:{job_data["chain"]}'
-
-    print(f"main loop started for query {query_name}")
-
-    executor = concurrent.futures.ProcessPoolExecutor(initializer=set_niceness, initargs=(19,))
-
-    start_time = time.time()
-
-    query_raw_pdb = executor.submit(prepare_PDB_wrapper, job_data['query'], config['dirs']['raw_pdbs'],
-                                    str(Path(config['dirs']['computations'], f'query{job_id}')))
-
-    messif_future = {'sketches_small': executor.submit(get_results_messif, job_data['query'], -1,
-                                                       job_data['num_results'], 'sketches_small', job_id),
-                     'sketches_large': None,
-                     'full': None}
-
-    result_stats = {}
     sent_data = {}
-    timer = 0
-    end_time = None
-    print(f'Stream started for job_id = {job_id}')
-    while True:
-        res_data = {'chain_ids': [],
-                    'status': 'COMPUTING',
-                    'sketches_small_status': 'COMPUTING',
-                    'sketches_large_status': 'WAITING',
-                    'full_status': 'WAITING'}
-
-        if messif_future['sketches_small'].done():
-            try:
-                res_data['chain_ids'], stats = messif_future['sketches_small'].result()
-                res_data['sketches_small_statistics'] = stats
-
-                res_data['sketches_small_status'] = 'DONE'
-                res_data['sketches_large_status'] = 'COMPUTING'
-
-                if messif_future['sketches_large'] is None:
-                    messif_future['sketches_large'] = executor.submit(get_results_messif, job_data['query'],
-                                                                      job_data['radius'], job_data['num_results'],
-                                                                      'sketches_large', job_id)
-            except RuntimeError as e:
-                res_data['status'] = 'ERROR'
-                res_data['sketches_small_status'] = 'ERROR'
-                res_data['error_message'] = str(e)
-
-        if messif_future['sketches_large'] is not None and messif_future['sketches_large'].done():
-            try:
-                res_data['chain_ids'], stats = messif_future['sketches_large'].result()
-                res_data['sketches_large_statistics'] = stats
-
-                res_data['sketches_large_status'] = 'DONE'
-                res_data['full_status'] = 'COMPUTING'
-
-                if messif_future['full'] is None:
-                    messif_future['full'] = executor.submit(get_results_messif, job_data['query'], job_data['radius'],
-                                                            job_data['num_results'], 'full', job_id)
-
-            except RuntimeError as e:
-                res_data['status'] = 'ERROR'
-                res_data['sketches_large_status'] = 'ERROR'
-                res_data['error_message'] = str(e)
-
-        if messif_future['full'] is not None and messif_future['full'].done():
-            try:
-                res_data['chain_ids'], stats = messif_future['full'].result()
-                print(f"messiff future result {messif_future['full'].result()}")
-                res_data['full_status'] = 'DONE'
-                res_data['full_statistics'] = stats
-            except RuntimeError as e:
-                res_data['status'] = 'ERROR'
-                res_data['full_status'] = 'ERROR'
-                res_data['error_message'] = str(e)
-
-        running_phase = None
-        for phase in ['sketches_small', 'sketches_large', 'full']:
-            if res_data[f'{phase}_status'] == 'COMPUTING':
-                running_phase = phase
-
-        try:
-            if running_phase is not None:
-                res_data[f'{running_phase}_progress'] = get_progress(job_id, running_phase)
-        except RuntimeError as e:
-            res_data['status'] = 'ERROR'
-            res_data[f'{running_phase}_status'] = 'ERROR'
-            res_data['error_message'] = str(e)
-
-        query = job_data['query']
-        disable_visualizations = job_data['disable_visualizations']
-        min_qscore = 1 - job_data['radius']
-        if query_raw_pdb.done():
-            print(f"res_data['chain_ids'] {res_data['chain_ids']}")
-            for chain_id in res_data['chain_ids']:
-                if chain_id not in result_stats:
-                    result_stats[chain_id] = executor.submit(get_stats, query, query_name, chain_id, min_qscore, job_id,
-                                                             disable_visualizations)
-
-        statistics = []
-        completed = 0
-        if query_raw_pdb.done():
-            for chain_id in res_data['chain_ids']:
-                job = result_stats[chain_id]
-                if job.done():
-                    completed += 1
-                    qscore, rmsd, seq_id, aligned = job.result()
-                    if qscore < 1 - job_data['radius']:
-                        continue
-                    statistics.append({'object': chain_id,
-                                       'qscore': round(qscore, 3),
-                                       'rmsd': round(rmsd, 3),
-                                       'seq_id': round(seq_id, 3),
-                                       'aligned': aligned})
-                else:
-                    statistics.append({
-                        'object': chain_id,
-                        'qscore': -1,
-                        'rmsd': None,
-                        'seq_id': None,
-                        'aligned': None,
-                    })
-
-        statistics = sorted(statistics, key=lambda x: x['qscore'], reverse=True)
-        res_data['statistics'] = statistics
-        res_data['completed'] = completed
-
-        if res_data['full_status'] == 'DONE':
-            res_data['search_time'] = 0
-            for phase in ['sketches_small', 'sketches_large', 'full']:
-                stats = res_data[f'{phase}_statistics']
-                res_data['search_time'] += stats['pivotTime'] + stats['searchTime']
-
-        if res_data['full_status'] == 'DONE' and completed == len(res_data['chain_ids']):
-            if end_time is None:
-                end_time = time.time()
-            res_data['total_time'] = int((time.time() - start_time) * 1000)
-            res_data['status'] = 'FINISHED'
-
-        if '_abort' in job_data:
-            print('User aborted the search')
-            res_data['status'] = 'ABORTED'
-
-        application.computation_results[job_id]['res_data'] = res_data
-
-        if json.dumps(res_data) != json.dumps(sent_data):
-            timer = 0
-            to_send = copy.deepcopy(res_data)
-            # Don't update results table if not necessary
-            if json.dumps(sent_data.get('statistics', [])) == json.dumps(to_send['statistics']):
-                del to_send['statistics']
-
-            sent_data = copy.deepcopy(res_data)
-
-            yield 'data: ' + json.dumps(to_send) + '\n\n'
-        else:
-            if timer == 5:
-                timer = 0
-                yield ': keep-alive'
-
-        timer += 1
-        time.sleep(1)
-        if res_data['status'] in ['FINISHED', 'ERROR', 'ABORTED']:
-            break
-
-    print(f'Stream ended for job_id = {job_id}')
-    for phase in ['sketches_small', 'sketches_large', 'full']:
-        if res_data[f'{phase}_status'] == 'COMPUTING':
-            end_messif_job(job_id, phase)
-
-    if sys.version_info.major == 3 and sys.version_info.minor >= 9:
-        executor.shutdown(cancel_futures=True)
-    else:
-        executor.shutdown()
+    sent_rows = {}
+    try:
+        for res_data in states:
+            if res_data is None:
+                yield ': keep-alive\n\n'
+                continue
+
+            # Only rows that changed since the last message are sent, the client patches its table
+            rows = {row['object']: row for row in res_data['statistics']}
+            updated = [row for obj, row in rows.items() if sent_rows.get(obj) != row]
+            removed = [obj for obj in sent_rows if obj not in rows]
+            to_send = {key: value for key, value in res_data.items() if key not in ('statistics', 'chain_ids')}
+            to_send['chain_count'] = len(res_data['chain_ids'])
+
+            if to_send != sent_data or updated or removed:
+                first = not sent_data
+                sent_data = copy.deepcopy(to_send)
+                sent_rows = rows
+                # The first message carries the whole table, it replaces the rows shown before a reconnection
+                if first:
+                    to_send['statistics'] = res_data['statistics']
+                elif updated or removed:
+                    to_send['statistics_diff'] = {'updated': updated, 'removed': removed}
+
+                yield 'data: ' + json.dumps(to_send) + '\n\n'
+    finally:
+        # Connection closed by the client (write of a message or keep-alive failed) or the search ended
+        states.close()
+
+    log('stream_ended', job_id=job_id, status=res_data['status'] if res_data is not None else None)
 
 
 @application.route('/get_results_stream/<string:job_id>')
@@ -358,7 +456,7 @@ def stream(job_id: str) -> Union[Response, Tuple]:
     if job_id not in application.computation_results:
         return jsonify({'error': 'job_id not found'}), 404
 
-    return Response(results_event_stream(job_id), mimetype='text/event-stream')
+    return Response(tracked_stream(results_event_stream(job_id)), mimetype='text/event-stream')
 
 
 @application.route('/save_query/<string:job_id>')
@@ -367,15 +465,17 @@ def save_query(job_id: str):
         return jsonify({'error': 'job_id not found'}), 404
 
     job_data = application.computation_results[job_id]
-    statistics = job_data['res_data']
+    res_data = job_data['res_data']
 
-    with DBConnection() as db:
+    with DBConnection() as db, span(job_id, 'save_query'):
         sql_insert = ('INSERT IGNORE INTO savedQueries '
                       '(job_id, name, chain, radius, k, statistics, disable_search_stats, disable_visualizations)'
                       'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)')
 
         db.c.execute(sql_insert, (job_id, job_data['name'], job_data['chain'], job_data['radius'], job_data['num_results'],
-                                  json.dumps(statistics), job_data['disable_search_stats'], job_data['disable_visualizations']))
+                                  json.dumps(compact_res_data(res_data)), job_data['disable_search_stats'],
+                                  job_data['disable_visualizations']))
+        save_hits(db, job_id, res_data['statistics'], job_data.get('transforms', {}))
         db.conn.commit()
 
     return Response(f'{request.url_root}saved_query/{job_id}')
@@ -383,30 +483,58 @@ def save_query(job_id: str):
 
 @application.route('/get_txt_results/<string:job_id>')
 def get_txt_results(job_id: str):
+    if job_id not in application.computation_results:
+        return jsonify({'error': 'job_id not found'}), 404
+
     all_data = application.computation_results[job_id]
-    res_data = all_data['res_data']['statistics']
+    hits = finished_hits(all_data['res_data']['statistics'])
+
+    def generate() -> Generator[str, None, None]:
+        yield 'Protein chain search results\n'
+        yield f'{"=" * 40}\n'
+        yield f'Query: {all_data["name"]}:{all_data["chain"]}\n'
+        yield f'Q-score threshold: {1 - all_data["radius"]}\n'
+        yield f'Maximum number of results: {all_data["num_results"]}\n'
+        yield f'Number of results: {len(hits)}\n'
+        yield f'DB version: {application.db_stats.get("updated")}\n'
+        yield f'Results downloaded: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\n'
+        yield f'{"=" * 40}\n'
+        yield ','.join(['object', 'qscore', 'rmsd', 'seq_id', 'aligned']) + '\n'
+        for obj in hits:
+            yield (f'{obj["object"]},'
+                   f'{obj["qscore"]:5.3f},'
+                   f'{obj["rmsd"]:5.3f},'
+                   f'{obj["seq_id"]:5.3f},'
+                   f'{obj["aligned"]}\n')
 
     filename = f'results_{all_data["query"].replace(":", "_")}.txt'
-    with open(Path(config['dirs']['computations'], f'query{job_id}', filename), 'w') as f:
-        f.write('Protein chain search results\n')
-        f.write(f'{"=" * 40}\n')
-        f.write(f'Query: {all_data["name"]}:{all_data["chain"]}\n')
-        f.write(f'Q-score threshold: {1 - all_data["radius"]}\n')
-        f.write(f'Maximum number of results: {all_data["num_results"]}\n')
-        f.write(f'Number of results: {len(res_data)}\n')
-        f.write(f'DB version: {application.db_stats["updated"]}\n')
-        f.write(f'Results downloaded: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\n')
-        f.write(f'{"=" * 40}\n')
-        f.write(','.join(['object', 'qscore', 'rmsd', 'seq_id', 'aligned']) + '\n')
-        for obj in res_data:
-            f.write(f'{obj["object"]},'
-                    f'{obj["qscore"]:5.3f},'
-                    f'{obj["rmsd"]:5.3f},'
-                    f'{obj["seq_id"]:5.3f},'
-                    f'{obj["aligned"]}\n')
-
-    return send_from_directory(Path(config['dirs']['computations'], f'query{job_id}'), filename,
-                               max_age=0, as_attachment=True)
+    return Response(generate(), mimetype='text/plain',
+                    headers={'Content-Disposition': attachment(filename)})
+
+
+@application.route('/export/<string:job_id>/<string:fmt>')
+def export(job_id: str, fmt: str) -> Union[Response, Tuple]:
+    if fmt not in EXPORT_MIMETYPES:
+        return jsonify({'error': f'Unknown format, use one of: {", ".join(EXPORT_MIMETYPES)}'}), 400
+    if fmt in ARROW_FORMATS and not arrow_available():
+        return jsonify({'error': f'Export to {fmt} is not available on this server.'}), 400
+
+    job_statistics = get_job_statistics(job_id)
+    if job_statistics is None:
+        return jsonify({'error': 'job_id not found'}), 404
+    name, chain, statistics = job_statistics
+
+    if job_id in application.computation_results:
+        transforms = application.computation_results[job_id].get('transforms', {})
+    else:
+        transforms = load_saved_transforms(job_id)
+
+    structures = request.args.get('structures') == '1'
+    directory = Path(config['dirs']['computations'], f'query{job_id}')
+    filename = f'results_{name}_{chain}.{fmt}'
+    return Response(export_results(statistics, transforms, fmt, directory, structures),
+                    mimetype=EXPORT_MIMETYPES[fmt],
+                    headers={'Content-Disposition': attachment(filename)})
 
 
 @application.route('/saved_query/<string:job_id>')
@@ -423,11 +551,17 @@ def saved_query(job_id: str):
         return Response('Invalid link.')
 
     name, chain, statistics, added, disable_search_stats, disable_visualizations = data[0]
+    summary = json.loads(statistics)
+    if 'statistics' not in summary:
+        summary['statistics'] = load_saved_hits(job_id)
+        statistics = json.dumps(summary)
     title = get_names([name]).get(name, None)
 
+    # Set by utils/archive_hooks.py when hits were removed or changed in the archive
     return render_template('results.html', saved=True, statistics=statistics, query=f'{name}:{chain}', added=added,
-                           title=title, disable_search_stats=disable_search_stats,
-                           disable_visualizations=disable_visualizations)
+                           job_id=job_id, title=title, disable_search_stats=disable_search_stats,
+                           disable_visualizations=disable_visualizations,
+                           archive_updated=summary.get('archive_updated'))
 
 
 @application.route('/end_job/<string:job_id>', methods=['GET', 'POST'])
@@ -459,22 +593,252 @@ def find_similar(job_id: str, obj: str):
         if not data:
             abort(404)
         k, radius, disable_search_stats, disable_visualizations = data[0]
+    # Queries saved before the limit may ask for more
+    k = min(max(k, 1), MAX_NUM_RESULTS)
 
     new_job_id, chains = prepare_indexed_chain(pdbid)
 
-    application.computation_results[new_job_id] = application.mp_manager.dict({
-        'query': obj,
-        'radius': radius,
-        'name': pdbid,
-        'chain': chain,
-        'num_results': k,
-        'disable_search_stats': disable_search_stats,
-        'disable_visualizations': disable_visualizations
-    })
+    try:
+        start_job(new_job_id, {
+            'query': obj,
+            'radius': radius,
+            'name': pdbid,
+            'chain': chain,
+            'num_results': k,
+            'disable_search_stats': disable_search_stats,
+            'disable_visualizations': disable_visualizations,
+            'state': 'CREATED',
+            'created': time.time()
+        })
+    except AdmissionError as e:
+        log('search_rejected', logging.WARNING, job_id=new_job_id, error=str(e))
+        return rejected(e)
 
     return redirect(url_for('results', job_id=new_job_id, chain=chain, name=pdbid))
 
 
+def batch_event_stream(batch_id: str, queries: List[Tuple[List[str], str]], radius: float, num_results: int,
+                       cost: float) -> Generator[str, None, None]:
+    min_qscore = 1 - radius
+    # Uploaded queries are read from their job directories during the whole batch
+    job_ids = {query[1:].split(':')[0] for _, query in queries if query.startswith('_')}
+    STORAGE.pin(job_ids)
+
+    messif_executor = None
+    executor = None
+    searches: Dict[concurrent.futures.Future, Tuple[List[str], str]] = {}
+    # Pairs are shared by all queries of the batch, so A -> B and B -> A are aligned only once
+    pairs: Dict[frozenset, concurrent.futures.Future] = {}
+
+    try:
+        # Batches share the capacity with the interactive searches
+        ADMISSION.enqueue(batch_id, cost)
+        position = ADMISSION.wait(batch_id, 0)
+        while position is not None:
+            if position == 0:
+                # Released by call_on_close, the client is gone
+                log('batch_cancelled', batch_id=batch_id)
+                return
+            position = ADMISSION.wait(batch_id, QUEUE_CHECK_INTERVAL)
+
+        log('batch_started', batch_id=batch_id, queries=len(queries), cost=round(cost, 1))
+        # MESSIF phases only wait for the remote server, alignments are CPU bound
+        messif_executor = concurrent.futures.ThreadPoolExecutor(BATCH_MESSIF_WORKERS)
+        executor = concurrent.futures.ProcessPoolExecutor(mp_context=WORKER_CONTEXT, initializer=os.nice,
+                                                          initargs=(19,))
+
+        # Each query is searched once and reported under all names sharing it (e.g., identical chains)
+        for i, (names, query) in enumerate(queries):
+            searches[submit_task(messif_executor, run_search_phases, query, radius, num_results,
+                                 f'{batch_id}_{i}')] = (names, query)
+        waiting = {}
+        outstanding = set(searches)
+        while outstanding:
+            done, outstanding = concurrent.futures.wait(outstanding, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future not in searches:
+                    continue
+                names, query = searches[future]
+                try:
+                    chain_ids, phase_stats = future.result()
+                except RuntimeError as e:
+                    for name in names:
+                        yield json.dumps({'query': name, 'status': 'ERROR', 'error_message': str(e)}) + '\n'
+                    continue
+
+                for chain_id in chain_ids:
+                    key = frozenset((query, chain_id))
+                    if key not in pairs:
+                        pairs[key] = submit_task(executor, get_similarity_results, query, chain_id, min_qscore)
+                    if not pairs[key].done():
+                        outstanding.add(pairs[key])
+                waiting[query] = (names, chain_ids, phase_stats)
+
+            for query in list(waiting):
+                names, chain_ids, phase_stats = waiting[query]
+                jobs = [pairs[frozenset((query, chain_id))] for chain_id in chain_ids]
+                if not all(job.done() for job in jobs):
+                    continue
+
+                statistics = []
+                for chain_id, job in zip(chain_ids, jobs):
+                    try:
+                        qscore, rmsd, seq_id, aligned, _ = job.result()
+                    except Exception as e:
+                        log('alignment_failed', logging.WARNING, query=query, other=chain_id, error=str(e))
+                        continue
+                    if qscore < min_qscore:
+                        continue
+                    statistics.append({'object': chain_id,
+                                       'qscore': round(qscore, 3),
+                                       'rmsd': round(rmsd, 3),
+                                       'seq_id': round(seq_id, 3),
+                                       'aligned': aligned})
+
+                search_time = sum(stats['pivotTime'] + stats['searchTime'] for stats in phase_stats.values())
+                statistics = sorted(statistics, key=lambda x: x['qscore'], reverse=True)
+                for name in names:
+                    result = {'query': name, 'status': 'FINISHED', 'search_time': search_time, 'statistics': statistics}
+                    if name != names[0]:
+                        result['identical_to'] = names[0]
+                    yield json.dumps(result) + '\n'
+                del waiting[query]
+    finally:
+        log('batch_ended', batch_id=batch_id)
+        ADMISSION.release(batch_id)
+        STORAGE.unpin(job_ids)
+        # The client may have disconnected, queued searches and alignments are dropped and running searches ended
+        for future in (*searches, *pairs.values()):
+            future.cancel()
+        for i, future in enumerate(searches):
+            if not future.done():
+                for phase in PHASES:
+                    try:
+                        end_messif_job(f'{batch_id}_{i}', phase)
+                    except RuntimeError:
+                        pass  # already logged, MESSIF ends the job itself eventually
+        for pool in (messif_executor, executor):
+            if pool is None:
+                continue
+            if sys.version_info.major == 3 and sys.version_info.minor >= 9:
+                pool.shutdown(wait=False, cancel_futures=True)
+            else:
+                pool.shutdown(wait=False)
+
+
+def start_batch(queries: List[Tuple[List[str], str]], radius: float, num_results: int) -> Union[Response, Tuple]:
+    """Stream of the results of the queries, 429 if the client is over its limits, 400 if the batch is too large."""
+    batch_id = uuid.uuid4().hex[:8]
+    lengths = get_chain_lengths([query for _, query in queries if not query.startswith('_')])
+    # Uploaded queries (_<job_id>:<chain>) have their lengths in the job directories
+    costs = [estimate_cost(num_results, radius, get_chain_length(query, query[1:].split(':')[0])
+                           if query.startswith('_') else lengths.get(query, 0))
+             for _, query in queries]
+    # BATCH_MESSIF_WORKERS queries are searched at once, the batch holds the capacity of the costliest of them
+    cost = sum(sorted(costs, reverse=True)[:BATCH_MESSIF_WORKERS])
+    try:
+        ADMISSION.register(batch_id, get_client(), cost)
+    except AdmissionError as e:
+        log('batch_rejected', logging.WARNING, queries=len(queries), error=str(e))
+        if e.retry_after is None:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'error': str(e)}), 429, {'Retry-After': str(e.retry_after)}
+
+    response = Response(tracked_stream(batch_event_stream(batch_id, queries, radius, num_results, cost)),
+                        mimetype='application/x-ndjson')
+    # Also when the client disconnects before the stream starts
+    response.call_on_close(lambda: ADMISSION.release(batch_id))
+    return response
+
+
+@application.route('/batch_search', methods=['POST'])
+def batch_search() -> Union[Response, Tuple]:
+    if 'file' in request.files:
+        params = request.form
+        try:
+            queries = process_archive(request, MAX_BATCH_QUERIES, WORKER_POOL)
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 400
+    else:
+        params = request.get_json(silent=True) or {}
+        chain_ids = params.get('chains', [])
+        if not isinstance(chain_ids, list) or not all(isinstance(chain_id, str) and
+                                                      re.match('^[a-z0-9]{4}:[a-z0-9]+$', chain_id, re.IGNORECASE)
+                                                      for chain_id in chain_ids):
+            return jsonify({'error': 'Incorrect list of chains.'}), 400
+        queries = [([chain_id], chain_id) for chain_id in dict.fromkeys(f'{chain_id[:4].upper()}{chain_id[4:]}'
+                                                                               for chain_id in chain_ids)]
+
+    if not queries:
+        return jsonify({'error': 'No queries given.'}), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return jsonify({'error': f'At most {MAX_BATCH_QUERIES} queries are allowed in a batch.'}), 400
+
+    try:
+        # JSON values may be lists or objects too
+        qscore = float(params.get('qscore_range', 0.5))
+        num_results = int(params.get('num_results', 30))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Incorrect search parameters.'}), 400
+    if not 0 <= qscore <= 1:
+        return jsonify({'error': 'Q-score threshold must be between 0 and 1.'}), 400
+    if num_results < 1:
+        return jsonify({'error': 'The number of results must be positive.'}), 400
+    radius = 1 - qscore
+
+    return start_batch(queries, radius, min(num_results, MAX_NUM_RESULTS))
+
+
+@application.route('/search_entry/<string:job_id>', methods=['POST'])
+def search_entry(job_id: str) -> Union[Response, Tuple]:
+    if not Path(config['dirs']['computations'], f'query{job_id}').exists():
+        return jsonify({'error': 'job_id not found'}), 404
+
+    name: str = request.form['input_name']
+    chains = get_job_chains(job_id)
+    selected = request.form.getlist('chain')
+    if selected:
+        if not set(selected) <= set(chains):
+            return jsonify({'error': 'Unknown chain selected.'}), 400
+        chains = [chain for chain in chains if chain in selected]
+
+    try:
+        radius = 1 - float(request.form['qscore_range'])
+        num_results = int(request.form['num_results'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Incorrect search parameters.'}), 400
+    if num_results < 1:
+        return jsonify({'error': 'The number of results must be positive.'}), 400
+
+    queries = []
+    for group in group_identical_chains(job_id, chains):
+        if request.form['uploaded'] == 'True':
+            query = f'_{job_id}:{group[0]}'
+        else:
+            query = f'{name}:{group[0]}'
+        queries.append(([f'{name}:{chain}' for chain in group], query))
+
+    log('entry_search_started', name=name, chains=len(chains), unique=len(queries))
+    return start_batch(queries, radius, min(num_results, MAX_NUM_RESULTS))
+
+
+@application.route('/trace/<string:job_id>')
+def trace(job_id: str):
+    if not Path(config['dirs']['computations'], f'query{job_id}').exists():
+        abort(404)
+
+    spans = load_trace(job_id)
+    if request.args.get('format') == 'json':
+        return jsonify(spans)
+
+    return render_template('trace.html', job_id=job_id, spans=spans)
+
+
+@application.route('/metrics')
+def metrics() -> Response:
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
 @application.errorhandler(404)
 def not_found(e):
     return render_template('404.html'), 404
@@ -0,0 +1,110 @@
+import logging
+import time
+import numpy as np
+from pathlib import Path
+from typing import List, Tuple, Dict
+
+import python_distance
+from .chain_store import CHAIN_STORE
+from .config import config
+from .logs import log
+
+
+# Number of set bits for every byte value, used when numpy lacks bitwise_count (numpy < 2.0)
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class SketchIndex:
+    """Binary sketches of all indexed chains stored as a packed bit matrix.
+
+    The index directory (created by utils/build_sketches.py) contains:
+      sketches.npy   -- uint8 matrix (chains x bytes) of packed sketch bits, rows sorted by chain name
+      names.npy      -- gesamtIds of the chains, sorted
+      pivots.npy     -- gesamtIds of the pivots, one pivot per sketch bit
+      thresholds.npy -- ball radius of each pivot; a bit is set when the chain lies inside the ball
+    """
+
+    def __init__(self, directory: str):
+        directory = Path(directory)
+        self.sketches = np.load(directory / 'sketches.npy', mmap_mode='r')
+        self.names = np.load(directory / 'names.npy')
+        self.pivots = [str(pivot) for pivot in np.load(directory / 'pivots.npy')]
+        self.thresholds = np.load(directory / 'thresholds.npy')
+
+    def lookup(self, chain_id: str) -> np.ndarray:
+        idx = np.searchsorted(self.names, chain_id)
+        if idx < len(self.names) and self.names[idx] == chain_id:
+            return np.asarray(self.sketches[idx])
+        raise KeyError(chain_id)
+
+    def compute(self, chain_id: str) -> np.ndarray:
+        distances = np.empty(len(self.pivots))
+        for i, pivot in enumerate(self.pivots):
+            _, qscore, *_ = python_distance.get_results(chain_id, pivot, CHAIN_STORE.archive_for((chain_id, pivot)),
+                                                        0.0)
+            distances[i] = 1 - qscore
+        return np.packbits(distances <= self.thresholds)
+
+    def hamming(self, sketch: np.ndarray) -> np.ndarray:
+        xored = np.bitwise_xor(self.sketches, sketch)
+        if hasattr(np, 'bitwise_count'):
+            return np.bitwise_count(xored).sum(axis=1, dtype=np.uint32)
+        return POPCOUNT_TABLE[xored].sum(axis=1, dtype=np.uint32)
+
+    def nearest(self, sketch: np.ndarray, k: int) -> List[str]:
+        distances = self.hamming(sketch)
+        k = min(k, len(distances))
+        if k <= 0:
+            return []
+        candidates = np.argpartition(distances, k - 1)[:k]
+        candidates = candidates[np.argsort(distances[candidates], kind='stable')]
+        return [str(name) for name in self.names[candidates]]
+
+
+_indexes: Dict[str, SketchIndex] = {}
+
+
+def get_index(phase: str) -> SketchIndex:
+    directory = config['sketches'][phase]
+    if directory not in _indexes:
+        _indexes[directory] = SketchIndex(directory)
+    return _indexes[directory]
+
+
+def get_results_local(query: str, num_results: int, phase: str) -> Tuple[List[str], Dict[str, int]]:
+    """The num_results chains with sketches nearest to the query.
+
+    Unlike MESSIF, the sketches_large phase does not refine the candidates by their Q-score distance, so it ignores
+    the radius and may return chains beyond it. Measuring that distance is an alignment of the pair, which the search
+    runs for every candidate anyway with 1 - radius as min_qscore, so such chains never reach the results. They only
+    cost alignments MESSIF would spare, and queued ones are cancelled once the full phase does not return them.
+    """
+    try:
+        index = get_index(phase)
+    except (KeyError, OSError) as e:
+        log('sketch_index_not_available', logging.ERROR, phase=phase, error=str(e))
+        raise RuntimeError('Sketch index not available')
+
+    begin = time.time()
+    try:
+        sketch = index.lookup(query)
+        cached = len(index.pivots)
+    except KeyError:
+        sketch = index.compute(query)
+        cached = 0
+    pivot_time = int((time.time() - begin) * 1000)
+
+    begin = time.time()
+    chain_ids = index.nearest(sketch, num_results)
+    search_time = int((time.time() - begin) * 1000)
+
+    statistics = {
+        'pivotDistCountTotal': len(index.pivots),
+        'pivotDistCountCached': cached,
+        'pivotTime': pivot_time,
+        'searchDistCountTotal': 0,
+        'searchDistCountCached': 0,
+        'searchTime': search_time,
+    }
+
+    return chain_ids, statistics
@@ -20,6 +20,32 @@ function format_time(time_in_ms) {
 }
 
 
+function wait_for_upload(job_id) {
+    let $chain = $('#chain');
+    let $run = $('#run');
+    let $parsing_status = $('#parsing_status');
+
+    $run.prop('disabled', true);
+    $.ajax({
+        url: `/upload_status/${job_id}`,
+        success: function (data) {
+            if (data['status'] === 'READY') {
+                for (const [chain, size] of data['chains']) {
+                    $chain.append(`<option value="${chain}" data-subtext="(size: ${size})">${chain}</option>`);
+                }
+                $chain.selectpicker('refresh');
+                $parsing_status.html('');
+                $run.prop('disabled', false);
+            } else if (data['status'] === 'ERROR') {
+                $parsing_status.html(`<span class="text-danger">${data['error_message']}</span>`);
+            } else {
+                setTimeout(wait_for_upload, 1000, job_id);
+            }
+        }
+    })
+}
+
+
 function init_index() {
     let $file = $('#file');
     let $upload = $('#upload');
@@ -30,6 +56,11 @@ function init_index() {
     let $search_input = $('#search_phrase');
     let $search_pdb = $('#search_pdb');
     let $status = $('#status');
+    let $parsing = $('#parsing');
+
+    if ($parsing.length) {
+        wait_for_upload($parsing.val());
+    }
 
     $search_input.on('keypress', function (event) {
         if (event.keyCode === 13 && $search_input.val().length > 2) {
@@ -179,34 +210,106 @@ function init_results() {
         alignment_classes = 'text-end';
     }
 
+    const visualizations_disabled = $disable_visualizations.val() === 'true';
+
+    function render_number(value, type, row) {
+        if (type !== 'display') {
+            return value === null ? -1 : value;
+        }
+        return row['qscore'] === -1 ? '?' : value.toFixed(3);
+    }
+
+    function render_alignment(obj, type, row) {
+        if (row['qscore'] === -1) {
+            if (visualizations_disabled) {
+                return '?';
+            }
+            return `<img src="/static/empty.png" alt="Alignment thumbnail of ${obj}">`;
+        }
+        if (visualizations_disabled) {
+            return `<a href="/details/${job_id}/${obj}" target="_blank">Show 3D visualization</a>`;
+        }
+        return `<a href="/details/${job_id}/${obj}" target="_blank">
+                    <div class="zoom-text">Show 3D visualization</div>
+                    <img src="/get_image/${job_id}/${obj}" alt="Alignment thumbnail of ${obj}">
+                </a>`;
+    }
+
     let resultsTable = $('#table').DataTable({
         columns: [
-            {title: 'No.', width: '80px'},
-            {title: 'Chain ID', width: '80px'},
-            {title: 'Protein (link to PDBe)'},
-            {title: 'Q-score', width: '70px', className: 'text-end'},
-            {title: 'RMSD', width: '70px', className: 'text-end'},
-            {title: 'Aligned res.', width: '90px', className: 'text-end'},
-            {title: 'Seq. identity', width: '100px', className: 'text-end'},
+            {title: 'No.', width: '80px', data: null, orderable: false, defaultContent: ''},
+            {
+                title: 'Chain ID', width: '80px', data: 'object',
+                render: (obj, type) => type !== 'display' ? obj :
+                    `<div>${obj}</div><div class="mt-1" style="max-width: 75px">
+                     <a href="/find_similar/${job_id}/${obj}">Find similar to this</a></div>`
+            },
+            {
+                title: 'Protein (link to PDBe)', data: 'object',
+                render: function (obj) {
+                    const pdbid = obj.split(':')[0];
+                    const name = localStorage.getItem(pdbid) === null ? '?' : localStorage.getItem(pdbid);
+                    return `<a href="https://www.ebi.ac.uk/pdbe/entry/pdb/${pdbid}" target="_blank" rel="noreferrer">
+                                <div class="name_${pdbid}" style="max-width: 900px">${name}</div>
+                            </a>`;
+                }
+            },
+            {title: 'Q-score', width: '70px', className: 'text-end', data: 'qscore', render: render_number},
+            {title: 'RMSD', width: '70px', className: 'text-end', data: 'rmsd', render: render_number},
+            {
+                title: 'Aligned res.', width: '90px', className: 'text-end', data: 'aligned',
+                render: (value, type, row) => type !== 'display' ? (value === null ? -1 : value) :
+                    (row['qscore'] === -1 ? '?' : value)
+            },
+            {title: 'Seq. identity', width: '100px', className: 'text-end', data: 'seq_id', render: render_number},
             {
                 title: 'Alignment',
+                data: 'object',
+                render: render_alignment,
                 'searchable': false,
                 'orderable': false,
                 width: '100px',
                 className: alignment_classes
             },
         ],
+        order: [[3, 'desc']],
+        rowId: 'object',
         searching: false,
-        paging: false,
+        paging: true,
+        pageLength: 50,
+        // Rows (and their thumbnails) are rendered only when their page is shown
+        deferRender: true,
         scrollCollapse: true,
         scrollResize: true,
         scrollY: 100,
         info: false,
         language: {
             emptyTable: 'Searching... No similar protein chains found yet.'
+        },
+        drawCallback: function () {
+            const api = this.api();
+            const start = api.page.info().start;
+            api.column(0, {page: 'current'}).nodes().each(function (cell, i) {
+                cell.innerHTML = start + i + 1;
+            });
         }
     });
 
+    let shown_objects = new Set();
+
+    function fetch_missing_titles(rows) {
+        let no_titles = []
+        for (const res of rows) {
+            const pdbid = res['object'].split(':')[0];
+            if (localStorage.getItem(pdbid) === null) {
+                no_titles.push(pdbid);
+            }
+        }
+        if (no_titles.length) {
+            fetch_titles(no_titles);
+        }
+    }
+
     $(window).bind('beforeunload', function () {
         // Modern browsers ignore this message
         return 'Computation is still running, do you want to leave the page and end the search?'
@@ -218,6 +321,7 @@ function init_results() {
 
     let $save_query = $('#save_query');
     let $download_results = $('#download_results');
+    let $export_results = $('#export_results');
     let $stop_search = $('#stop_search');
     let $stop_search_div = $('#stop_search_div');
     let $back = $('#back');
@@ -229,6 +333,9 @@ function init_results() {
     $back.toggle(false);
     $save_query.toggle(false);
     $download_results.toggle(false);
+    if (window.location.pathname.startsWith('/results')) {
+        $export_results.toggle(false);
+    }
 
     $save_query.on('click', function () {
         $.ajax({
@@ -273,10 +380,13 @@ function init_results() {
         if (data['status'] === 'FINISHED') {
             $save_query.toggle(true);
             $download_results.toggle(true);
+            $export_results.toggle(true);
             $('#total_time').html(`Total time: ${format_time(data['total_time'])}`);
             $('.dataTables_empty').html('No similar protein chains found in the database.')
-            $('#results_number').html(`(${data['chain_ids'].length} results)`);
+            const chain_count = data.hasOwnProperty('chain_count') ? data['chain_count'] : data['chain_ids'].length;
+            $('#results_number').html(`(${chain_count} results)`);
         } else if (data['status'] === 'ABORTED') {
+            $('#queue_position').html('');
             let $running = $('#running');
             if ($running.length) {
                 $running.removeClass(['spinner-border', 'spinner-border-sm']);
@@ -286,6 +396,12 @@ function init_results() {
             return;
         }
 
+        if (data['status'] === 'QUEUED') {
+            $('#queue_position').html(`Server is busy, the search is waiting in a queue (position ${data['queue_position']}).`);
+        } else {
+            $('#queue_position').html('');
+        }
+
         for (const phase of ['sketches_small', 'sketches_large', 'full']) {
             const status = data[`${phase}_status`];
             let row_data = [`<b>${PHASE_NAMES[phase]}</b>`];
@@ -357,66 +473,34 @@ function init_results() {
 
         statusTable.columns.adjust().draw();
 
-        // No change in statistics -> skip the rest
-        if (!data.hasOwnProperty('statistics')) {
-            return;
-        }
-
-        resultsTable.clear().draw();
-
-        // Get title of proteins
-        let no_titles = []
-        for (const res of data['statistics']) {
-            const pdbid = res['object'].split(':')[0];
-            if (localStorage.getItem(pdbid) === null) {
-                no_titles.push(pdbid);
-            }
-        }
-        if (no_titles.length) {
-            fetch_titles(no_titles);
-        }
-
-        let idx = 0;
-        for (const res of data['statistics']) {
-            const pdbid = res['object'].split(':')[0];
-            let name = localStorage.getItem(pdbid) === null ? '?' : localStorage.getItem(pdbid);
-
-            let qscore = '?';
-            let rmsd = '?';
-            let aligned = '?';
-            let seq_id = '?';
-            let link = `<img src="/static/empty.png" alt="Alignment thumbnail of ${res['object']}">`;
-            if ($disable_visualizations.val() === 'true') {
-                link = '?';
+        if (data.hasOwnProperty('statistics')) {
+            resultsTable.clear();
+            resultsTable.rows.add(data['statistics']);
+            shown_objects = new Set(data['statistics'].map(res => res['object']));
+            fetch_missing_titles(data['statistics']);
+        } else if (data.hasOwnProperty('statistics_diff')) {
+            // Rows are looked up only when present, unknown '#id' selectors would fall back to jQuery
+            const diff = data['statistics_diff'];
+            for (const obj of diff['removed']) {
+                if (shown_objects.delete(obj)) {
+                    resultsTable.row(`#${obj}`).remove();
+                }
             }
-
-            if (res['qscore'] !== -1) {
-                qscore = res['qscore'].toFixed(3);
-                rmsd = res['rmsd'].toFixed(3);
-                aligned = res['aligned'];
-                seq_id = res['seq_id'].toFixed(3);
-
-                if ($disable_visualizations.val() === 'true') {
-                    link = `<a href="/details/${job_id}/${res['object']}" target="_blank">
-                                Show 3D visualization</a>`;
+            for (const res of diff['updated']) {
+                if (shown_objects.has(res['object'])) {
+                    resultsTable.row(`#${res['object']}`).data(res);
                 } else {
-                    link = `<a href="/details/${job_id}/${res['object']}" target="_blank">
-                                <div class="zoom-text">Show 3D visualization</div>
-                                <img src="/get_image/${job_id}/${res['object']}"
-                                     alt="Alignment thumbnail of ${res['object']}">
-                                </a>`;
+                    resultsTable.row.add(res);
+                    shown_objects.add(res['object']);
                 }
             }
-
-            const data = [idx + 1, `<div>${res['object']}</div><div class="mt-1" style="max-width: 75px"><a href="/find_similar/${job_id}/${res['object']}">Find similar to this</a></div>`,
-                `<a href="https://www.ebi.ac.uk/pdbe/entry/pdb/${pdbid}" target="_blank" rel="noreferrer">
-                            <div class="name_${pdbid}" style="max-width: 900px">${name}</div>
-                        </a>`, qscore, rmsd, aligned, seq_id, link];
-
-            resultsTable.row.add(data).node().id = res['object'];
-            idx++;
+            fetch_missing_titles(diff['updated']);
+        } else {
+            // No change in statistics -> skip the rest
+            return;
         }
-        resultsTable.columns.adjust().draw();
+
+        resultsTable.columns.adjust().draw(false);
     }
 
     const eventSource = new EventSource(`/get_results_stream/${job_id}`);
@@ -0,0 +1,185 @@
+"""Disk usage of the computations directory: per-job sizes, retention and a quota enforced by LRU eviction.
+
+Job directories (query<job_id>) and entries of the query cache are removed when unused for longer than the
+retention, or earlier, least recently used first, when the directory grows over the quota. Saved queries are kept
+until they are deleted from savedQueries (utils/remove_old.py), directories used by running searches always.
+"""
+import logging
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .computation import DBConnection, get_upload_cache_dir
+from .config import config
+from .logs import log
+from .metrics import STORAGE_ENTRIES, STORAGE_EVICTED, STORAGE_PURGED_BYTES, STORAGE_QUOTA_BYTES, STORAGE_USED_BYTES
+
+JOB_PREFIX = 'query'
+SCAN_INTERVAL = 5 * 60
+# Directories used recently (uploads being parsed, users choosing a chain) are never removed
+MIN_IDLE = 3600
+# Eviction stops below this fraction of the quota
+LOW_WATERMARK = 0.9
+
+
+def get_size(directory: Path) -> Tuple[int, bool]:
+    """Allocated size of the files in the (flat) directory and whether some of them are linked from elsewhere.
+
+    Files of the query cache are hard-linked into job directories, each link counts its share of the size.
+    """
+    size = 0
+    shared = False
+    with os.scandir(directory) as it:
+        for entry in it:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue  # removed meanwhile
+            size += stat.st_blocks * 512 // stat.st_nlink
+            shared |= entry.is_file(follow_symlinks=False) and stat.st_nlink > 1
+    return size, shared
+
+
+def purge_artifacts(job_id: str, keep: Iterable[str]) -> int:
+    """Removes aligned structures and images of chains not in keep, returns the number of freed bytes."""
+    keep = set(keep)
+    freed = 0
+    directory = Path(config['dirs']['computations'], f'{JOB_PREFIX}{job_id}')
+    for pattern in ('*.aligned.pdb', '*.aligned.png'):
+        for path in directory.glob(pattern):
+            if path.name[:-len('.aligned.pdb')] in keep:
+                continue
+            try:
+                freed += path.stat().st_blocks * 512
+                path.unlink()
+            except OSError:
+                pass
+    STORAGE_PURGED_BYTES.inc(freed)
+    return freed
+
+
+class StorageManager:
+    def __init__(self, root: Path, upload_cache: Path, quota: int, retention: float):
+        self.root = root
+        self.upload_cache = upload_cache
+        self.quota = quota
+        self.retention = retention
+        self.lock = threading.Lock()
+        # Path of a directory -> (its mtime when measured, size, shared)
+        self.sizes: Dict[Path, Tuple[float, int, bool]] = {}
+        self.accessed: Dict[str, float] = {}
+        self.pinned: Dict[str, int] = {}
+        self.thread: Optional[threading.Thread] = None
+
+    def touch(self, job_id: str) -> None:
+        with self.lock:
+            self.accessed[job_id] = time.time()
+
+    def pin(self, job_ids: Iterable[str]) -> None:
+        with self.lock:
+            for job_id in job_ids:
+                self.pinned[job_id] = self.pinned.get(job_id, 0) + 1
+
+    def unpin(self, job_ids: Iterable[str]) -> None:
+        with self.lock:
+            for job_id in job_ids:
+                self.pinned[job_id] -= 1
+                if not self.pinned[job_id]:
+                    del self.pinned[job_id]
+                self.accessed[job_id] = time.time()
+
+    def start(self) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='storage-janitor', daemon=True)
+            self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.collect()
+            except Exception as e:
+                log('storage_collection_failed', logging.ERROR, error=str(e))
+            time.sleep(SCAN_INTERVAL)
+
+    def scan(self) -> List[Tuple[Path, Optional[str], float, int, bool]]:
+        """(directory, job_id or None for query cache entries, last use, size, shared) of all removable directories."""
+        directories = [(path, path.name[len(JOB_PREFIX):]) for path in self.root.iterdir()
+                       if path.name.startswith(JOB_PREFIX) and path.is_dir()]
+        if self.upload_cache.is_dir():
+            directories += [(path, None) for path in self.upload_cache.iterdir() if path.is_dir()]
+
+        entries = []
+        sizes = {}
+        for path, job_id in directories:
+            try:
+                mtime = path.stat().st_mtime
+                with self.lock:
+                    last_used = max(mtime, self.accessed.get(job_id, 0)) if job_id is not None else mtime
+                    active = job_id in self.pinned
+                cached = self.sizes.get(path)
+                # Files are only added to and removed from the directories, running jobs are measured every time.
+                # Links to the query cache come and go with the job directories, cache entries are measured always.
+                if cached is not None and cached[0] == mtime and not active and job_id is not None:
+                    size, shared = cached[1:]
+                else:
+                    size, shared = get_size(path)
+            except OSError:
+                continue  # removed meanwhile
+            sizes[path] = (mtime, size, shared)
+            entries.append((path, job_id, last_used, size, shared))
+        self.sizes = sizes
+        return entries
+
+    def collect(self) -> None:
+        entries = self.scan()
+        with DBConnection() as db:
+            db.c.execute('SELECT job_id FROM savedQueries')
+            saved: Set[str] = {row[0] for row in db.c.fetchall()}
+
+        now = time.time()
+        used = sum(entry[3] for entry in entries)
+        with self.lock:
+            pinned = set(self.pinned)
+        # Query cache entries linked from job directories would not free any space
+        removable = sorted((entry for entry in entries
+                            if entry[1] not in saved and entry[1] not in pinned and now - entry[2] > MIN_IDLE
+                            and not (entry[1] is None and entry[4])),
+                           key=lambda entry: entry[2])
+
+        over_quota = used > self.quota
+        freed = 0
+        evicted = set()
+        for path, job_id, last_used, size, _ in removable:
+            if now - last_used > self.retention:
+                reason = 'expired'
+            elif over_quota and used - freed > self.quota * LOW_WATERMARK:
+                reason = 'quota'
+            else:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            self.sizes.pop(path, None)
+            evicted.add(path)
+            freed += size
+            STORAGE_EVICTED.inc(label_value=reason)
+            log('storage_evicted', logging.DEBUG, path=str(path), reason=reason, size=size)
+
+        remaining = [entry for entry in entries if entry[0] not in evicted]
+        with self.lock:
+            existing = {entry[1] for entry in remaining}
+            self.accessed = {job_id: t for job_id, t in self.accessed.items() if job_id in existing}
+
+        STORAGE_USED_BYTES.set(used - freed)
+        STORAGE_QUOTA_BYTES.set(self.quota)
+        STORAGE_ENTRIES.set(sum(1 for entry in remaining if entry[1] is not None), label_value='job')
+        STORAGE_ENTRIES.set(sum(1 for entry in remaining if entry[1] is None), label_value='upload_cache')
+        if over_quota and used - freed > self.quota:
+            log('storage_over_quota', logging.WARNING, used=used - freed, quota=self.quota)
+        log('storage_collected', logging.DEBUG, used=used - freed, freed=freed, entries=len(remaining))
+
+
+STORAGE = StorageManager(Path(config['dirs']['computations']), get_upload_cache_dir(),
+                         int(config.getfloat('storage', 'quota_gb', fallback=50) * 2 ** 30),
+                         config.getfloat('storage', 'retention_hours', fallback=24) * 3600)
@@ -0,0 +1,146 @@
+"""Aligned structures of the hits superposed in the app processes with NumPy.
+
+python_distance.prepare_PDB parses the raw mmCIF of a hit for every alignment. Here the ATOM records of a PDB entry
+are parsed with gemmi once and saved to the query cache (atoms.npz in an entry named by the version of the raw file,
+like the indexed entries), the processes keep the recently used entries in memory. Superposition is then a single
+matrix product of the homogeneous coordinates with the transform T of the alignment and formatting of the PDB lines,
+a few milliseconds for a typical chain. gemmi is optional, without it (or with [superpose] enabled = false) the aligned
+structures are written by python_distance as before.
+"""
+import functools
+import importlib.util
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+
+from .computation import get_upload_cache_dir
+from .config import config
+from .logs import log
+from .metrics import COORDINATE_CACHE
+
+# Parsed PDB entries kept by each process
+ENTRY_CACHE_SIZE = 128
+
+# Atoms of a chain: %-format of its PDB lines taking the coordinates, coordinates
+ChainAtoms = Tuple[str, np.ndarray]
+
+
+def superpose_available() -> bool:
+    # gemmi is imported by the first parsed entry, not by the processes only serving cached files
+    return config.getboolean('superpose', 'enabled', fallback=True) and importlib.util.find_spec('gemmi') is not None
+
+
+def pdb_prefix(serial: int, atom, residue, chain_name: str) -> str:
+    # Names of atoms of one-letter elements start in column 14 unless they have four characters
+    name = f' {atom.name:<3}' if len(atom.name) < 4 and len(atom.element.name) == 1 else f'{atom.name:<4}'
+    # Two-character chain names take column 21 too (like gemmi), longer ones are cut
+    return (f'ATOM  {serial % 100000:5d} {name}{atom.altloc if atom.altloc != chr(0) else " "}{residue.name:>3}'
+            f'{chain_name[-2:]:>2}{residue.seqid.num % 10000:4d}{residue.seqid.icode}   ')
+
+
+def pdb_suffix(atom) -> str:
+    charge = f'{abs(atom.charge)}{"+" if atom.charge > 0 else "-"}' if atom.charge else '  '
+    return f'{atom.occ:6.2f}{atom.b_iso:6.2f}          {atom.element.name.upper():>2}{charge}'
+
+
+def parse_entry(raw_file: Path) -> Dict[str, np.ndarray]:
+    """Arrays of the ATOM records of the first model, grouped by chains."""
+    import gemmi
+
+    structure = gemmi.read_structure(str(raw_file))
+    names, offsets, prefixes, coordinates, suffixes = [], [0], [], [], []
+    for chain in structure[0]:
+        serial = 0
+        for residue in chain:
+            if residue.het_flag != 'A':
+                continue
+            for atom in residue:
+                serial += 1
+                prefixes.append(pdb_prefix(serial, atom, residue, chain.name))
+                coordinates.append((atom.pos.x, atom.pos.y, atom.pos.z))
+                suffixes.append(pdb_suffix(atom))
+        if serial:
+            names.append(chain.name)
+            offsets.append(len(prefixes))
+    return {'chains': np.array(names, dtype=str), 'offsets': np.array(offsets, dtype=np.int64),
+            'prefixes': np.array(prefixes, dtype='S30'), 'suffixes': np.array(suffixes, dtype='S26'),
+            'coordinates': np.array(coordinates, dtype=np.float64).reshape(-1, 3)}
+
+
+def get_raw_file(pdb_id: str) -> Path:
+    return Path(config['dirs']['raw_pdbs'], pdb_id[1:3].lower(), f'{pdb_id.lower()}.cif')
+
+
+def get_entry_arrays(pdb_id: str, version: str) -> Dict[str, np.ndarray]:
+    entry = Path(get_upload_cache_dir(), f'atoms_{pdb_id}_{version}')
+    path = Path(entry, 'atoms.npz')
+    try:
+        with np.load(path) as arrays:
+            COORDINATE_CACHE.inc(label_value='hit')
+            os.utime(entry)
+            return dict(arrays)
+    except FileNotFoundError:
+        COORDINATE_CACHE.inc(label_value='miss')
+
+    arrays = parse_entry(get_raw_file(pdb_id))
+    try:
+        entry.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='tmp', dir=entry)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+    except OSError as e:
+        # Parsed again next time
+        log('atoms_cache_failed', logging.WARNING, pdb_id=pdb_id, error=str(e))
+    return arrays
+
+
+@functools.lru_cache(maxsize=ENTRY_CACHE_SIZE)
+def load_entry(pdb_id: str, version: str) -> Dict[str, ChainAtoms]:
+    arrays = get_entry_arrays(pdb_id, version)
+    # Parts of the lines before (columns 1-30) and after (55-80) the coordinates
+    prefixes = np.char.decode(arrays['prefixes']).tolist()
+    suffixes = np.char.decode(arrays['suffixes']).tolist()
+    lines = [f'{prefix.replace("%", "%%")}%8.3f%8.3f%8.3f{suffix.replace("%", "%%")}\n'
+             for prefix, suffix in zip(prefixes, suffixes)]
+    offsets = arrays['offsets']
+    return {name: (''.join(lines[begin:end]), arrays['coordinates'][begin:end])
+            for name, begin, end in zip(arrays['chains'].tolist(), offsets[:-1], offsets[1:])}
+
+
+def get_chain_atoms(chain_id: str) -> ChainAtoms:
+    pdb_id, chain = chain_id.split(':')
+    raw_file = get_raw_file(pdb_id)
+    # The raw file is replaced whenever the entry is updated in the archive
+    stat = raw_file.stat()
+    chains = load_entry(pdb_id, f'{stat.st_size}_{stat.st_mtime_ns}')
+    if chain not in chains:
+        raise ValueError(f'Chain {chain_id} has no atoms in {raw_file}')
+    return chains[chain]
+
+
+def transform(coordinates: np.ndarray, T: Sequence[float]) -> np.ndarray:
+    """Coordinates transformed by the row-major 4x4 matrix T of python_distance.get_results()."""
+    homogeneous = np.empty((len(coordinates), 4))
+    homogeneous[:, :3] = coordinates
+    homogeneous[:, 3] = 1
+    return (homogeneous @ np.asarray(T, dtype=np.float64).reshape(4, 4).T)[:, :3]
+
+
+def aligned_pdb(chain_id: str, T: Sequence[float]) -> str:
+    """PDB file of the chain superposed onto the query."""
+    lines, coordinates = get_chain_atoms(chain_id)
+    # One formatting of all lines is faster than formatting them one by one
+    return lines % tuple(transform(coordinates, T).ravel().tolist()) + 'TER\nEND\n'
+
+
+def write_aligned_pdb(chain_id: str, T: Sequence[float], directory: Path) -> Path:
+    """Writes {chain_id}.aligned.pdb to the directory, like python_distance.prepare_PDB."""
+    path = Path(directory, f'{chain_id}.aligned.pdb')
+    path.with_suffix('.tmp').write_text(aligned_pdb(chain_id, T))
+    os.replace(path.with_suffix('.tmp'), path)
+    return path
@@ -0,0 +1,66 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional
+
+from .config import config
+
+TRACE_FILE = 'trace.jsonl'
+
+_local = threading.local()
+
+
+def get_trace_path(job_id: str) -> Path:
+    return Path(config['dirs']['computations'], f'query{job_id}', TRACE_FILE)
+
+
+def record_span(job_id: str, name: str, start: float, end: float, parent: Optional[str], **attrs) -> None:
+    span = {'name': name, 'start': start, 'end': end, 'parent': parent, 'pid': os.getpid(), **attrs}
+    try:
+        # Single appended line per span, so spans from the web process and workers do not interleave
+        with open(get_trace_path(job_id), 'a') as f:
+            f.write(json.dumps(span, default=str) + '\n')
+    except OSError:
+        pass  # job directory already removed or job without directory (batch searches)
+
+
+@contextmanager
+def span(job_id: Optional[str], name: str, **attrs):
+    if job_id is None:
+        yield
+        return
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    parent = stack[-1] if stack else None
+    stack.append(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        stack.pop()
+        record_span(job_id, name, start, time.time(), parent, **attrs)
+
+
+def load_trace(job_id: str) -> List[dict]:
+    try:
+        with open(get_trace_path(job_id)) as f:
+            spans = [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+    if not spans:
+        return spans
+
+    begin = min(s['start'] for s in spans)
+    total = max(max(s['end'] for s in spans) - begin, 1e-6)
+    for s in sorted(spans, key=lambda x: x['start']):
+        s['offset_ms'] = int((s['start'] - begin) * 1000)
+        s['duration_ms'] = int((s['end'] - s['start']) * 1000)
+        s['left'] = round(100 * (s['start'] - begin) / total, 2)
+        s['width'] = max(round(100 * (s['end'] - s['start']) / total, 2), 0.1)
+    return sorted(spans, key=lambda x: x['start'])
@@ -0,0 +1,60 @@
+import logging
+import multiprocessing
+from multiprocessing.managers import DictProxy, SyncManager
+from typing import Optional
+from flask import Flask
+
+from .config import config
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+
+application = Flask(__name__)
+
+application.jinja_env.trim_blocks = True
+application.jinja_env.lstrip_blocks = True
+
+
+class StateManager(SyncManager):
+    """Manager serving the job states on a TCP address, so that separate servers (the search and stream pools of
+    gunicorn.conf.py) share them."""
+
+
+_computation_results = {}
+StateManager.register('computation_results', callable=lambda: _computation_results, proxytype=DictProxy)
+
+
+def start_manager() -> Optional[StateManager]:
+    """Manager of the shared job states, None if the states stay in this process (one server process)."""
+    address = config.get('server', 'state_address', fallback=None)
+    if address is None:
+        return None
+
+    host, port = address.rsplit(':', 1)
+    # Proxies of the per-job dicts are passed between the servers and authenticate with the key of the process
+    authkey = config['server']['state_authkey'].encode()
+    multiprocessing.current_process().authkey = authkey
+    manager = StateManager((host, int(port)), authkey)
+    try:
+        manager.connect()
+    except ConnectionRefusedError:
+        # The first server started serves the state, another one may have bound the address meanwhile
+        try:
+            manager.start()
+        except EOFError:
+            manager.connect()
+    return manager
+
+
+def new_job_data(job_data: dict) -> dict:
+    """Job data to be stored in computation_results, shared with the other server processes if needed."""
+    return application.mp_manager.dict(job_data) if application.mp_manager is not None else job_data
+
+
+# Threads of the server process are the only users of the job states, unless they are shared through the manager
+application.mp_manager = start_manager()
+application.db_stats = {}
+application.computation_results = application.mp_manager.computation_results() \
+    if application.mp_manager is not None else {}
+
+application.secret_key = 'protein search secret key'
@@ -0,0 +1,67 @@
+"""Deployment of the app with gunicorn as two pools of workers behind a reverse proxy
+(docker/ProteinSearch-gunicorn.conf):
+
+  search -- threaded workers serving everything but the result streams. The searches run here, in threads of the
+            worker and in its process pools. Admission control, storage pins and job monitors are per process, so keep
+            one worker (the default) and raise the threads instead.
+  stream -- gevent workers serving only /get_results_stream, each holds thousands of idle SSE connections.
+
+Both are started from the directory containing the app and share the job states through the manager at
+[server] state_address (see utils/protein_search.ini.example):
+
+    PROTEIN_SEARCH_POOL=search gunicorn -c gunicorn.conf.py app:application
+    PROTEIN_SEARCH_POOL=stream gunicorn -c gunicorn.conf.py app:application
+
+The app (numpy, gemmi, python_distance, the id maps) is loaded once in the master and the workers share its pages.
+A reload (kill -HUP <master>) starts new workers with the loaded code and a changed config; old search workers finish
+their running searches first, streams reconnect to the new workers. Code updates need a restart of both pools.
+"""
+import configparser
+import multiprocessing
+import os
+
+pool = os.environ.setdefault('PROTEIN_SEARCH_POOL', 'search')
+if pool not in ('search', 'stream'):
+    raise ValueError(f'Unknown PROTEIN_SEARCH_POOL {pool}, expected search or stream')
+
+server_config = configparser.ConfigParser()
+server_config.read(os.environ.get('PROTEIN_SEARCH_CONFIG', '../protein_search.ini'))
+server_settings = server_config['server'] if server_config.has_section('server') else {}
+
+preload_app = True
+wsgi_app = 'app:application'
+# Workers must not be killed while waiting for MESSIF or streaming
+timeout = int(server_settings.get('timeout', 120))
+accesslog = '-'
+
+if pool == 'search':
+    bind = server_settings.get('search_bind', '127.0.0.1:8001')
+    worker_class = 'gthread'
+    workers = int(server_settings.get('search_workers', 1))
+    threads = int(server_settings.get('search_threads', 32))
+    # Running searches are finished before an old worker exits, up to the job deadline
+    graceful_timeout = int(server_settings.get('search_graceful_timeout', 30 * 60))
+else:
+    # Patched before the app is loaded, so that it uses cooperative sockets and locks from the start
+    from gevent import monkey
+    monkey.patch_all()
+
+    bind = server_settings.get('stream_bind', '127.0.0.1:8002')
+    worker_class = 'gevent'
+    workers = int(server_settings.get('stream_workers', multiprocessing.cpu_count()))
+    worker_connections = int(server_settings.get('stream_connections', 1000))
+    graceful_timeout = int(server_settings.get('stream_graceful_timeout', 10))
+
+
+def post_worker_init(worker):
+    if pool == 'search':
+        from app.chain_store import CHAIN_STORE
+        from app.storage import STORAGE
+        STORAGE.start()
+        CHAIN_STORE.start()
+
+
+def worker_exit(server, worker):
+    if pool == 'search':
+        from app.monitor import wait_for_monitors
+        wait_for_monitors(graceful_timeout)
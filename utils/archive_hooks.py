@@ -0,0 +1,107 @@
+"""Hook of update_binary_archive.py keeping the results cached by the app consistent with the archive.
+
+The chains added, removed and modified by an update are saved to a JSON file of the changes directory. Cached
+alignments (queriesNearestNeighboursStats) and hits of saved queries involving removed or modified chains are deleted,
+the saved queries are marked as outdated and the chains are dropped from the neighbour lists. A background run of
+build_neighbours.py then aligns the added and modified chains against their neighbours and adds them to the lists. The
+changed chains are removed from the chain store of the app. Entries of indexed structures in the query cache are named
+by the version of the raw file, so they need no invalidation.
+"""
+import configparser
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+import mariadb
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from app.chain_store import DEFAULT_DIRECTORY, ChainStore
+from app.neighbours import get_neighbours_dir, update_neighbour_lists
+
+# Chains per DELETE statement
+BATCH_SIZE = 1000
+
+
+def get_changes_dir(config: configparser.ConfigParser) -> Path:
+    return Path(config.get('dirs', 'archive_changes',
+                           fallback=str(Path(config['dirs']['computations'], 'archive_changes'))))
+
+
+def save_changes(directory: Path, added: List[str], removed: List[str], modified: List[str]) -> Path:
+    directory.mkdir(parents=True, exist_ok=True)
+    path = Path(directory, f'{time.strftime("%Y%m%d%H%M%S")}.json')
+    with open(path, 'w') as f:
+        json.dump({'added': sorted(added), 'removed': sorted(removed), 'modified': sorted(modified)}, f)
+    return path
+
+
+def invalidate_caches(conn: 'mariadb.connection', config: configparser.ConfigParser, chain_ids: List[str]) -> None:
+    """Deletes the cached results involving the chains (removed or modified ones)."""
+    cursor = conn.cursor()
+    int_ids = []
+    alignments = hits = outdated = 0
+    updated = time.strftime('%Y-%m-%d')
+    for i in range(0, len(chain_ids), BATCH_SIZE):
+        batch = chain_ids[i:i + BATCH_SIZE]
+        ids_format = ', '.join(['%s'] * len(batch))
+        cursor.execute(f'DELETE FROM queriesNearestNeighboursStats '
+                       f'WHERE queryGesamtId IN ({ids_format}) OR nnGesamtId IN ({ids_format})', (*batch, *batch))
+        alignments += cursor.rowcount
+        cursor.execute(f'SELECT intId FROM proteinChain WHERE gesamtId IN ({ids_format})', batch)
+        batch_int_ids = [row[0] for row in cursor.fetchall()]
+        int_ids.extend(batch_int_ids)
+        if batch_int_ids:
+            int_ids_format = ', '.join(['%s'] * len(batch_int_ids))
+            # The results page of the saved queries tells that they lost hits
+            cursor.execute(f"UPDATE savedQueries SET statistics = JSON_SET(statistics, '$.archive_updated', %s) "
+                           f'WHERE job_id IN (SELECT job_id FROM savedQueryHits '
+                           f'WHERE chainIntId IN ({int_ids_format}))', (updated, *batch_int_ids))
+            outdated += cursor.rowcount
+            cursor.execute(f'DELETE FROM savedQueryHits WHERE chainIntId IN ({int_ids_format})', batch_int_ids)
+            hits += cursor.rowcount
+        conn.commit()
+    cursor.close()
+    print(f'Deleted {alignments} cached alignments and {hits} hits of {outdated} saved queries (marked outdated)')
+
+    directory = update_neighbour_lists(get_neighbours_dir(config), int_ids, {})
+    if directory is not None:
+        print(f'Changed chains dropped from the neighbour lists, saved to {directory}')
+
+
+def evict_from_chain_store(config: configparser.ConfigParser, chain_ids: List[str]) -> None:
+    """Removes the chains from the chain store of the app, it would keep serving their old binaries."""
+    directory = config.get('chain_store', 'directory', fallback=DEFAULT_DIRECTORY)
+    evicted = 0
+    for chain_id in chain_ids:
+        try:
+            ChainStore.chain_path(directory, chain_id).unlink()
+            evicted += 1
+        except FileNotFoundError:
+            pass
+    # The janitor of the app recounts the store
+    print(f'Removed {evicted} changed chains from the chain store')
+
+
+def schedule_neighbour_update(config_file: str, changes_file: Path, workers: int) -> None:
+    """Starts build_neighbours.py for the changed chains in the background, its output goes next to the changes."""
+    with open(changes_file.with_suffix('.log'), 'w') as log_file:
+        subprocess.Popen([sys.executable, str(Path(__file__).resolve().parent / 'build_neighbours.py'),
+                          '--config', config_file, '--changes', str(changes_file), '--workers', str(workers)],
+                         stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+    print(f'Alignment of the changed chains started, see {changes_file.with_suffix(".log")}')
+
+
+def run_update_hook(conn: 'mariadb.connection', config_file: str, added: List[str], removed: List[str],
+                    modified: List[str], workers: int, background: bool = True) -> None:
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    changes_file = save_changes(get_changes_dir(config), added, removed, modified)
+    print(f'Chains added: {len(added)}, removed: {len(removed)}, modified: {len(modified)} (saved to {changes_file})')
+    invalidate_caches(conn, config, removed + modified)
+    evict_from_chain_store(config, removed + modified)
+    if background and (added or modified):
+        schedule_neighbour_update(config_file, changes_file, workers)
@@ -0,0 +1,88 @@
+import sqlite3
+import sys
+import zlib
+from pathlib import Path
+from typing import List
+
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'app'))
+from id_map import write_id_map
+
+SCHEMA = '''
+CREATE TABLE protein (pdbId TEXT PRIMARY KEY, name TEXT);
+CREATE TABLE proteinId (id TEXT PRIMARY KEY);
+CREATE TABLE proteinChain (
+    intId INTEGER PRIMARY KEY AUTOINCREMENT,
+    gesamtId TEXT UNIQUE NOT NULL,
+    chainLength INTEGER,
+    indexedAsDataObject INTEGER DEFAULT 1,
+    added TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE proteinChainMetadata (pdbId TEXT, lastUpdate TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+CREATE TABLE queriesNearestNeighboursStats (
+    evaluationTime INTEGER,
+    queryGesamtId TEXT NOT NULL,
+    nnGesamtId TEXT NOT NULL,
+    qscore REAL,
+    rmsd REAL,
+    alignedResidues INTEGER,
+    seqIdentity REAL,
+    rotationStats TEXT,
+    added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    neighbourList BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (queryGesamtId, nnGesamtId)
+);
+CREATE TABLE savedQueries (
+    job_id TEXT PRIMARY KEY,
+    name TEXT,
+    chain TEXT,
+    radius REAL,
+    k INTEGER,
+    statistics TEXT,
+    added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    disable_search_stats INTEGER,
+    disable_visualizations INTEGER
+);
+CREATE TABLE savedQueryHits (
+    job_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    chainIntId INTEGER NOT NULL,
+    qscore REAL NOT NULL,
+    rmsd REAL NOT NULL,
+    seqIdentity REAL NOT NULL,
+    alignedResidues INTEGER NOT NULL,
+    rotationStats TEXT,
+    PRIMARY KEY (job_id, position)
+);
+'''
+
+
+def pdb_id(i: int) -> str:
+    return f'{1 + i // 4096}{i % 4096:03X}'
+
+
+def chain_length(chain_id: str) -> int:
+    # Deterministic, so the fake python_distance knows the lengths without the DB
+    return 50 + zlib.crc32(chain_id.encode()) % 500
+
+
+def create_fixture(path: str, entries: int, chains_per_entry: int, id_map_dir: str) -> List[str]:
+    """Creates SQLite DB with the tables used by the app and the chain ID mapping.
+
+    Returns gesamtIds of the indexed chains in intId order.
+    """
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+
+    pdb_ids = [pdb_id(i) for i in range(entries)]
+    chain_ids = [f'{pdb}:{chr(ord("A") + c)}' for pdb in pdb_ids for c in range(chains_per_entry)]
+
+    conn.executemany('INSERT INTO protein VALUES (?, ?)', [(pdb, f'Benchmark protein {pdb}') for pdb in pdb_ids])
+    conn.executemany('INSERT INTO proteinId VALUES (?)', [(pdb,) for pdb in pdb_ids])
+    conn.executemany('INSERT INTO proteinChain (gesamtId, chainLength) VALUES (?, ?)',
+                     [(chain_id, chain_length(chain_id)) for chain_id in chain_ids])
+    conn.executemany('INSERT INTO proteinChainMetadata (pdbId) VALUES (?)', [(pdb,) for pdb in pdb_ids])
+    conn.commit()
+    write_id_map(Path(id_map_dir), conn.execute('SELECT intId, gesamtId FROM proteinChain').fetchall())
+    conn.close()
+
+    return chain_ids
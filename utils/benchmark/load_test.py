@@ -0,0 +1,340 @@
+"""End-to-end load test of the web app against local stand-ins of MESSIF, python_distance and MariaDB.
+
+The app runs in a subprocess with this directory first on PYTHONPATH, so it imports the fake python_distance
+and the SQLite-backed mariadb modules from here. Concurrent users go through
+upload -> search -> stream -> details and the latencies of the steps are reported.
+
+Example:
+    python utils/benchmark/load_test.py --users 8 --searches 5 --output baseline.json
+    python utils/benchmark/load_test.py --users 8 --searches 5 --compare baseline.json
+"""
+import argparse
+import json
+import os
+import re
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import requests
+
+from fixture import create_fixture
+from mock_messif import MockMessif
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCHMARK_DIR.parents[1]
+PHASES = ('sketches_small', 'sketches_large', 'full')
+STEPS = ('upload', 'search', 'first_event', 'stream', 'details', 'total')
+TERMINAL_STATUSES = ('FINISHED', 'ERROR', 'ABORTED')
+PERCENTILES = (50, 95, 99)
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {step: [] for step in STEPS}
+        self.errors: Dict[str, int] = {step: 0 for step in STEPS}
+
+    def add(self, step: str, seconds: float) -> None:
+        with self.lock:
+            self.latencies[step].append(seconds)
+
+    def error(self, step: str) -> None:
+        with self.lock:
+            self.errors[step] += 1
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def write_config(workdir: Path, database: str, ports: Dict[str, int], users: int = 0) -> Path:
+    # The app reads ../protein_search.ini relative to its working directory
+    for directory in ('computations', 'archive', 'raw_pdbs', 'app'):
+        Path(workdir, directory).mkdir(parents=True, exist_ok=True)
+    lines = [
+        '[db]', 'host = localhost', f'database = {database}', 'user = benchmark', 'password = benchmark',
+        '[ports]', *[f'{phase} = {port}' for phase, port in ports.items()],
+        '[dirs]', f'computations = {workdir / "computations"}', f'archive = {workdir / "archive"}',
+        f'raw_pdbs = {workdir / "raw_pdbs"}',
+        # All virtual users connect from localhost, each one is identified by its own token. The per-client rate
+        # limit would otherwise throttle the benchmark instead of the server's capacity.
+        '[admission]', f'tokens = {" ".join(f"user{user}" for user in range(users))}',
+        'rate_per_minute = 6000', 'rate_burst = 100',
+        # Raw files of the fixture are not structures, the fake python_distance writes the aligned ones
+        '[superpose]', 'enabled = false',
+    ]
+    Path(workdir, 'protein_search.ini').write_text('\n'.join(lines) + '\n')
+    return Path(workdir, 'app')
+
+
+def start_app(cwd: Path, port: int, args: argparse.Namespace) -> subprocess.Popen:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([str(BENCHMARK_DIR), str(REPO_DIR), env.get('PYTHONPATH', '')])
+    env.update({
+        'BENCH_ALIGN_MS': str(args.align_ms),
+        'BENCH_SAVE_MS': str(args.save_ms),
+        'BENCH_PREPARE_MS': str(args.prepare_ms),
+    })
+    code = f'from app import application; application.run(host="localhost", port={port}, threaded=True)'
+    log = open(Path(cwd, 'app.log'), 'w')
+    # Own process group, so the worker pools forked by the app (holding the listening socket) are stopped too
+    return subprocess.Popen([sys.executable, '-c', code], cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+
+
+def wait_for_app(url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    end = time.time() + timeout
+    while time.time() < end:
+        if process.poll() is not None:
+            raise RuntimeError('App exited during startup, see app.log in the working directory')
+        try:
+            requests.get(f'{url}/metrics', timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError('App did not start in time')
+
+
+def read_stream(url: str, recorder: Recorder, begin: float) -> Optional[dict]:
+    rows = {}
+    first = True
+    with requests.get(url, stream=True, timeout=600) as response:
+        for line in response.iter_lines(decode_unicode=True):
+            # Keep-alive comments are not newline terminated and may prefix the next message
+            idx = line.find('data: ') if line else -1
+            if idx == -1:
+                continue
+            if first:
+                recorder.add('first_event', time.perf_counter() - begin)
+                first = False
+            message = json.loads(line[idx + len('data: '):])
+            if 'statistics' in message:
+                rows = {row['object']: row for row in message['statistics']}
+            diff = message.get('statistics_diff', {})
+            rows.update((row['object'], row) for row in diff.get('updated', []))
+            for obj in diff.get('removed', []):
+                rows.pop(obj, None)
+            if message['status'] in TERMINAL_STATUSES:
+                if message['status'] != 'FINISHED':
+                    raise RuntimeError(message.get('error_message', message['status']))
+                return max(rows.values(), key=lambda row: row['qscore'], default=None)
+    raise RuntimeError('Stream ended without a final status')
+
+
+def run_search(url: str, user: int, search: int, args: argparse.Namespace, recorder: Recorder) -> None:
+    session = requests.Session()
+    session.headers['X-API-Token'] = f'user{user}'
+    total_begin = time.perf_counter()
+
+    # Unique content unless upload cache hits are wanted
+    salt = uuid.uuid4().hex if args.unique_uploads else 'shared'
+    content = f'REMARK {salt}\n' + ''.join(f'CHAIN {chr(ord("A") + i)} {100 + 20 * i}\n' for i in range(args.chains))
+    step = 'upload'
+    try:
+        begin = time.perf_counter()
+        response = session.post(f'{url}/', data={'upload': 'upload'},
+                                files={'file': (f'bench_{user}_{search}.pdb', content)})
+        response.raise_for_status()
+        job_id = re.search(r'/search/([^"]+)"', response.text).group(1)
+        while True:
+            status = session.get(f'{url}/upload_status/{job_id}').json()
+            if status['status'] == 'READY':
+                break
+            if status['status'] == 'ERROR':
+                raise RuntimeError(status['error_message'])
+            time.sleep(args.poll_interval)
+        recorder.add(step, time.perf_counter() - begin)
+
+        step = 'search'
+        begin = time.perf_counter()
+        form = {'chain': status['chains'][0][0], 'input_name': f'bench_{user}_{search}.pdb', 'uploaded': 'True',
+                'qscore_range': str(args.qscore), 'num_results': str(args.num_results)}
+        if not args.visualizations:
+            form['disable_visualizations'] = 'on'
+        response = session.post(f'{url}/search/{job_id}', data=form)
+        response.raise_for_status()
+        recorder.add(step, time.perf_counter() - begin)
+
+        step = 'stream'
+        begin = time.perf_counter()
+        best = read_stream(f'{url}/get_results_stream/{job_id}', recorder, begin)
+        recorder.add(step, time.perf_counter() - begin)
+
+        step = 'details'
+        if best is not None:
+            begin = time.perf_counter()
+            session.get(f'{url}/details/{job_id}/{best["object"]}').raise_for_status()
+            recorder.add(step, time.perf_counter() - begin)
+    except (requests.exceptions.RequestException, RuntimeError, AttributeError, KeyError, ValueError) as e:
+        recorder.error(step)
+        recorder.error('total')
+        print(f'User {user}, search {search} failed at {step}: {e}')
+        return
+
+    recorder.add('total', time.perf_counter() - total_begin)
+
+
+def run_user(url: str, user: int, args: argparse.Namespace, recorder: Recorder) -> None:
+    for search in range(args.searches):
+        run_search(url, user, search, args, recorder)
+
+
+def process_stats(pid: int) -> Dict[str, float]:
+    stats = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(('VmHWM:', 'VmRSS:', 'Threads:')):
+                    key, value = line.split(':', 1)
+                    stats[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return stats
+
+
+def summarize(recorder: Recorder, wall_time: float, resources: dict, args: argparse.Namespace) -> dict:
+    steps = {}
+    for step in STEPS:
+        values = recorder.latencies[step]
+        steps[step] = {
+            'count': len(values),
+            'errors': recorder.errors[step],
+            'mean': sum(values) / len(values) if values else None,
+            **{f'p{p}': percentile(values, p) for p in PERCENTILES},
+        }
+    return {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'wall_time': wall_time,
+        'throughput': len(recorder.latencies['total']) / wall_time if wall_time else 0,
+        'steps': steps,
+        'resources': resources,
+    }
+
+
+def print_summary(summary: dict) -> None:
+    print(f'{"step":<12} {"count":>6} {"errors":>6} ' + ' '.join(f'{"p" + str(p):>9}' for p in PERCENTILES))
+    for step, values in summary['steps'].items():
+        latencies = ' '.join(f'{values[f"p{p}"]:>9.3f}' if values[f'p{p}'] is not None else f'{"-":>9}'
+                             for p in PERCENTILES)
+        print(f'{step:<12} {values["count"]:>6} {values["errors"]:>6} {latencies}')
+    print(f'Throughput: {summary["throughput"]:.3f} searches/s in {summary["wall_time"]:.1f} s')
+    print('Resources: ' + ', '.join(f'{key}={value}' for key, value in summary['resources'].items()))
+
+
+def compare(summary: dict, baseline_file: str, tolerance: float) -> bool:
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+
+    ok = True
+    print(f'Comparison with {baseline_file} (tolerance {tolerance:.0%}):')
+    for step, values in summary['steps'].items():
+        old = baseline['steps'].get(step, {}).get('p95')
+        new = values['p95']
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0
+        regression = change > tolerance
+        ok &= not regression
+        print(f'  {step:<12} p95 {old:.3f} -> {new:.3f} ({change:+.1%}){" REGRESSION" if regression else ""}')
+    old, new = baseline['throughput'], summary['throughput']
+    if old:
+        change = (new - old) / old
+        regression = change < -tolerance
+        ok &= not regression
+        print(f'  throughput {old:.3f} -> {new:.3f} ({change:+.1%}){" REGRESSION" if regression else ""}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=4, help='Number of concurrent users')
+    parser.add_argument('--searches', type=int, default=3, help='Number of searches per user')
+    parser.add_argument('--num-results', type=int, default=30, help='Number of results of each search')
+    parser.add_argument('--qscore', type=float, default=0.5, help='Q-score threshold of searches')
+    parser.add_argument('--chains', type=int, default=2, help='Number of chains in the uploaded structures')
+    parser.add_argument('--entries', type=int, default=2000, help='Number of PDB entries in the fixture DB')
+    parser.add_argument('--chains-per-entry', type=int, default=2, help='Number of chains of each fixture entry')
+    parser.add_argument('--messif-latency', type=float, nargs=3, default=[0.05, 0.2, 1.0],
+                        metavar=('SMALL', 'LARGE', 'FULL'), help='Latencies of the mock MESSIF phases in seconds')
+    parser.add_argument('--align-ms', type=float, default=20, help='Cost of one alignment')
+    parser.add_argument('--save-ms', type=float, default=200, help='Cost of converting an uploaded structure')
+    parser.add_argument('--prepare-ms', type=float, default=5, help='Cost of writing a PDB file')
+    parser.add_argument('--unique-uploads', action=argparse.BooleanOptionalAction, default=True,
+                        help='Upload distinct structures (disable to measure upload cache hits)')
+    parser.add_argument('--visualizations', action='store_true', help='Render alignment images (needs PyMOL)')
+    parser.add_argument('--poll-interval', type=float, default=0.1, help='Upload status polling interval')
+    parser.add_argument('--port', type=int, default=18080, help='Port of the app')
+    parser.add_argument('--messif-port', type=int, default=18090, help='First port of the mock MESSIF servers')
+    parser.add_argument('--output', type=str, help='File to save the results (JSON)')
+    parser.add_argument('--compare', type=str, help='Results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown when comparing')
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix='protein_search_bench'))
+    database = str(workdir / 'fixture.db')
+    num_chains = len(create_fixture(database, args.entries, args.chains_per_entry,
+                                    str(workdir / 'computations' / 'id_map')))
+    ports = {phase: args.messif_port + i for i, phase in enumerate(PHASES)}
+    app_dir = write_config(workdir, database, ports, args.users)
+
+    servers = [MockMessif(phase, ports[phase], latency, num_chains)
+               for phase, latency in zip(PHASES, args.messif_latency)]
+    for server in servers:
+        server.start()
+
+    url = f'http://localhost:{args.port}'
+    process = start_app(app_dir, args.port, args)
+    print(f'Working directory: {workdir}')
+    try:
+        wait_for_app(url, process)
+        recorder = Recorder()
+        begin = time.perf_counter()
+        with ThreadPoolExecutor(args.users) as executor:
+            for user in range(args.users):
+                executor.submit(run_user, url, user, args, recorder)
+        wall_time = time.perf_counter() - begin
+        app_stats = process_stats(process.pid)
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait()
+        for server in servers:
+            server.stop()
+
+    # Children are waited for, so their usage (including the app's worker processes) is accounted here
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    resources = {
+        'cpu_user_s': round(usage.ru_utime, 2),
+        'cpu_system_s': round(usage.ru_stime, 2),
+        'max_rss_kb': usage.ru_maxrss,
+        'app_peak_rss_kb': app_stats.get('VmHWM'),
+        'app_threads': app_stats.get('Threads'),
+    }
+
+    summary = summarize(recorder, wall_time, resources, args)
+    print_summary(summary)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if args.compare and not compare(summary, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
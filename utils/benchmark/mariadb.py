@@ -0,0 +1,64 @@
+"""SQLite-backed stand-in for the mariadb connector used by the benchmark.
+
+The `database` argument of connect() is the path of the SQLite file created by fixture.py. Only the SQL dialect
+used by the app on the benchmarked paths is translated.
+"""
+import re
+import sqlite3
+
+Error = sqlite3.Error
+
+TRANSLATIONS = [
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'INSERT IGNORE', re.IGNORECASE), 'INSERT OR IGNORE'),
+    (re.compile(r'RAND\(\)', re.IGNORECASE), 'RANDOM()'),
+    (re.compile(r'NOW\(\)', re.IGNORECASE), "datetime('now')"),
+]
+
+
+def translate(sql: str) -> str:
+    for pattern, replacement in TRANSLATIONS:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+class Cursor:
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.cursor = cursor
+
+    def execute(self, sql: str, params=()):
+        self.cursor.execute(translate(sql), tuple(params))
+
+    def executemany(self, sql: str, params):
+        self.cursor.executemany(translate(sql), [tuple(row) for row in params])
+
+    @property
+    def rowcount(self) -> int:
+        return self.cursor.rowcount
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+class Connection:
+    def __init__(self, database: str):
+        self.conn = sqlite3.connect(database, timeout=30)
+
+    def cursor(self) -> Cursor:
+        return Cursor(self.conn.cursor())
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def connect(host=None, user=None, password=None, database=None) -> Connection:
+    return Connection(database)
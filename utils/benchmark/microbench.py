@@ -0,0 +1,231 @@
+"""Microbenchmarks of the functions running per search hit.
+
+Uses the same stand-ins as load_test.py (SQLite fixture, fake python_distance, mock MESSIF with zero latency),
+so the numbers measure the app's own overhead. Results can be saved and compared with a baseline.
+
+Example:
+    python utils/benchmark/microbench.py --output baseline.json
+    python utils/benchmark/microbench.py --compare baseline.json
+"""
+import argparse
+import gzip
+import importlib.util
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable, Dict, List
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCHMARK_DIR.parents[1]
+sys.path[:0] = [str(BENCHMARK_DIR), str(REPO_DIR), str(REPO_DIR / 'utils')]
+
+# Zero costs of the fake python_distance, only the app's overhead is measured
+for variable in ('BENCH_ALIGN_MS', 'BENCH_SAVE_MS', 'BENCH_PREPARE_MS'):
+    os.environ.setdefault(variable, '0')
+
+from fixture import create_fixture
+from load_test import PHASES, write_config
+from mock_messif import MockMessif
+
+
+def bench(name: str, fn: Callable[[], object], repeat: int, number: int, results: Dict[str, dict]) -> None:
+    fn()  # warm-up
+    timings = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter() - begin) / number)
+    results[name] = {'min': min(timings), 'median': statistics.median(timings), 'mean': statistics.mean(timings)}
+    print(f'{name:<45} {results[name]["median"] * 1e6:>12.1f} us  (min {results[name]["min"] * 1e6:.1f} us)')
+
+
+def completed_future(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def bench_similarity(computation, chain_ids: List[str], args: argparse.Namespace, results: Dict[str, dict]) -> None:
+    query, cached = chain_ids[0], chain_ids[1]
+    with computation.DBConnection() as db:
+        db.c.execute('INSERT INTO queriesNearestNeighboursStats (evaluationTime, queryGesamtId, nnGesamtId, qscore,'
+                     ' rmsd, alignedResidues, seqIdentity, rotationStats) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)',
+                     (100, query, cached, 0.8, 1.2, 120, 0.5, ';'.join(['0.000'] * 16)))
+        db.conn.commit()
+
+    # Misses are not inserted into the cache, the fake alignment is faster than the 30 ms threshold
+    bench('get_similarity_results[hit]', lambda: computation.get_similarity_results(query, cached, 0.5),
+          args.repeat, args.number, results)
+    bench('get_similarity_results[miss]', lambda: computation.get_similarity_results(query, chain_ids[2], 0.5),
+          args.repeat, args.number, results)
+
+
+def bench_names(computation, chain_ids: List[str], args: argparse.Namespace, results: Dict[str, dict]) -> None:
+    pdb_ids = sorted({chain_id.split(':')[0] for chain_id in chain_ids})
+    for size in (1, 10, 100, 1000):
+        batch = pdb_ids[:size]
+        bench(f'get_names[{len(batch)}]', lambda: computation.get_names(batch), args.repeat, args.number, results)
+
+
+def bench_messif(computation, args: argparse.Namespace, results: Dict[str, dict]) -> None:
+    for k in (30, 1000, 10000):
+        for phase in ('sketches_small', 'full'):
+            bench(f'get_results_messif[{phase},k={k}]',
+                  lambda: computation.get_results_messif('1000:A', 0.5, k, phase, 'bench'),
+                  args.repeat, max(1, args.number // 10), results)
+
+
+def bench_assembly(monitor, chain_ids: List[str], args: argparse.Namespace, results: Dict[str, dict]) -> None:
+    T = [1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0]
+    for k in (30, 1000, 10000):
+        ids = chain_ids[:k]
+        result_stats = {chain_id: completed_future((0.3 + 0.7 * (i % 97) / 97, 1.5, 0.4, 120, T))
+                        for i, chain_id in enumerate(ids)}
+        # Half of the alignments still running
+        for chain_id in ids[::2]:
+            result_stats[chain_id] = Future()
+
+        def assemble():
+            statistics, completed = monitor.collect_statistics(ids, result_stats, 0.5, {})
+            message = {'status': 'COMPUTING', 'completed': completed, 'chain_count': len(ids),
+                       'statistics_diff': {'updated': statistics, 'removed': []}}
+            return json.dumps(message)
+
+        bench(f'collect_statistics+json[k={len(ids)}]', assemble, args.repeat, max(1, args.number // 10), results)
+
+
+def bench_is_updated(workdir: Path, args: argparse.Namespace, results: Dict[str, dict]) -> None:
+    from update_binary_archive import is_updated
+
+    mirror_dir, raw_dir = Path(workdir, 'mirror'), Path(workdir, 'raw')
+    for size in (100_000, 1_000_000):
+        for changed in (False, True):
+            filename = f'{"c" if changed else "u"}{size // 1000:03d}.cif'
+            directory = filename[1:3]
+            Path(mirror_dir, directory).mkdir(parents=True, exist_ok=True)
+            Path(raw_dir, directory).mkdir(parents=True, exist_ok=True)
+            content = ''.join(f'ATOM {i:>8} CA ALA A {i % 9999:>4}\n' for i in range(size // 32))
+            with gzip.open(Path(mirror_dir, directory, f'{filename}.gz'), 'wt') as f:
+                f.write(content)
+            Path(raw_dir, directory, filename).write_text(content if not changed else content[:-2] + 'X\n')
+            bench(f'is_updated[{size // 1000}kB,{"changed" if changed else "same"}]',
+                  lambda: is_updated(filename, str(mirror_dir), str(raw_dir)),
+                  args.repeat, max(1, args.number // 10), results)
+
+
+def write_structure(path: Path, residues: int) -> None:
+    """Single-chain mmCIF of a straight poly-alanine."""
+    import gemmi
+
+    chain = gemmi.Chain('A')
+    for i in range(residues):
+        residue = gemmi.Residue()
+        residue.name, residue.seqid, residue.het_flag = 'ALA', gemmi.SeqId(i + 1, ' '), 'A'
+        for j, name in enumerate(('N', 'CA', 'C', 'O', 'CB')):
+            atom = gemmi.Atom()
+            atom.name, atom.element, atom.occ, atom.b_iso = name, gemmi.Element(name[0]), 1.0, 20.0
+            atom.pos = gemmi.Position(3.8 * i, 1.2 * j, 0.0)
+            residue.add_atom(atom)
+        chain.add_residue(residue)
+    model = gemmi.Model('1')
+    model.add_chain(chain)
+    structure = gemmi.Structure()
+    structure.add_model(model)
+    structure.setup_entities()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    structure.make_mmcif_document().write_file(str(path))
+
+
+def bench_superpose(chain_ids: List[str], args: argparse.Namespace, results: Dict[str, dict]) -> None:
+    if importlib.util.find_spec('gemmi') is None:
+        return
+    from app import superpose
+
+    T = [0.0, -1.0, 0.0, 10.0, 1.0, 0.0, 0.0, -5.0, 0.0, 0.0, 1.0, 2.5, 0.0, 0.0, 0.0, 1.0]
+    pdb_id = chain_ids[0].split(':')[0]
+    write_structure(superpose.get_raw_file(pdb_id), 600)
+    chain_id = f'{pdb_id}:A'
+    bench('aligned_pdb[3000 atoms]', lambda: superpose.aligned_pdb(chain_id, T), args.repeat, args.number, results)
+
+    def from_disk():
+        superpose.load_entry.cache_clear()
+        return superpose.aligned_pdb(chain_id, T)
+
+    bench('aligned_pdb[3000 atoms,disk cache]', from_disk, args.repeat, max(1, args.number // 10), results)
+
+
+def compare(results: Dict[str, dict], baseline_file: str, tolerance: float) -> bool:
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+
+    ok = True
+    print(f'Comparison with {baseline_file} (tolerance {tolerance:.0%}):')
+    for name, values in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['median'], values['median']
+        change = (new - old) / old if old else 0
+        regression = change > tolerance
+        ok &= not regression
+        print(f'  {name:<45} {old * 1e6:>10.1f} -> {new * 1e6:>10.1f} us ({change:+.1%})'
+              f'{" REGRESSION" if regression else ""}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed rounds of each benchmark')
+    parser.add_argument('--number', type=int, default=100, help='Number of calls in one round')
+    parser.add_argument('--entries', type=int, default=5000, help='Number of PDB entries in the fixture DB')
+    parser.add_argument('--messif-port', type=int, default=18190, help='First port of the mock MESSIF servers')
+    parser.add_argument('--output', type=str, help='File to save the results (JSON)')
+    parser.add_argument('--compare', type=str, help='Results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown when comparing')
+    args = parser.parse_args()
+    # Relative to the directory of the user, the benchmark runs in the fixture's directory
+    args.output = os.path.abspath(args.output) if args.output else None
+    args.compare = os.path.abspath(args.compare) if args.compare else None
+
+    workdir = Path(tempfile.mkdtemp(prefix='protein_search_microbench'))
+    database = str(workdir / 'fixture.db')
+    chain_ids = create_fixture(database, args.entries, 2, str(workdir / 'computations' / 'id_map'))
+    ports = {phase: args.messif_port + i for i, phase in enumerate(PHASES)}
+    os.chdir(write_config(workdir, database, ports))
+
+    servers = [MockMessif(phase, ports[phase], 0.0, len(chain_ids)) for phase in PHASES]
+    for server in servers:
+        server.start()
+
+    # The app reads its configuration on import, i.e., after the fixture is written
+    from app import computation, monitor
+    logging.getLogger('protein_search').setLevel(logging.WARNING)
+
+    results = {}
+    try:
+        bench_similarity(computation, chain_ids, args, results)
+        bench_names(computation, chain_ids, args, results)
+        bench_messif(computation, args, results)
+        bench_assembly(monitor, chain_ids, args, results)
+        bench_is_updated(workdir, args, results)
+        bench_superpose(chain_ids, args, results)
+    finally:
+        for server in servers:
+            server.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
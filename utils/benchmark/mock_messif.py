@@ -0,0 +1,113 @@
+"""MESSIF stand-in serving /search, /get_progress and /end_job with responses matching utils/response_schema.json.
+
+Answers are drawn deterministically from intIds 1..num_chains (the fixture's proteinChain rows), so repeated runs
+of the benchmark search for the same candidates.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+PIVOT_COUNT = 512
+
+
+class MockMessif:
+    def __init__(self, phase: str, port: int, latency: float, num_chains: int):
+        self.phase = phase
+        self.latency = latency
+        self.num_chains = num_chains
+        self.running: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('localhost', port), self.handler())
+        self.server.daemon_threads = True
+
+    def handler(self):
+        messif = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if url.path == '/search':
+                    response = messif.search(params['queryid'], int(params['k']), float(params.get('radius', -1)),
+                                             params.get('job_id', ''))
+                elif url.path == '/get_progress':
+                    response = messif.progress(params.get('job_id', ''))
+                elif url.path == '/end_job':
+                    response = {}
+                else:
+                    self.send_error(404)
+                    return
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def answer(self, query: str, k: int) -> List[int]:
+        rng = random.Random(f'{self.phase}:{query}')
+        return rng.sample(range(1, self.num_chains + 1), min(k, self.num_chains))
+
+    def search(self, query: str, k: int, radius: float, job_id: str) -> dict:
+        with self.lock:
+            self.running[job_id] = time.time()
+        try:
+            time.sleep(self.latency)
+        finally:
+            with self.lock:
+                self.running.pop(job_id, None)
+
+        ids = self.answer(query, k)
+        operation_time = int(self.latency * 1000)
+        return {
+            'answer_records': [{'_id': str(i)} for i in ids],
+            # Answers of range queries lie within the radius
+            'answer_distances': [round((radius if radius >= 0 else 1.0) * (i + 1) / len(ids), 4)
+                                 for i in range(len(ids))],
+            'answer_count': len(ids),
+            'status': {'code': 200, 'text': 'OK'},
+            'statistics': {'OperationTime': operation_time},
+            'query_record': {
+                'proteinObj': {'_id': query},
+                'job_id': job_id,
+                'pivotDistCountTotal': PIVOT_COUNT,
+                'pivotDistCountCached': 0,
+                'pivotDistTimes': operation_time // 3,
+                'searchDistCountTotal': 10 * len(ids),
+                'searchDistCountCached': 0,
+            },
+        }
+
+    def progress(self, job_id: str) -> dict:
+        with self.lock:
+            start = self.running.get(job_id)
+        if start is None:
+            return {'Running': False}
+
+        done = min(1.0, (time.time() - start) / max(self.latency, 1e-3))
+        return {
+            'Running': True,
+            'pivotDistCountExpected': PIVOT_COUNT,
+            'pivotDistCountCached': 0,
+            'pivotDistCountComputed': int(PIVOT_COUNT * min(1.0, 3 * done)),
+            'pivotTime': int(self.latency * 1000) // 3 if done > 1 / 3 else None,
+            'searchDistCountExpected': 1000,
+            'searchDistCountCached': 0,
+            'searchDistCountComputed': int(1000 * done),
+        }
+
+    def start(self) -> None:
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,54 @@
+"""Fake of the native python_distance module with tunable cost, used by the benchmark.
+
+Costs are busy loops (CPU bound like gesamt), configured in milliseconds by environment variables:
+BENCH_ALIGN_MS (get_results with a chain of 250 residues, scaled by the length of the other chain), BENCH_SAVE_MS
+(save_chains) and BENCH_PREPARE_MS (prepare_PDB).
+Uploaded benchmark structures are text files with lines 'CHAIN <id> <length>'.
+"""
+import hashlib
+import os
+import time
+from pathlib import Path
+
+from fixture import chain_length
+
+ALIGN_MS = float(os.environ.get('BENCH_ALIGN_MS', 20))
+SAVE_MS = float(os.environ.get('BENCH_SAVE_MS', 200))
+PREPARE_MS = float(os.environ.get('BENCH_PREPARE_MS', 5))
+
+
+def burn(milliseconds: float) -> None:
+    end = time.perf_counter() + milliseconds / 1000
+    while time.perf_counter() < end:
+        pass
+
+
+def save_chains(filename: str, output_dir: str, prefix: str):
+    burn(SAVE_MS)
+    chains = []
+    with open(filename) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[0] == 'CHAIN':
+                chains.append((parts[1], int(parts[2])))
+    for chain, _ in chains:
+        Path(output_dir, f'{prefix}:{chain}.bin').write_text(chain)
+    return chains
+
+
+def get_results(query: str, other: str, archive_dir: str, min_qscore: float):
+    burn(ALIGN_MS * chain_length(other) / 250)
+    # Symmetric and deterministic, like distances between real chains
+    digest = hashlib.md5(':'.join(sorted((query, other))).encode()).digest()
+    qscore = 0.3 + 0.7 * digest[0] / 255
+    rmsd = 0.5 + 3 * digest[1] / 255
+    seq_identity = digest[2] / 255
+    aligned = 20 + digest[3]
+    T = [1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0, 1.0]
+    return 1 - qscore, qscore, rmsd, seq_identity, aligned, T
+
+
+def prepare_PDB(chain_id: str, raw_dir: str, output_dir: str, T) -> None:
+    burn(PREPARE_MS)
+    filename = 'query.pdb' if T is None else f'{chain_id}.aligned.pdb'
+    Path(output_dir, filename).write_text('ATOM      1  CA  ALA A   1       0.000   0.000   0.000  1.00  0.00           C\n')
@@ -0,0 +1,167 @@
+"""Cold start benchmark: import time of the app's modules, time to the first response and spawn time of worker pools.
+
+Every measurement runs in a new interpreter (with the stand-ins of load_test.py first on PYTHONPATH), so nothing is
+cached in sys.modules. Results can be saved and compared with a baseline like those of the other benchmarks.
+
+Example:
+    python utils/benchmark/startup.py --output baseline.json
+    python utils/benchmark/startup.py --compare baseline.json
+    python utils/benchmark/startup.py --importtime    # modules with the longest cumulative import time
+"""
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import requests
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCHMARK_DIR.parents[1]
+sys.path[:0] = [str(BENCHMARK_DIR), str(REPO_DIR)]
+
+from fixture import create_fixture
+from load_test import PHASES, write_config
+
+# Statements timed in a new interpreter, the result is printed as the last line
+IMPORTS = {
+    'import[app]': 'import app',
+    # Modules used by the worker processes, without Flask and the routes
+    'import[app.computation]': 'import app.computation',
+    'import[application]': 'from app import application',
+}
+POOL_CODE = '''
+import concurrent.futures, os, sys, time
+from app import application
+from app.computation import init_job_worker
+import multiprocessing
+context = multiprocessing.get_context(sys.argv[1])
+begin = time.perf_counter()
+executor = concurrent.futures.ProcessPoolExecutor(mp_context=context, initializer=init_job_worker,
+                                                  initargs=(context.Event(), context.SimpleQueue()))
+executor.submit(os.getpid).result()
+print(time.perf_counter() - begin)
+executor.shutdown()
+'''
+
+
+def get_env() -> Dict[str, str]:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([str(BENCHMARK_DIR), str(REPO_DIR), env.get('PYTHONPATH', '')])
+    return env
+
+
+def run_timed(cwd: Path, args: List[str]) -> float:
+    # A pool whose workers import the whole app (and start its manager) may hang instead of failing
+    output = subprocess.run([sys.executable, *args], cwd=cwd, env=get_env(), capture_output=True, text=True,
+                            check=True, timeout=120).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def time_import(cwd: Path, statement: str) -> float:
+    code = f'import time\nbegin = time.perf_counter()\n{statement}\nprint(time.perf_counter() - begin)'
+    return run_timed(cwd, ['-c', code])
+
+
+def time_first_response(cwd: Path, port: int) -> float:
+    code = f'from app import application; application.run(host="localhost", port={port}, threaded=True)'
+    begin = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=cwd, env=get_env(), stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        while process.poll() is None:
+            try:
+                requests.get(f'http://localhost:{port}/metrics', timeout=1)
+                return time.perf_counter() - begin
+            except requests.exceptions.RequestException:
+                time.sleep(0.01)
+        raise RuntimeError('App exited during startup')
+    finally:
+        # The whole process group, including a manager server of the app
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait()
+
+
+def bench(name: str, fn, repeat: int, results: Dict[str, dict]) -> None:
+    timings = [fn() for _ in range(repeat)]
+    results[name] = {'min': min(timings), 'median': statistics.median(timings), 'mean': statistics.mean(timings)}
+    print(f'{name:<40} {results[name]["median"] * 1000:>10.1f} ms  (min {results[name]["min"] * 1000:.1f} ms)')
+
+
+def print_importtime(cwd: Path, top: int) -> None:
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'from app import application'], cwd=cwd,
+                            env=get_env(), capture_output=True, text=True, check=True).stderr
+    modules = []
+    for line in stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            modules.append((int(parts[1]), parts[2].rstrip()))
+    print(f'Top {top} modules by cumulative import time:')
+    for cumulative, module in sorted(modules, reverse=True)[:top]:
+        print(f'  {cumulative / 1000:>8.1f} ms {module}')
+
+
+def compare(results: Dict[str, dict], baseline_file: str, tolerance: float) -> bool:
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+
+    ok = True
+    print(f'Comparison with {baseline_file} (tolerance {tolerance:.0%}):')
+    for name, values in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['median'], values['median']
+        change = (new - old) / old if old else 0
+        regression = change > tolerance
+        ok &= not regression
+        print(f'  {name:<40} {old * 1000:>8.1f} -> {new * 1000:>8.1f} ms ({change:+.1%})'
+              f'{" REGRESSION" if regression else ""}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs of each measurement')
+    parser.add_argument('--contexts', nargs='+', default=['fork', 'forkserver', 'spawn'],
+                        help='Start methods of the measured worker pools')
+    parser.add_argument('--port', type=int, default=18380, help='Port of the app')
+    parser.add_argument('--importtime', action='store_true', help='List the slowest imports of the app')
+    parser.add_argument('--top', type=int, default=20, help='Number of modules listed by --importtime')
+    parser.add_argument('--output', type=str, help='File to save the results (JSON)')
+    parser.add_argument('--compare', type=str, help='Results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative slowdown when comparing')
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix='protein_search_startup'))
+    database = str(workdir / 'fixture.db')
+    create_fixture(database, 100, 2, str(workdir / 'computations' / 'id_map'))
+    # MESSIF is not contacted during the startup
+    cwd = write_config(workdir, database, {phase: args.port + 1 + i for i, phase in enumerate(PHASES)})
+
+    results = {}
+    for name, statement in IMPORTS.items():
+        bench(name, lambda: time_import(cwd, statement), args.repeat, results)
+    bench('first_response', lambda: time_first_response(cwd, args.port), args.repeat, results)
+    for context in args.contexts:
+        bench(f'pool_first_task[{context}]', lambda: run_timed(cwd, ['-c', POOL_CODE, context]), args.repeat,
+              results)
+
+    if args.importtime:
+        print_importtime(cwd, args.top)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
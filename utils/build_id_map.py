@@ -0,0 +1,37 @@
+import argparse
+import configparser
+import mariadb
+import sys
+from pathlib import Path
+
+# id_map.py has no dependencies on the rest of the app
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'app'))
+from id_map import IdMap, get_id_map_dir, write_id_map
+
+
+def build_id_map(conn: 'mariadb.connection', root: Path) -> IdMap:
+    cursor = conn.cursor()
+    cursor.execute('SELECT intId, gesamtId FROM proteinChain')
+    rows = cursor.fetchall()
+    cursor.close()
+    directory = write_id_map(root, rows)
+    print(f'Mapping of {len(rows)} chain IDs saved to {directory}')
+    return IdMap(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='/etc/protein_search.ini', help='File with configuration of DB')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    conn = mariadb.connect(host=config['db']['host'], user=config['db']['user'], password=config['db']['password'],
+                           database=config['db']['database'])
+    build_id_map(conn, get_id_map_dir(config))
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""Builds the lists of the nearest neighbours of all indexed chains (see app/neighbours.py).
+
+Each chain is searched like a query of the app (with its MESSIF phases) and the candidates are aligned, reusing
+queriesNearestNeighboursStats. Alignments of the neighbours are stored there as well and flagged with
+neighbourList, so utils/remove_old.py keeps them and searches answered by the lists align nothing. Chains are
+processed in chunks saved to the work directory as they finish, an interrupted build continues with the missing chunks
+when started again with the same parameters.
+
+With --changes, only the chains added or modified by an archive update (listed in the file written by
+update_binary_archive.py) are searched, their lists are added to the current ones.
+
+Example:
+    python utils/build_neighbours.py --config /etc/protein_search.ini --workers 16 --size 100 --min-qscore 0.5
+    python utils/build_neighbours.py --config /etc/protein_search.ini --changes /var/local/changes/20250101.json
+"""
+import argparse
+import configparser
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import as_completed, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import mariadb
+import numpy as np
+import tqdm
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+MANIFEST = 'manifest.json'
+# Cached alignments of the neighbours in the lists are exempt from the purge of fast alignments
+ADD_LIST_FLAG = ('ALTER TABLE queriesNearestNeighboursStats '
+                 'ADD COLUMN IF NOT EXISTS neighbourList BOOLEAN NOT NULL DEFAULT FALSE')
+
+
+def get_chains(conn: 'mariadb.connection') -> List[Tuple[int, str]]:
+    cursor = conn.cursor()
+    cursor.execute('SELECT intId, gesamtId FROM proteinChain WHERE indexedAsDataObject = 1')
+    chains = sorted(cursor.fetchall())
+    cursor.close()
+    return chains
+
+
+def neighbours_of(chain_id: str, size: int, min_qscore: float, job_id: str) -> Tuple[List[Tuple[str, float]], bool]:
+    """Best neighbours of the chain and whether there may be more of them passing min_qscore."""
+    from app.computation import DBConnection, cache_alignment, get_similarity_results, run_search_phases
+
+    # The current lists must not answer their own rebuild
+    candidates, _ = run_search_phases(chain_id, 1 - min_qscore, size, job_id, use_neighbour_lists=False)
+    neighbours = []
+    with DBConnection() as db:
+        for other in candidates:
+            begin = time.time()
+            results = get_similarity_results(chain_id, other, min_qscore, job_id)
+            elapsed = int((time.time() - begin) * 1000)
+            if results[0] < min_qscore:
+                continue
+            neighbours.append((other, results[0]))
+            # Slower alignments were cached by get_similarity_results() already
+            if other != chain_id and elapsed <= 30:
+                cache_alignment(db, chain_id, other, elapsed, results)
+        neighbours.sort(key=lambda neighbour: neighbour[1], reverse=True)
+        others = [other for other, _ in neighbours[:size] if other != chain_id]
+        if others:
+            ids_format = ', '.join(['%s'] * len(others))
+            db.c.execute(f'UPDATE queriesNearestNeighboursStats SET neighbourList = TRUE '
+                         f'WHERE queryGesamtId = %s AND nnGesamtId IN ({ids_format})', (chain_id, *others))
+            db.conn.commit()
+    # MESSIF returns at most size candidates, a full answer may have left out more chains passing min_qscore
+    return neighbours[:size], len(candidates) >= size
+
+
+def chain_list(int_id: int, chain_id: str, size: int, min_qscore: float) \
+        -> Optional[Tuple[List[Tuple[int, float]], bool]]:
+    """Neighbours of the chain as intIds with Q-scores and whether the list is truncated, None if it failed."""
+    from app.computation import DBConnection, get_int_ids
+
+    try:
+        neighbours, truncated = neighbours_of(chain_id, size, min_qscore, f'neighbours_{int_id}')
+    except Exception as e:
+        # The chain gets no list, its searches go to MESSIF
+        print(f'Neighbours of {chain_id} not computed: {e}', file=sys.stderr)
+        return None
+    with DBConnection() as db:
+        int_ids = get_int_ids([other for other, _ in neighbours], db)
+    return [(int_ids[other], qscore) for other, qscore in neighbours if other in int_ids], truncated
+
+
+def build_chunk(index: int, chains: List[Tuple[int, str]], size: int, min_qscore: float, work_dir: Path) -> int:
+    """Saves the lists of the chains to a chunk file of the work directory, returns the number of failed chains."""
+    int_ids, offsets, neighbours, qscores, truncated = [], [0], [], [], []
+    failed = 0
+    for int_id, chain_id in chains:
+        result = chain_list(int_id, chain_id, size, min_qscore)
+        if result is None:
+            failed += 1
+            continue
+        int_ids.append(int_id)
+        offsets.append(offsets[-1] + len(result[0]))
+        neighbours.extend(neighbour for neighbour, _ in result[0])
+        qscores.extend(qscore for _, qscore in result[0])
+        truncated.append(result[1])
+
+    path = Path(work_dir, f'chunk_{index:06d}.npz')
+    with open(path.with_suffix('.tmp'), 'wb') as f:
+        np.savez(f, int_ids=np.array(int_ids, dtype=np.int64), offsets=np.array(offsets, dtype=np.int64),
+                 neighbours=np.array(neighbours, dtype=np.int64), qscores=np.array(qscores, dtype=np.float32),
+                 truncated=np.array(truncated, dtype=bool))
+    os.replace(path.with_suffix('.tmp'), path)
+    return failed
+
+
+def merge_chunks(work_dir: Path, chunk_count: int) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    int_ids, offsets, neighbours, qscores, truncated = [], [np.zeros(1, dtype=np.int64)], [], [], []
+    total = 0
+    for index in range(chunk_count):
+        with np.load(Path(work_dir, f'chunk_{index:06d}.npz')) as chunk:
+            int_ids.append(chunk['int_ids'])
+            offsets.append(chunk['offsets'][1:] + total)
+            neighbours.append(chunk['neighbours'])
+            qscores.append(chunk['qscores'])
+            truncated.append(chunk['truncated'])
+            total += len(chunk['neighbours'])
+    return (np.concatenate(int_ids), np.concatenate(offsets), np.concatenate(neighbours), np.concatenate(qscores),
+            np.concatenate(truncated))
+
+
+def apply_changes(changes_file: str, root: Path, workers: int, size: int, min_qscore: float) -> None:
+    """Aligns the added and modified chains against their neighbours (filling the alignment cache) and adds them to
+    the current lists. The changed chains were dropped from the lists by update_binary_archive.py already."""
+    from app.computation import DBConnection, WORKER_CONTEXT, get_int_ids
+    from app.neighbours import load_current, update_neighbour_lists
+
+    with open(changes_file) as f:
+        changes = json.load(f)
+    lists = load_current(root)
+    if lists is not None:
+        # New lists are merged into the current ones, so they must be built the same way
+        size, min_qscore = lists.size, lists.min_qscore
+
+    chain_ids = changes['added'] + changes['modified']
+    with DBConnection() as db:
+        int_ids = get_int_ids(chain_ids, db)
+        # MESSIF may return the removed chains until its index is rebuilt
+        removed = set(get_int_ids(changes['removed'], db).values()) if changes['removed'] else set()
+    new_lists: Dict[int, Tuple[List[Tuple[int, float]], bool]] = {}
+    with ProcessPoolExecutor(workers, mp_context=WORKER_CONTEXT) as executor:
+        jobs = {executor.submit(chain_list, int_ids[chain_id], chain_id, size, min_qscore): int_ids[chain_id]
+                for chain_id in chain_ids if chain_id in int_ids}
+        for job in tqdm.tqdm(as_completed(jobs), total=len(jobs), desc='Aligning changed chains'):
+            result = job.result()
+            if result is not None:
+                neighbours, truncated = result
+                new_lists[jobs[job]] = [neighbour for neighbour in neighbours if neighbour[0] not in removed], truncated
+
+    directory = update_neighbour_lists(root, [], new_lists)
+    print(f'Neighbours of {len(new_lists)} of {len(chain_ids)} changed chains computed'
+          f'{f", lists saved to {directory}" if directory is not None else ""}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='/etc/protein_search.ini', help='File with configuration of DB')
+    parser.add_argument('--size', type=int, default=100, help='Maximal number of neighbours of a chain')
+    parser.add_argument('--min-qscore', type=float, default=0.5, help='Minimal Q-score of a neighbour')
+    parser.add_argument('--workers', type=int, default=1, help='Number of workers')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Number of chains per saved chunk')
+    parser.add_argument('--work-directory', type=str, help='Directory of the chunks (default next to the lists)')
+    parser.add_argument('--restart', action='store_true', help='Discard the chunks of an interrupted build')
+    parser.add_argument('--changes', type=str, help='Update the lists with the chains changed by an archive update')
+    args = parser.parse_args()
+
+    # The app reads its configuration when imported (by the workers, too)
+    os.environ['PROTEIN_SEARCH_CONFIG'] = args.config
+    from app.computation import DBConnection, WORKER_CONTEXT
+    from app.neighbours import get_neighbours_dir, write_neighbour_lists
+
+    with DBConnection() as db:
+        db.c.execute(ADD_LIST_FLAG)
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    root = get_neighbours_dir(config)
+    if args.changes:
+        apply_changes(args.changes, root, args.workers, args.size, args.min_qscore)
+        return
+
+    work_dir = Path(args.work_directory) if args.work_directory else root.with_name(f'{root.name}_build')
+    parameters = {'size': args.size, 'min_qscore': args.min_qscore, 'chunk_size': args.chunk_size}
+
+    if args.restart:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if Path(work_dir, MANIFEST).exists():
+        with open(Path(work_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+        if manifest['parameters'] != parameters:
+            print(f'Build in {work_dir} uses different parameters {manifest["parameters"]}, use --restart')
+            return
+        # The chunks of the interrupted build cover these chains, even if the DB changed meanwhile
+        chains = [tuple(chain) for chain in manifest['chains']]
+    else:
+        conn = mariadb.connect(host=config['db']['host'], user=config['db']['user'],
+                               password=config['db']['password'], database=config['db']['database'])
+        chains = get_chains(conn)
+        conn.close()
+        work_dir.mkdir(parents=True, exist_ok=True)
+        with open(Path(work_dir, MANIFEST), 'w') as f:
+            json.dump({'parameters': parameters, 'chains': chains}, f)
+
+    chunks = [chains[i:i + args.chunk_size] for i in range(0, len(chains), args.chunk_size)]
+    missing = [index for index in range(len(chunks)) if not Path(work_dir, f'chunk_{index:06d}.npz').exists()]
+    print(f'Computing neighbours of {len(chains)} chains, {len(chunks) - len(missing)} of {len(chunks)} chunks done')
+
+    failed = 0
+    with ProcessPoolExecutor(args.workers, mp_context=WORKER_CONTEXT) as executor:
+        jobs = [executor.submit(build_chunk, index, chunks[index], args.size, args.min_qscore, work_dir)
+                for index in missing]
+        for job in tqdm.tqdm(as_completed(jobs), total=len(jobs), desc='Computing neighbour lists'):
+            failed += job.result()
+
+    int_ids, offsets, neighbours, qscores, truncated = merge_chunks(work_dir, len(chunks))
+    directory = write_neighbour_lists(root, int_ids, offsets, neighbours, qscores, truncated, args.size,
+                                      args.min_qscore)
+    shutil.rmtree(work_dir)
+    print(f'Lists of {len(int_ids)} chains ({len(neighbours)} neighbours) saved to {directory}'
+          f'{f", {failed} chains failed" if failed else ""}')
+
+
+if __name__ == '__main__':
+    main()
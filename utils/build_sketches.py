@@ -0,0 +1,88 @@
+import argparse
+import configparser
+import mariadb
+import numpy as np
+import python_distance
+import tqdm
+from pathlib import Path
+from typing import List, Tuple
+from concurrent.futures import as_completed, ProcessPoolExecutor
+
+
+def get_pivots(conn: 'mariadb.connection', count: int) -> List[str]:
+    cursor = conn.cursor()
+    cursor.execute('SELECT id FROM pivotSet WHERE currentlyUsed = 1')
+    pivot_set_id = cursor.fetchall()[0][0]
+    cursor.execute('SELECT gesamtId FROM proteinChain WHERE intId IN '
+                   '(SELECT chainIntId FROM pivot512 WHERE pivotSetId = %s) ORDER BY gesamtId LIMIT %s',
+                   (pivot_set_id, count))
+    prefix = f'@{pivot_set_id}_'
+    pivots = [row[0][len(prefix):] for row in cursor.fetchall()]
+    cursor.close()
+    return pivots
+
+
+def get_chains(conn: 'mariadb.connection') -> List[str]:
+    cursor = conn.cursor()
+    cursor.execute('SELECT gesamtId FROM proteinChain WHERE indexedAsDataObject = 1')
+    chains = sorted(row[0] for row in cursor.fetchall())
+    cursor.close()
+    return chains
+
+
+def pivot_distances(chain_id: str, pivots: List[str], archive_dir: str) -> Tuple[str, List[float]]:
+    distances = []
+    for pivot in pivots:
+        _, qscore, *_ = python_distance.get_results(chain_id, pivot, archive_dir, 0.0)
+        distances.append(1 - qscore)
+    return chain_id, distances
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='/etc/protein_search.ini', help='File with configuration of DB')
+    parser.add_argument('--output-directory', type=str, required=True, help='Directory to store the sketch index')
+    parser.add_argument('--bits', type=int, default=64, help='Number of sketch bits (one pivot per bit)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of workers')
+    args = parser.parse_args()
+
+    if args.bits % 8:
+        parser.error('Number of bits must be divisible by 8')
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    conn = mariadb.connect(host=config['db']['host'], user=config['db']['user'], password=config['db']['password'],
+                           database=config['db']['database'])
+    pivots = get_pivots(conn, args.bits)
+    chains = get_chains(conn)
+    conn.close()
+
+    if len(pivots) < args.bits:
+        print(f'Only {len(pivots)} pivots available, cannot build {args.bits}-bit sketches')
+        return
+
+    print(f'Computing distances of {len(chains)} chains to {len(pivots)} pivots')
+    distances = np.empty((len(chains), len(pivots)), dtype=np.float32)
+    row = {chain_id: i for i, chain_id in enumerate(chains)}
+    with ProcessPoolExecutor(args.workers) as executor:
+        jobs = [executor.submit(pivot_distances, chain_id, pivots, config['dirs']['archive']) for chain_id in chains]
+        for job in tqdm.tqdm(as_completed(jobs), total=len(jobs), desc='Computing pivot distances'):
+            chain_id, chain_distances = job.result()
+            distances[row[chain_id]] = chain_distances
+
+    # Median radius splits the chains into halves for each pivot, i.e., balanced bits
+    thresholds = np.median(distances, axis=0)
+    sketches = np.packbits(distances <= thresholds, axis=1)
+
+    output = Path(args.output_directory)
+    output.mkdir(parents=True, exist_ok=True)
+    np.save(output / 'sketches.npy', sketches)
+    np.save(output / 'names.npy', np.array(chains))
+    np.save(output / 'pivots.npy', np.array(pivots))
+    np.save(output / 'thresholds.npy', thresholds)
+    print(f'Sketch index saved to {output}')
+
+
+if __name__ == '__main__':
+    main()
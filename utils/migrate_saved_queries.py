@@ -0,0 +1,59 @@
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+CREATE_HITS_TABLE = '''
+CREATE TABLE IF NOT EXISTS savedQueryHits (
+    job_id VARCHAR(64) NOT NULL,
+    position SMALLINT UNSIGNED NOT NULL,
+    chainIntId INT UNSIGNED NOT NULL,
+    qscore FLOAT NOT NULL,
+    rmsd FLOAT NOT NULL,
+    seqIdentity FLOAT NOT NULL,
+    alignedResidues INT NOT NULL,
+    rotationStats VARCHAR(255),
+    PRIMARY KEY (job_id, position),
+    UNIQUE KEY job_chain (job_id, chainIntId)
+)
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move hits of saved queries from JSON blobs to savedQueryHits')
+    parser.add_argument('--config', type=str, default='/etc/protein_search.ini', help='File with configuration of DB')
+    args = parser.parse_args()
+
+    # Hits are stored the same way as by the app, which reads its configuration when imported
+    os.environ['PROTEIN_SEARCH_CONFIG'] = args.config
+    from app.computation import DBConnection, compact_res_data, save_hits
+
+    with DBConnection() as db:
+        db.c.execute(CREATE_HITS_TABLE)
+        db.c.execute('ALTER TABLE savedQueryHits ADD COLUMN IF NOT EXISTS rotationStats VARCHAR(255)')
+
+        db.c.execute('SELECT job_id, statistics FROM savedQueries')
+        saved = db.c.fetchall()
+        print(f'Checking {len(saved)} saved queries')
+
+        migrated = 0
+        for job_id, statistics in saved:
+            res_data = json.loads(statistics)
+            if 'statistics' not in res_data:
+                continue
+
+            # Transformations were not stored in the blobs
+            save_hits(db, job_id, res_data['statistics'], {})
+            db.c.execute('UPDATE savedQueries SET statistics = %s WHERE job_id = %s',
+                         (json.dumps(compact_res_data(res_data)), job_id))
+            db.conn.commit()
+            migrated += 1
+
+    print(f'Migrated {migrated} saved queries')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,8 @@ import random
 from pathlib import Path
 import shutil
 
+from build_id_map import build_id_map, get_id_map_dir
+
 PIVOT_SIZE_LIMIT = 2500
 
 
@@ -44,8 +46,10 @@ def main():
         'INSERT IGNORE INTO proteinChain (gesamtId, chainLength, indexedAsDataObject) VALUES (%s, %s, %s)',
         pivot_entries)
 
-    cursor.execute(f'SELECT intId FROM proteinChain WHERE gesamtId LIKE \'@{pivot_set_id}_%\'')
-    ids = [(x[0], pivot_set_id) for x in cursor.fetchall()]
+    # Pivots are new rows of proteinChain, so the mapping is rebuilt anyway
+    id_map = build_id_map(conn, get_id_map_dir(config))
+    ids = [(int_id, pivot_set_id) for int_id in id_map.to_int_ids([entry[0] for entry in pivot_entries])
+           if int_id is not None]
 
     print(f"inserting {len(ids)} pivots")
     print(ids[0])
@@ -13,6 +13,9 @@ import tqdm
 from typing import Optional, Tuple, List, Dict
 from concurrent.futures import as_completed, ProcessPoolExecutor
 
+from archive_hooks import run_update_hook
+from build_id_map import build_id_map, get_id_map_dir
+
 
 def get_dir(filename: str) -> str:
     return Path(filename).name[1:3]
@@ -77,8 +80,9 @@ def get_whats_updated(mirror_dir: str, raw_dir: str, executor: ProcessPoolExecut
     return new_files, modified_files, removed_files, stats
 
 
-def remove_chains(files: List[str], raw_dir: str, binary_dir: str, conn: 'mariadb.connection') -> None:
+def remove_chains(files: List[str], raw_dir: str, binary_dir: str, conn: 'mariadb.connection') -> List[str]:
     cursor = conn.cursor()
+    removed_chains = []
     for file in files:
         pdb_id = Path(file).with_suffix('').name.upper()
         cursor.execute('DELETE FROM protein WHERE pdbId = %s', (pdb_id,))
@@ -90,6 +94,7 @@ def remove_chains(files: List[str], raw_dir: str, binary_dir: str, conn: 'mariad
             int_ids, chain_ids = zip(*result)
             ids_format = ', '.join(['%s'] * len(int_ids))
             cursor.execute(f'UPDATE proteinChain SET indexedAsDataObject = 0 WHERE intId IN ({ids_format})', int_ids)
+            removed_chains.extend(chain_ids)
 
             for chain_id in chain_ids:
                 try:
@@ -101,6 +106,7 @@ def remove_chains(files: List[str], raw_dir: str, binary_dir: str, conn: 'mariad
 
     conn.commit()
     cursor.close()
+    return removed_chains
 
 
 def decompress_file(filename, src_dir: str, dest_dir: str) -> None:
@@ -137,7 +143,7 @@ def read_protein_title(filename: str) -> Tuple[str, Optional[str]]:
 
 
 def add_chains(files: List[str], mirror_dir: str, raw_dir: str, binary_dir: str, conn: 'mariadb.connection',
-               executor: ProcessPoolExecutor) -> None:
+               executor: ProcessPoolExecutor) -> List[str]:
     cursor = conn.cursor()
 
     # Decompress gzipped CIFs
@@ -176,6 +182,7 @@ def add_chains(files: List[str], mirror_dir: str, raw_dir: str, binary_dir: str,
         conn.commit()
 
     cursor.close()
+    return [chain_id for chain_id, _ in chains_to_store]
 
 
 def consistency_check(raw_dir: str, conn: 'mariadb.connection') -> None:
@@ -248,6 +255,8 @@ def main():
     parser.add_argument('--raw-directory', type=str, required=True, help='Directory with uncompressed files')
     parser.add_argument('--workers', type=int, default=1, help='Number of workers ')
     parser.add_argument('--consistency-check', type=bool, default=False, help='Should a consistency check with DB be performed')
+    parser.add_argument('--no-neighbour-update', action='store_true',
+                        help='Do not align the changed chains against their neighbours in the background')
     args = parser.parse_args()
 
     config = configparser.ConfigParser()
@@ -280,16 +289,29 @@ def main():
 
 
     print('*** Processing new entries ***')
-    add_chains(new_files, args.mirror_directory, args.raw_directory, args.binary_directory, conn, executor)
+    added = add_chains(new_files, args.mirror_directory, args.raw_directory, args.binary_directory, conn, executor)
 
     print('*** Removing obsoleted entries ***')
-    remove_chains(removed_files, args.raw_directory, args.binary_directory, conn)
+    removed = remove_chains(removed_files, args.raw_directory, args.binary_directory, conn)
 
     print('*** Updating modified entries (1 - remove) ***')
-    remove_chains(modified_files, args.raw_directory, args.binary_directory, conn)
+    old_chains = remove_chains(modified_files, args.raw_directory, args.binary_directory, conn)
 
     print('*** Updating modified entries (2 - add) ***')
-    add_chains(modified_files, args.mirror_directory, args.raw_directory, args.binary_directory, conn, executor)
+    new_chains = add_chains(modified_files, args.mirror_directory, args.raw_directory, args.binary_directory, conn,
+                            executor)
+
+    print('*** Rebuilding chain ID mapping ***')
+    build_id_map(conn, get_id_map_dir(config))
+
+    print('*** Invalidating cached results ***')
+    # Chains of modified entries may appear or disappear, e.g., when gesamt reads the new structure differently
+    old_set, new_set = set(old_chains), set(new_chains)
+    added += [chain_id for chain_id in new_chains if chain_id not in old_set]
+    removed += [chain_id for chain_id in old_chains if chain_id not in new_set]
+    modified = [chain_id for chain_id in new_chains if chain_id in old_set]
+    run_update_hook(conn, args.config, added, removed, modified, args.workers,
+                    background=not args.no_neighbour_update)
 
     conn.close()
 